@@ -0,0 +1,105 @@
+"""Time fetching pages of a big userdata table sorted by a user column, before
+and after the column has been indexed.
+
+The first, a middle and the last page are each fetched repeatedly and the
+median latency is reported.
+
+Creates a scratch table of synthetic data (with generate_series, to save
+time) in a transaction that is rolled back at the end, so nothing is left
+behind.  Run with:
+
+    python benchmarks/column_sort.py --rows 1000000
+
+"""
+
+import argparse
+import statistics
+import time
+
+from passlib.context import CryptContext
+from sqlalchemy import text
+
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import (
+    BinaryFilter,
+    BinaryOp,
+    Column,
+    ColumnType,
+    KeySet,
+    ROW_ID_COLUMN,
+)
+from csvbase.web.app import init_app
+
+from tests.utils import create_table, make_user
+
+NAME_COLUMN = Column("name", ColumnType.TEXT)
+COUNT_COLUMN = Column("count", ColumnType.INTEGER)
+COLUMNS = [NAME_COLUMN, COUNT_COLUMN]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        backend = PGUserdataAdapter(sesh)
+        user = make_user(sesh, CryptContext(["plaintext"]))
+        table = create_table(sesh, user, COLUMNS)
+        try:
+            table_name = f"userdata.table_{table.table_uuid.hex}"
+            # counts are scattered, so the row id order is no help
+            sesh.execute(
+                text(
+                    f"INSERT INTO {table_name} (name, count)"
+                    " SELECT 'row number ' || n, (n::bigint * 7919) % :rows"
+                    " FROM generate_series(1, :rows) AS n"
+                ),
+                {"rows": args.rows},
+            )
+            sesh.execute(text(f"ANALYZE {table_name}"))
+
+            keysets = [
+                ("first", KeySet([COUNT_COLUMN, ROW_ID_COLUMN], (), "greater_than")),
+                (
+                    "middle",
+                    KeySet(
+                        [COUNT_COLUMN, ROW_ID_COLUMN],
+                        (args.rows // 2, 0),
+                        "greater_than",
+                    ),
+                ),
+                ("last", KeySet([COUNT_COLUMN, ROW_ID_COLUMN], (), "less_than")),
+                (
+                    "filter",
+                    KeySet(
+                        [ROW_ID_COLUMN],
+                        (),
+                        "greater_than",
+                        filters=[BinaryFilter(COUNT_COLUMN, 1000, BinaryOp.LT)],
+                    ),
+                ),
+            ]
+            for indexed in [False, True]:
+                if indexed:
+                    backend.create_column_index(table.table_uuid, COUNT_COLUMN.name)
+                    sesh.execute(text(f"ANALYZE {table_name}"))
+                for name, keyset in keysets:
+                    timings = []
+                    for _ in range(args.repeats):
+                        start = time.perf_counter()
+                        backend.table_page(table, keyset)
+                        timings.append(time.perf_counter() - start)
+                    print(
+                        f"{'indexed' if indexed else 'unindexed':>9} {name:>7}:"
+                        f" {statistics.median(timings) * 1000:.2f}ms"
+                    )
+        finally:
+            sesh.rollback()
+
+
+if __name__ == "__main__":
+    main()
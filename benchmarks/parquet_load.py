@@ -0,0 +1,127 @@
+"""Compare ways of loading a parquet file into a userdata table.
+
+- rows: parquet_file_to_rows into insert_table_data/upsert_table_data, ie: a
+  python tuple per row, COPYed in by pgcopy
+- record-batches: parquet_file_to_record_batches into
+  insert_record_batches/upsert_record_batches, ie: arrow writes csv which is
+  streamed into a single COPY
+
+Creates scratch tables in a transaction that is rolled back at the end, so
+nothing is left behind.  Run with:
+
+    python benchmarks/parquet_load.py --rows 1000000
+
+"""
+
+import argparse
+import io
+import time
+from datetime import date, timedelta
+from typing import Callable
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from passlib.context import CryptContext
+
+from csvbase import table_io
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import Column, ColumnType, ROW_ID_COLUMN
+from csvbase.web.app import init_app
+
+from tests.utils import create_table, make_user
+
+COLUMNS = [
+    Column("name", ColumnType.TEXT),
+    Column("count", ColumnType.INTEGER),
+    Column("ratio", ColumnType.FLOAT),
+    Column("flag", ColumnType.BOOLEAN),
+    Column("day", ColumnType.DATE),
+]
+
+
+def synthetic_parquet(n: int, with_row_ids: bool) -> io.BytesIO:
+    start = date(2000, 1, 1)
+    data = {
+        "name": [f"row number {i}" for i in range(1, n + 1)],
+        "count": [i * 7 for i in range(1, n + 1)],
+        "ratio": [i / 3 for i in range(1, n + 1)],
+        "flag": [i % 2 == 0 for i in range(1, n + 1)],
+        "day": [start + timedelta(i % 10_000) for i in range(1, n + 1)],
+    }
+    if with_row_ids:
+        data = {"csvbase_row_id": list(range(1, n + 1)), **data}
+    buf = io.BytesIO()
+    pq.write_table(pa.table(data), buf)
+    buf.seek(0)
+    return buf
+
+
+def time_load(
+    name: str, load: Callable[[PGUserdataAdapter, pq.ParquetFile], None], **kwargs
+) -> None:
+    sesh = get_sesh()
+    backend = PGUserdataAdapter(sesh)
+    pf = table_io.buf_to_pf(synthetic_parquet(**kwargs))
+    start = time.perf_counter()
+    load(backend, pf)
+    sesh.flush()
+    print(f"{name:>22}: {time.perf_counter() - start:.3f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        user = make_user(sesh, CryptContext(["plaintext"]))
+        try:
+            for name, with_row_ids, load in [
+                (
+                    "insert rows",
+                    False,
+                    lambda backend, table, pf: backend.insert_table_data(
+                        table, COLUMNS, table_io.parquet_file_to_rows(pf)
+                    ),
+                ),
+                (
+                    "insert record-batches",
+                    False,
+                    lambda backend, table, pf: backend.insert_record_batches(
+                        table, COLUMNS, table_io.parquet_file_to_record_batches(pf)
+                    ),
+                ),
+                (
+                    "upsert rows",
+                    True,
+                    lambda backend, table, pf: backend.upsert_table_data(
+                        table,
+                        [ROW_ID_COLUMN] + COLUMNS,
+                        table_io.parquet_file_to_rows(pf),
+                    ),
+                ),
+                (
+                    "upsert record-batches",
+                    True,
+                    lambda backend, table, pf: backend.upsert_record_batches(
+                        table,
+                        [ROW_ID_COLUMN] + COLUMNS,
+                        table_io.parquet_file_to_record_batches(pf),
+                    ),
+                ),
+            ]:
+                table = create_table(sesh, user, COLUMNS)
+                time_load(
+                    name,
+                    lambda backend, pf: load(backend, table, pf),
+                    n=args.rows,
+                    with_row_ids=with_row_ids,
+                )
+        finally:
+            sesh.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Time writing rows one at a time (as the single-row API does, committing
+each) against writing them in one batch of row operations.
+
+Half of the operations create rows, a quarter update them and a quarter
+delete them.
+
+This has to commit, so creates a scratch user (which is left behind) and
+table (which is dropped at the end).  Run with:
+
+    python benchmarks/row_batch.py --operations 1000
+
+"""
+
+import argparse
+import time
+from typing import List
+
+from passlib.context import CryptContext
+
+from csvbase import svc
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import Column, ColumnType, RowOperation, Table
+from csvbase.web.app import init_app
+
+from tests.utils import create_table, make_user
+
+NAME_COLUMN = Column("name", ColumnType.TEXT)
+COUNT_COLUMN = Column("count", ColumnType.INTEGER)
+COLUMNS = [NAME_COLUMN, COUNT_COLUMN]
+
+
+def make_operations(n: int, first_row_id: int) -> List[RowOperation]:
+    creates = [
+        RowOperation("create", row={NAME_COLUMN: f"row {i}", COUNT_COLUMN: i})
+        for i in range(n // 2)
+    ]
+    updates = [
+        RowOperation(
+            "update",
+            row_id=first_row_id + i,
+            row={NAME_COLUMN: f"row {i}", COUNT_COLUMN: -i},
+        )
+        for i in range(n // 4)
+    ]
+    deletes = [
+        RowOperation("delete", row_id=first_row_id + n // 4 + i) for i in range(n // 4)
+    ]
+    return creates + updates + deletes
+
+
+def one_at_a_time(backend: PGUserdataAdapter, table: Table, n: int) -> float:
+    sesh = backend.sesh
+    start = time.perf_counter()
+    for operation in make_operations(n, first_row_id=1):
+        if operation.op == "create":
+            backend.insert_row(table.table_uuid, operation.row or {})
+        elif operation.op == "update":
+            backend.update_row(
+                table.table_uuid, operation.row_id or 0, operation.row or {}
+            )
+        else:
+            backend.delete_row(table.table_uuid, operation.row_id or 0)
+        svc.mark_table_changed(sesh, table.table_uuid)
+        sesh.commit()
+    return time.perf_counter() - start
+
+
+def batched(backend: PGUserdataAdapter, table: Table, n: int) -> float:
+    sesh = backend.sesh
+    start = time.perf_counter()
+    backend.apply_row_operations(
+        table.table_uuid, make_operations(n, first_row_id=n // 2 + 1)
+    )
+    svc.mark_table_changed(sesh, table.table_uuid)
+    sesh.commit()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--operations", type=int, default=1000)
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        backend = PGUserdataAdapter(sesh)
+        user = make_user(sesh, CryptContext(["plaintext"]))
+        table = create_table(sesh, user, COLUMNS)
+        sesh.commit()
+        try:
+            single = one_at_a_time(backend, table, args.operations)
+            batch = batched(backend, table, args.operations)
+            print(f"{args.operations} operations, one at a time: {single:.3f}s")
+            print(f"{args.operations} operations, in one batch:  {batch:.3f}s")
+        finally:
+            svc.delete_table_and_metadata(sesh, user.username, table.table_name)
+            sesh.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Compare ways of reading a whole userdata table out as python rows.
+
+- select: PGUserdataAdapter.table_as_rows, ie: a SELECT streamed via
+  SQLAlchemy (psycopg2 parses the text protocol in C)
+- copy-binary: COPY ... TO STDOUT (FORMAT binary), decoded with a pure
+  python, schema-specialised decoder (below)
+- copy-only: the binary COPY without any decoding, as a lower bound
+
+Creates a scratch table of synthetic data in a transaction that is rolled back
+at the end, so nothing is left behind.  Run with:
+
+    python benchmarks/table_as_rows.py --rows 1000000
+
+"""
+
+import argparse
+import struct
+import time
+from contextlib import closing
+from datetime import date, timedelta
+from tempfile import TemporaryFile
+from typing import IO, Callable, Iterable, Iterator, List, Sequence, Tuple
+from uuid import UUID, uuid4
+
+from pgcopy import CopyManager
+
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import Column, ColumnType, PythonType, ROW_ID_COLUMN
+from csvbase.web.app import init_app
+
+COLUMNS = [
+    ROW_ID_COLUMN,
+    Column("name", ColumnType.TEXT),
+    Column("count", ColumnType.INTEGER),
+    Column("ratio", ColumnType.FLOAT),
+    Column("flag", ColumnType.BOOLEAN),
+    Column("day", ColumnType.DATE),
+]
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER = struct.Struct(f">{len(COPY_SIGNATURE)}sii")
+INT16 = struct.Struct(">h")
+INT32 = struct.Struct(">i")
+INT64 = struct.Struct(">q")
+FLOAT8 = struct.Struct(">d")
+PG_EPOCH_ORDINAL = date(2000, 1, 1).toordinal()
+
+# (buffer, offset, length) -> value
+FieldDecoder = Callable[[bytes, int, int], PythonType]
+
+FIELD_DECODERS = {
+    ColumnType.TEXT: lambda buf, offset, length: str(
+        buf[offset : offset + length], "utf-8"
+    ),
+    ColumnType.INTEGER: lambda buf, offset, length: INT64.unpack_from(buf, offset)[0],
+    ColumnType.FLOAT: lambda buf, offset, length: FLOAT8.unpack_from(buf, offset)[0],
+    ColumnType.BOOLEAN: lambda buf, offset, length: buf[offset] != 0,
+    ColumnType.DATE: lambda buf, offset, length: date.fromordinal(
+        PG_EPOCH_ORDINAL + INT32.unpack_from(buf, offset)[0]
+    ),
+}
+
+
+def synthetic_rows(n: int) -> Iterable[Sequence[PythonType]]:
+    start = date(2000, 1, 1)
+    for i in range(1, n + 1):
+        yield (i, f"row number {i}", i * 7, i / 3, i % 2 == 0, start + timedelta(i))
+
+
+def copy_to_file(backend: PGUserdataAdapter, table_uuid: UUID, copy_file: IO[bytes]):
+    column_names = ", ".join(c.name for c in COLUMNS)
+    raw_conn = backend.sesh.connection().connection
+    with closing(raw_conn.cursor()) as cursor:
+        cursor.copy_expert(
+            f"COPY (SELECT {column_names} FROM userdata.table_{table_uuid.hex}"
+            " ORDER BY csvbase_row_id) TO STDOUT (FORMAT binary)",
+            copy_file,
+        )
+    copy_file.seek(0)
+
+
+def decode_tuples(
+    buf: bytes,
+    offset: int,
+    decoders: Sequence[FieldDecoder],
+    rows: List[Tuple[PythonType, ...]],
+) -> Tuple[int, bool]:
+    """Decode the complete tuples in buf, returning the offset of the first
+    undecoded byte and whether the trailer was reached."""
+    end = len(buf)
+    while offset + 2 <= end:
+        if INT16.unpack_from(buf, offset)[0] == -1:
+            return offset + 2, True
+        position = offset + 2
+        row: List[PythonType] = []
+        for decode in decoders:
+            if position + 4 > end:
+                return offset, False
+            (length,) = INT32.unpack_from(buf, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            if position + length > end:
+                return offset, False
+            row.append(decode(buf, position, length))
+            position += length
+        rows.append(tuple(row))
+        offset = position
+    return offset, False
+
+
+def decode_copy_binary(
+    copy_file: IO[bytes], chunk_size: int = 1024 * 1024
+) -> Iterator[Tuple[PythonType, ...]]:
+    decoders = [FIELD_DECODERS[c.type_] for c in COLUMNS]
+    buf = copy_file.read(chunk_size)
+    signature, _, extension_length = COPY_HEADER.unpack_from(buf)
+    assert signature == COPY_SIGNATURE
+    offset = COPY_HEADER.size + extension_length
+    rows: List[Tuple[PythonType, ...]] = []
+    while True:
+        offset, finished = decode_tuples(buf, offset, decoders, rows)
+        yield from rows
+        rows.clear()
+        if finished:
+            return
+        buf = buf[offset:] + copy_file.read(chunk_size)
+        offset = 0
+
+
+def via_select(
+    backend: PGUserdataAdapter, table_uuid: UUID
+) -> Iterable[Sequence[PythonType]]:
+    return backend.table_as_rows(table_uuid)
+
+
+def via_copy_binary(
+    backend: PGUserdataAdapter, table_uuid: UUID
+) -> Iterable[Sequence[PythonType]]:
+    with TemporaryFile() as copy_file:
+        copy_to_file(backend, table_uuid, copy_file)
+        yield from decode_copy_binary(copy_file)
+
+
+def copy_only(
+    backend: PGUserdataAdapter, table_uuid: UUID
+) -> Iterable[Sequence[PythonType]]:
+    with TemporaryFile() as copy_file:
+        copy_to_file(backend, table_uuid, copy_file)
+    return []
+
+
+def time_export(
+    name: str,
+    export: Callable[[PGUserdataAdapter, UUID], Iterable[Sequence[PythonType]]],
+    backend: PGUserdataAdapter,
+    table_uuid: UUID,
+    repeats: int,
+) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        count = sum(1 for _ in export(backend, table_uuid))
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>12}: {best:.3f}s, {count} rows")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        backend = PGUserdataAdapter(sesh)
+        table_uuid = uuid4()
+        try:
+            backend.create_table(table_uuid, COLUMNS)
+            CopyManager(
+                sesh.connection().connection,
+                f"userdata.table_{table_uuid.hex}",
+                [c.name for c in COLUMNS],
+            ).copy(synthetic_rows(args.rows))
+
+            # check the decoder before timing it
+            assert list(via_copy_binary(backend, table_uuid)) == list(
+                via_select(backend, table_uuid)
+            )
+
+            for name, export in [
+                ("select", via_select),
+                ("copy-binary", via_copy_binary),
+                ("copy-only", copy_only),
+            ]:
+                time_export(name, export, backend, table_uuid, args.repeats)
+        finally:
+            sesh.rollback()
+
+
+if __name__ == "__main__":
+    main()
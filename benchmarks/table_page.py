@@ -0,0 +1,85 @@
+"""Time fetching pages of a big userdata table, as the table view does.
+
+The first, a middle and the last page are each fetched repeatedly and the
+median latency and the number of statements executed are reported.
+
+Creates a scratch table of synthetic data (with generate_series, to save
+time) in a transaction that is rolled back at the end, so nothing is left
+behind.  Run with:
+
+    python benchmarks/table_page.py --rows 10000000
+
+"""
+
+import argparse
+import statistics
+import time
+from typing import List
+
+from passlib.context import CryptContext
+from sqlalchemy import event, text
+
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import Column, ColumnType, KeySet, ROW_ID_COLUMN
+from csvbase.web.app import init_app
+
+from tests.utils import create_table, make_user
+
+COLUMNS = [
+    Column("name", ColumnType.TEXT),
+    Column("count", ColumnType.INTEGER),
+    Column("ratio", ColumnType.FLOAT),
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        backend = PGUserdataAdapter(sesh)
+        user = make_user(sesh, CryptContext(["plaintext"]))
+        table = create_table(sesh, user, COLUMNS)
+        try:
+            table_name = f"userdata.table_{table.table_uuid.hex}"
+            sesh.execute(
+                text(
+                    f"INSERT INTO {table_name} (name, count, ratio)"
+                    " SELECT 'row number ' || n, n * 7, n / 3.0"
+                    " FROM generate_series(1, :rows) AS n"
+                ),
+                {"rows": args.rows},
+            )
+            sesh.execute(text(f"ANALYZE {table_name}"))
+
+            statements: List[str] = []
+            event.listen(
+                sesh.get_bind(),
+                "before_cursor_execute",
+                lambda conn, cursor, statement, *rest: statements.append(statement),
+            )
+            for name, keyset in [
+                ("first", KeySet([ROW_ID_COLUMN], (0,), "greater_than")),
+                ("middle", KeySet([ROW_ID_COLUMN], (args.rows // 2,), "greater_than")),
+                ("last", KeySet([ROW_ID_COLUMN], (args.rows + 1,), "less_than")),
+            ]:
+                timings = []
+                statements.clear()
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    backend.table_page(table, keyset)
+                    timings.append(time.perf_counter() - start)
+                print(
+                    f"{name:>7}: {statistics.median(timings) * 1000:.2f}ms,"
+                    f" {len(statements) / args.repeats:.0f} statements"
+                )
+        finally:
+            sesh.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Time upserts against the size of the table, with and without the staging
+table being prepared (ANALYZEd, and indexed when large).
+
+Each table is loaded with n rows and then upserted with n rows, of which a
+tenth are changed and a twentieth are new.  Both the csvbase_row_id path and
+the path for another (unique) key are timed.
+
+Creates scratch tables in a transaction that is rolled back at the end, so
+nothing is left behind.  Run with:
+
+    python benchmarks/upsert_staging.py --sizes 10000 100000 1000000
+
+"""
+
+import argparse
+import time
+from typing import List, Sequence, Tuple, cast
+from unittest.mock import patch
+
+from passlib.context import CryptContext
+from sqlalchemy import func, select
+from sqlalchemy.sql.expression import TableClause
+
+from csvbase.sesh import get_sesh
+from csvbase.userdata import PGUserdataAdapter
+from csvbase.value_objs import Column, ColumnType, ROW_ID_COLUMN
+from csvbase.web.app import init_app
+
+from tests.utils import create_table, make_user
+
+NAME_COLUMN = Column("name", ColumnType.TEXT)
+COUNT_COLUMN = Column("count", ColumnType.INTEGER)
+COLUMNS = [NAME_COLUMN, COUNT_COLUMN]
+
+
+def unprepared_staging_table(
+    self: PGUserdataAdapter, temp_tableclause: TableClause, key: Sequence[Column]
+) -> int:
+    """As things were before: just count the rows."""
+    return cast(
+        int,
+        self.sesh.execute(select(func.count()).select_from(temp_tableclause)).scalar(),
+    )
+
+
+def new_rows(n: int, with_row_ids: bool) -> List[Tuple]:
+    rows: List[Tuple] = []
+    for i in range(1, n + 1):
+        if i % 20 == 0:
+            # a new row
+            row: Tuple = (f"new row {i}", i)
+            row_id = None
+        elif i % 10 == 0:
+            row = (f"row {i}", -i)
+            row_id = i
+        else:
+            row = (f"row {i}", i)
+            row_id = i
+        rows.append((row_id, *row) if with_row_ids else row)
+    return rows
+
+
+def time_upsert(n: int, by_row_id: bool, prepared: bool) -> float:
+    sesh = get_sesh()
+    backend = PGUserdataAdapter(sesh)
+    user = make_user(sesh, CryptContext(["plaintext"]))
+    table = create_table(sesh, user, COLUMNS)
+    backend.insert_table_data(
+        table, COLUMNS, ((f"row {i}", i) for i in range(1, n + 1))
+    )
+    if by_row_id:
+        row_columns = [ROW_ID_COLUMN] + COLUMNS
+        key: Sequence[Column] = (ROW_ID_COLUMN,)
+    else:
+        row_columns = COLUMNS
+        key = (NAME_COLUMN,)
+        backend.create_key_index(table.table_uuid, key)
+    rows = new_rows(n, with_row_ids=by_row_id)
+
+    start = time.perf_counter()
+    if prepared:
+        backend.upsert_table_data(table, row_columns, rows, key=key)
+    else:
+        with patch.object(
+            PGUserdataAdapter, "_prepare_staging_table", unprepared_staging_table
+        ):
+            backend.upsert_table_data(table, row_columns, rows, key=key)
+    sesh.flush()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    args = parser.parse_args()
+
+    with init_app().app_context():
+        sesh = get_sesh()
+        print(f"{'rows':>10} {'key':>7} {'unprepared':>11} {'prepared':>9}")
+        try:
+            for n in args.sizes:
+                for by_row_id in [True, False]:
+                    unprepared = time_upsert(n, by_row_id, prepared=False)
+                    prepared = time_upsert(n, by_row_id, prepared=True)
+                    print(
+                        f"{n:>10} {'row id' if by_row_id else 'name':>7}"
+                        f" {unprepared:>10.3f}s {prepared:>8.3f}s"
+                    )
+        finally:
+            sesh.rollback()
+
+
+if __name__ == "__main__":
+    main()
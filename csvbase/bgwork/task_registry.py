@@ -10,7 +10,8 @@ from csvbase.web.billing import svc as billing_svc
 from csvbase.value_objs import GitUpstream, ContentType
 from csvbase.userdata import PGUserdataAdapter
 from csvbase.sesh import get_sesh
-from csvbase import svc
+from csvbase.config import get_config
+from csvbase import exc, svc
 from csvbase.bgwork.core import celery
 from csvbase.follow import update
 from csvbase.follow.git import GitSource
@@ -68,20 +69,49 @@ def update_stripe_subscriptions() -> None:
     billing_svc.update_stripe_subscriptions(sesh, full=False)
 
 
+@celery.task
+def refresh_top_tables() -> None:
+    sesh = get_sesh()
+    svc.refresh_top_tables(sesh)
+    sesh.commit()
+
+
 @celery.task
 def populate_repcache(table_uuid: UUID, content_type_str: str) -> None:
     sesh = get_sesh()
     table = svc.get_table_by_uuid(sesh, table_uuid)
     content_type = ContentType(content_type_str)
-    repcache = RepCache(table.table_uuid, content_type, table.last_changed)
-    if repcache.write_in_progress():
+    try:
+        svc.populate_repcache(sesh, table_uuid, content_type)
+    except exc.RepWriteInProgress:
         logger.info(
             "repcache already being populated for %s/%s",
             table.ref(),
-            table.last_changed,
+            table.version,
         )
-    else:
-        svc.populate_repcache(sesh, table_uuid, content_type)
+
+
+@celery.task
+def create_column_index(table_uuid: UUID, column_name: str) -> None:
+    sesh = get_sesh()
+    backend = PGUserdataAdapter(sesh)
+    backend.create_column_index(table_uuid, column_name)
+    sesh.commit()
+
+
+@celery.task
+def flush_table_changes() -> None:
+    sesh = get_sesh()
+    table_uuids = svc.flush_table_changes(sesh)
+    sesh.commit()
+    logger.info("flushed changes to %d tables", len(table_uuids))
+
+
+@celery.task
+def evict_from_repcache() -> None:
+    repcache_max_bytes = get_config().repcache_max_bytes
+    if repcache_max_bytes is not None:
+        RepCache.evict(repcache_max_bytes)
 
 
 @celery.on_after_configure.connect
@@ -93,3 +123,13 @@ def setup_periodic_tasks(sender: Celery, **kwargs) -> None:
     sender.add_periodic_task(
         timedelta(days=1).total_seconds(), update_stripe_subscriptions.s()
     )
+    sender.add_periodic_task(
+        timedelta(minutes=10).total_seconds(), refresh_top_tables.s()
+    )
+    table_changed_interval = get_config().table_changed_interval
+    if table_changed_interval is not None:
+        sender.add_periodic_task(table_changed_interval, flush_table_changes.s())
+    if get_config().repcache_max_bytes is not None:
+        sender.add_periodic_task(
+            timedelta(minutes=10).total_seconds(), evict_from_repcache.s()
+        )
@@ -0,0 +1,412 @@
+"""Caches for hot metadata.
+
+The metadata for tables and users is needed by almost every request and
+changes rarely, so it is worth holding onto between requests.
+
+If memcache_server is configured, the cache is shared between all processes
+(on all hosts) via memcached.  Otherwise a process-local stand-in is used,
+which cannot see invalidations made by other processes and so only keeps
+entries for a short time (LOCAL_CACHE_TTL) to bound the staleness.
+
+Invalidation is done with generation numbers: each cached table/user has a
+generation token which is replaced whenever it changes.  A cached value is
+only used if it was stored under the current token.
+
+Users' API keys are secrets, so they are never cached: they are loaded from
+the database each time.
+
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID, uuid4
+import hashlib
+import json
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, SessionTransaction
+
+from .config import get_config
+from .value_objs import (
+    Column,
+    ColumnType,
+    GitUpstream,
+    Licence,
+    RowCount,
+    Table,
+    User,
+    UserSettings,
+)
+
+logger = getLogger(__name__)
+
+LOCAL_CACHE_TTL = timedelta(seconds=5)
+
+LOCAL_CACHE_MAX_SIZE = 4096
+
+# Invalidation in memcached is exact, this is just to eventually clear out
+# anything that is no longer read
+MEMCACHE_EXPIRY = timedelta(days=1)
+
+MEMCACHE_TIMEOUT = timedelta(milliseconds=250)
+
+# the key used in Session.info to hold what should be invalidated (again) when
+# the transaction ends
+_PENDING_INVALIDATIONS_KEY = "csvbase_pending_cache_invalidations"
+
+TABLE = "table"
+USER = "user"
+
+
+class LocalClient:
+    """An in-process LRU stand-in for a memcache client.
+
+    Only the subset of the (pymemcache) client interface that is used here is
+    implemented.
+
+    """
+
+    def __init__(self, max_size: int = LOCAL_CACHE_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        rv = {}
+        now = monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expiry, value = entry
+                if expiry < now:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    rv[key] = value
+        return rv
+
+    def set_many(self, values: Dict[str, bytes], expire: int = 0) -> List[str]:
+        expiry = monotonic() + expire if expire else float("inf")
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (expiry, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return []
+
+    def delete_many(self, keys: Iterable[str]) -> bool:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        return True
+
+    def flush_all(self) -> bool:
+        with self._lock:
+            self._entries.clear()
+        return True
+
+
+@dataclass
+class Generation:
+    """The generation token of some table or user, as read prior to loading it
+    from the database.
+
+    Storing a value under the generation that was current *before* it was
+    loaded means that if it changes in the meantime the value is never used.
+
+    """
+
+    kind: str
+    uuid: UUID
+    token: bytes
+
+
+class MetadataCache:
+    """A cache of Table and User objects on top of a memcache(-like) client."""
+
+    def __init__(self, client: Any, expire: timedelta) -> None:
+        self.client = client
+        self.expire = int(expire.total_seconds())
+
+    def get_table(
+        self, username: str, table_name: str
+    ) -> Tuple[Optional[Table], Optional[Generation]]:
+        """Return the table (if cached) or the generation to store it under
+        once loaded.
+
+        If neither is returned the table should be loaded but not stored.
+
+        """
+        table_uuid = self._resolve(TABLE, f"{username}/{table_name}")
+        if table_uuid is None:
+            return None, None
+        value, generation = self._get(TABLE, table_uuid)
+        if value is not None:
+            table = _table_from_json(value)
+            # the name may since have been given to another table
+            if table.username != username or table.table_name != table_name:
+                return None, None
+            return table, generation
+        return None, generation
+
+    def put_table(self, table: Table, generation: Optional[Generation]) -> None:
+        # Table names can only be resolved to uuids after a miss.  The table
+        # itself is only stored once a generation was read up front.
+        values = {
+            _name_key(TABLE, f"{table.username}/{table.table_name}"): str(
+                table.table_uuid
+            ).encode("utf-8")
+        }
+        if generation is not None and generation.uuid == table.table_uuid:
+            values[_value_key(TABLE, table.table_uuid)] = _dumps(
+                generation.token, _table_to_json(table)
+            )
+        self._set_many(values)
+
+    def get_user_by_name(
+        self, username: str, load_api_key: Callable[[UUID], bytes]
+    ) -> Tuple[Optional[User], Optional[Generation]]:
+        """Return the user (if cached) or the generation to store it under, as
+        get_table does.
+
+        The user's API key is not cached, load_api_key is called for it.
+
+        """
+        user_uuid = self._resolve(USER, username)
+        if user_uuid is None:
+            return None, None
+        user, generation = self.get_user_by_uuid(user_uuid, load_api_key)
+        if user is not None and user.username != username:
+            return None, None
+        return user, generation
+
+    def get_user_by_uuid(
+        self, user_uuid: UUID, load_api_key: Callable[[UUID], bytes]
+    ) -> Tuple[Optional[User], Optional[Generation]]:
+        value, generation = self._get(USER, user_uuid)
+        if value is not None:
+            return _user_from_json(value, load_api_key(user_uuid)), generation
+        return None, generation
+
+    def put_user(self, user: User, generation: Optional[Generation]) -> None:
+        values = {_name_key(USER, user.username): str(user.user_uuid).encode("utf-8")}
+        if generation is not None and generation.uuid == user.user_uuid:
+            values[_value_key(USER, user.user_uuid)] = _dumps(
+                generation.token, _user_to_json(user)
+            )
+        self._set_many(values)
+
+    def invalidate(self, kind: str, uuid: UUID) -> None:
+        self._set_many({_generation_key(kind, uuid): _new_token()})
+
+    def _resolve(self, kind: str, name: str) -> Optional[UUID]:
+        key = _name_key(kind, name)
+        as_bytes = self._get_many([key]).get(key)
+        if as_bytes is None:
+            return None
+        return UUID(as_bytes.decode("utf-8"))
+
+    def _get(
+        self, kind: str, uuid: UUID
+    ) -> Tuple[Optional[Dict[str, Any]], Generation]:
+        value_key = _value_key(kind, uuid)
+        generation_key = _generation_key(kind, uuid)
+        got = self._get_many([value_key, generation_key])
+        token = got.get(generation_key)
+        if token is None:
+            token = _new_token()
+            self._set_many({generation_key: token})
+        generation = Generation(kind, uuid, token)
+        if value_key in got:
+            stored_token, value = _loads(got[value_key])
+            if stored_token == token:
+                return value, generation
+        return None, generation
+
+    def _get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        try:
+            return self.client.get_many(keys)
+        except Exception:
+            # the cache being unavailable should not break the site
+            logger.exception("unable to get from cache")
+            return {}
+
+    def _set_many(self, values: Dict[str, bytes]) -> None:
+        try:
+            self.client.set_many(values, expire=self.expire)
+        except Exception:
+            logger.exception("unable to set in cache")
+
+
+def _name_key(kind: str, name: str) -> str:
+    # memcached keys are limited to 250 bytes and can't contain whitespace, so
+    # names are hashed
+    digest = hashlib.blake2b(name.encode("utf-8"), digest_size=16).hexdigest()
+    return f"csvbase:{kind}-uuid:{digest}"
+
+
+def _value_key(kind: str, uuid: UUID) -> str:
+    return f"csvbase:{kind}:{uuid.hex}"
+
+
+def _generation_key(kind: str, uuid: UUID) -> str:
+    return f"csvbase:{kind}-generation:{uuid.hex}"
+
+
+def _new_token() -> bytes:
+    return uuid4().hex.encode("utf-8")
+
+
+def _dumps(token: bytes, json_dict: Dict[str, Any]) -> bytes:
+    return token + b" " + json.dumps(json_dict).encode("utf-8")
+
+
+def _loads(as_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    token, _, json_bytes = as_bytes.partition(b" ")
+    return token, json.loads(json_bytes)
+
+
+def _table_to_json(table: Table) -> Dict[str, Any]:
+    return {
+        "table_uuid": str(table.table_uuid),
+        "username": table.username,
+        "table_name": table.table_name,
+        "is_public": table.is_public,
+        "caption": table.caption,
+        "columns": [[c.name, c.type_.value] for c in table.columns],
+        "created": table.created.isoformat(),
+        "row_count": [table.row_count.exact, table.row_count.approx],
+        "last_changed": table.last_changed.isoformat(),
+        "version": table.version,
+        "latest_version": table.latest_version,
+        "licence": table.licence.spdx_id if table.licence is not None else None,
+        "key": [c.name for c in table.key] if table.key is not None else None,
+        "upstream": (
+            table.upstream.to_json_dict() if table.upstream is not None else None
+        ),
+        "indexed_columns": [c.name for c in table.indexed_columns],
+    }
+
+
+def _table_from_json(json_dict: Dict[str, Any]) -> Table:
+    columns = [Column(name, ColumnType(type_)) for name, type_ in json_dict["columns"]]
+    key_names = json_dict["key"]
+    return Table(
+        table_uuid=UUID(json_dict["table_uuid"]),
+        username=json_dict["username"],
+        table_name=json_dict["table_name"],
+        is_public=json_dict["is_public"],
+        caption=json_dict["caption"],
+        columns=columns,
+        created=datetime.fromisoformat(json_dict["created"]),
+        row_count=RowCount(*json_dict["row_count"]),
+        last_changed=datetime.fromisoformat(json_dict["last_changed"]),
+        version=json_dict["version"],
+        latest_version=json_dict["latest_version"],
+        licence=(
+            Licence.from_spdx_id(json_dict["licence"])
+            if json_dict["licence"] is not None
+            else None
+        ),
+        key=(
+            [c for c in columns if c.name in key_names]
+            if key_names is not None
+            else None
+        ),
+        upstream=(
+            GitUpstream.from_json_dict(json_dict["upstream"])
+            if json_dict["upstream"] is not None
+            else None
+        ),
+        indexed_columns=[c for c in columns if c.name in json_dict["indexed_columns"]],
+    )
+
+
+def _user_to_json(user: User) -> Dict[str, Any]:
+    return {
+        "user_uuid": str(user.user_uuid),
+        "username": user.username,
+        "email": user.email,
+        "registered": user.registered.isoformat(),
+        "settings": user.settings.to_json(),
+    }
+
+
+def _user_from_json(json_dict: Dict[str, Any], api_key: bytes) -> User:
+    return User(
+        user_uuid=UUID(json_dict["user_uuid"]),
+        username=json_dict["username"],
+        email=json_dict["email"],
+        registered=datetime.fromisoformat(json_dict["registered"]),
+        api_key=api_key,
+        settings=UserSettings.from_json(json_dict["settings"]),
+    )
+
+
+__metadata_cache__: Optional[MetadataCache] = None
+
+
+def get_metadata_cache() -> MetadataCache:
+    """Returns the metadata cache, which is backed by memcached if it is
+    configured."""
+    global __metadata_cache__
+    if __metadata_cache__ is None:
+        memcache_server = get_config().memcache_server
+        if memcache_server is not None:
+            # pymemcache is only needed when memcached is in use
+            from pymemcache.client.base import PooledClient
+
+            timeout = MEMCACHE_TIMEOUT.total_seconds()
+            client = PooledClient(
+                memcache_server, connect_timeout=timeout, timeout=timeout
+            )
+            __metadata_cache__ = MetadataCache(client, MEMCACHE_EXPIRY)
+            logger.info("using memcached (%s) for metadata cache", memcache_server)
+        else:
+            __metadata_cache__ = MetadataCache(LocalClient(), LOCAL_CACHE_TTL)
+    return __metadata_cache__
+
+
+def invalidate_table(sesh: Session, table_uuid: UUID) -> None:
+    """Drop any cached metadata for the given table.
+
+    This is done immediately and then again when the current transaction ends.
+    The second time is necessary because until the transaction is committed
+    other requests can read (and cache) the previous state.  It also covers
+    rollbacks.
+
+    """
+    _invalidate(sesh, TABLE, table_uuid)
+
+
+def invalidate_user(sesh: Session, user_uuid: UUID) -> None:
+    """Drop any cached metadata for the given user (see invalidate_table)."""
+    _invalidate(sesh, USER, user_uuid)
+
+
+def _invalidate(sesh: Session, kind: str, uuid: UUID) -> None:
+    get_metadata_cache().invalidate(kind, uuid)
+    pending: Set[Tuple[str, UUID]] = sesh.info.setdefault(
+        _PENDING_INVALIDATIONS_KEY, set()
+    )
+    pending.add((kind, uuid))
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _invalidate_pending(session: Session, transaction: SessionTransaction) -> None:
+    # only care about the outermost transaction, savepoints don't matter
+    if transaction.parent is not None:
+        return
+    pending: Set[Tuple[str, UUID]] = session.info.pop(_PENDING_INVALIDATIONS_KEY, set())
+    if len(pending) > 0:
+        metadata_cache = get_metadata_cache()
+        for kind, uuid in pending:
+            metadata_cache.invalidate(kind, uuid)
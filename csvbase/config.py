@@ -25,6 +25,8 @@ class Config:
     stripe_api_key: Optional[str]
     stripe_price_id: Optional[str]
     enable_datadog: bool
+    # if set, nginx serves the repcache (at /repcache/).  Compressed variants
+    # end in .gz or .zst and nginx should set their Content-Encoding
     x_accel_redirect: bool
     smtp_host: Optional[str]
     memcache_server: Optional[str]
@@ -35,6 +37,29 @@ class Config:
 
     celery_broker_url: Optional[str] = "redis://localhost/3"
 
+    # large csv uploads are parsed in chunks, across this many processes
+    csv_parse_workers: int = 1
+    csv_parse_chunk_size: int = 64 * 1024 * 1024
+
+    # work_mem for upserts (eg: "256MB"), which join large staging tables
+    upsert_work_mem: Optional[str] = None
+
+    # if set, single-row writes don't bump last_changed (or the version the
+    # repcache goes by) themselves - instead they are brought up to date at
+    # most this often (in seconds), in the background
+    table_changed_interval: Optional[int] = None
+
+    # if set, the least recently used representations of tables (see
+    # csvbase.repcache) are evicted to keep them under this many bytes
+    repcache_max_bytes: Optional[int] = None
+
+    # where the repcache and temp uploads are kept: "local" (the cache dir,
+    # which needs Linux) or "s3" (any S3-compatible store, credentials are
+    # found the usual boto3 way)
+    object_store: str = "local"
+    s3_bucket: Optional[str] = None
+    s3_endpoint_url: Optional[str] = None
+
 
 __config__: Optional[Config] = None
 
@@ -66,6 +91,14 @@ def load_config(config_file: Path) -> Config:
         turnstile_secret_key=as_dict.get("turnstile_secret_key"),
         smtp_host=as_dict.get("smtp_host"),
         memcache_server=as_dict.get("memcache_server"),
+        csv_parse_workers=as_dict.get("csv_parse_workers", 1),
+        csv_parse_chunk_size=as_dict.get("csv_parse_chunk_size", 64 * 1024 * 1024),
+        upsert_work_mem=as_dict.get("upsert_work_mem"),
+        table_changed_interval=as_dict.get("table_changed_interval"),
+        repcache_max_bytes=as_dict.get("repcache_max_bytes"),
+        object_store=as_dict.get("object_store", "local"),
+        s3_bucket=as_dict.get("s3_bucket"),
+        s3_endpoint_url=as_dict.get("s3_endpoint_url"),
     )
 
 
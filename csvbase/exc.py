@@ -172,5 +172,9 @@ class MissingTempFile(CSVBaseException):
     pass
 
 
+class RepWriteInProgress(CSVBaseException):
+    """Another process is already writing that representation"""
+
+
 class ReadOnlyException(CSVBaseException):
     pass
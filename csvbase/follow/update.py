@@ -24,12 +24,12 @@ def update_external_table(
     logger.info("updating %s/%s", table.username, table.table_name)
     str_buf = streams.byte_buf_to_str_buf(upstream_file.filelike)
     dialect, csv_columns = streams.peek_csv(str_buf, table.columns)
-    rows = table_io.csv_to_rows(str_buf, csv_columns, dialect)
+    record_batches = table_io.csv_to_record_batches(str_buf, csv_columns, dialect)
     key_column_names = svc.get_key(sesh, table.table_uuid)
     key: Sequence[Column]
     if len(key_column_names) > 0:
         key = [c for c in table.user_columns() if c.name in key_column_names]
     else:
         key = (ROW_ID_COLUMN,)
-    backend.upsert_table_data(table, csv_columns, rows, key=key)
+    backend.upsert_record_batches(table, csv_columns, record_batches, key=key)
     svc.set_version(sesh, table.table_uuid, upstream_file.version)
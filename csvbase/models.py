@@ -11,7 +11,7 @@ from sqlalchemy import (
 )
 from sqlalchemy.orm import mapped_column, DeclarativeBase, relationship
 from sqlalchemy.dialects.postgresql import BYTEA, UUID as _PGUUID, JSONB
-from sqlalchemy.schema import CheckConstraint, Identity, MetaData
+from sqlalchemy.schema import CheckConstraint, Identity, MetaData, Sequence
 
 naming_convention = {
     "ix": "ix_%(column_0_label)s",
@@ -207,6 +207,77 @@ class UniqueColumn(Base):
     column_name = mapped_column(satypes.String, nullable=False, primary_key=True)
 
 
+class ColumnIndex(Base):
+    # Columns that have been indexed (for sorting and filtering), so that the
+    # indexes can be rebuilt when a table is replaced
+    __tablename__ = "column_indexes"
+    __table_args__ = (METADATA_SCHEMA_TABLE_ARG,)
+
+    table_uuid = mapped_column(
+        PGUUID, ForeignKey("metadata.tables.table_uuid"), primary_key=True
+    )
+    column_name = mapped_column(satypes.String, nullable=False, primary_key=True)
+
+
+class ColumnUse(Base):
+    # How many times a column of a large table has been sorted or filtered by,
+    # shared between processes so that the index gets built once (see
+    # PGUserdataAdapter.note_column_use).  Counted outside of any request's
+    # transaction, which is why there is no foreign key.
+    __tablename__ = "column_uses"
+    __table_args__ = (METADATA_SCHEMA_TABLE_ARG,)
+
+    table_uuid = mapped_column(PGUUID, primary_key=True)
+    column_name = mapped_column(satypes.String, nullable=False, primary_key=True)
+    uses = mapped_column(satypes.BigInteger, nullable=False)
+
+
+table_versions = Sequence("table_versions", metadata=metadata, schema="metadata")
+
+
+class TableRowCount(Base):
+    # Kept up to date from the table_changes log (see TableChange).  There is
+    # no foreign key because the shadow tables that are built to replace
+    # others are counted too.
+    #
+    # Every change to a table (including to its metadata, see
+    # svc.mark_table_changed) gives it a new version.  The version here is the
+    # one the repcache goes by, so it only moves when changes are folded in.
+    # data_changed is when the userdata last changed, which last_changed on
+    # metadata.tables can lag behind (see svc.mark_table_data_changed).
+    __tablename__ = "row_counts"
+    __table_args__ = (METADATA_SCHEMA_TABLE_ARG,)
+
+    table_uuid = mapped_column(PGUUID, primary_key=True)
+    row_count = mapped_column(satypes.BigInteger, nullable=False)
+    version = mapped_column(
+        satypes.BigInteger, server_default=table_versions.next_value(), nullable=False
+    )
+    data_changed = mapped_column(
+        satypes.TIMESTAMP(timezone=True), nullable=False, server_default=func.now()
+    )
+
+
+class TableChange(Base):
+    # Written by triggers on the userdata tables (see
+    # PGUserdataAdapter.create_table): one row per statement that changes
+    # any rows.  Appending here, rather than updating row_counts, means that
+    # concurrent writers to the same table don't queue up on a single row.
+    # Changes are folded into row_counts later (see
+    # PGUserdataAdapter.fold_changes).
+    __tablename__ = "table_changes"
+    __table_args__ = (METADATA_SCHEMA_TABLE_ARG,)
+
+    version = mapped_column(
+        satypes.BigInteger, server_default=table_versions.next_value(), primary_key=True
+    )
+    table_uuid = mapped_column(PGUUID, nullable=False, index=True)
+    row_count_change = mapped_column(satypes.BigInteger, nullable=False)
+    changed = mapped_column(
+        satypes.TIMESTAMP(timezone=True), nullable=False, server_default=func.now()
+    )
+
+
 class GitUpstream(Base):
     # FIXME: table should be called "git_upstreams"
     __tablename__ = "github_follows"
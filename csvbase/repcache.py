@@ -1,18 +1,35 @@
 """A cache for generated representations of tables."""
 
 from logging import getLogger
-import os
-from pathlib import Path
-from typing import IO, Generator, Dict
+from typing import IO, Generator, Dict, List, Optional, cast
 from uuid import UUID
-from datetime import datetime
 import contextlib
 
+import pyarrow as pa
+
 from csvbase.value_objs import ContentType
-from csvbase import streams
+from csvbase.storage import get_object_store
+from csvbase.streams import KeepOpen, TeeWriter
 
 logger = getLogger(__name__)
 
+REPCACHE_PREFIX = "repcache/"
+
+# precompressed variants of these are kept as well, as they compress well (and
+# the other content types are already compressed)
+COMPRESSIBLE_CONTENT_TYPES = frozenset([ContentType.CSV, ContentType.JSON_LINES])
+
+# representations of these are written from start to end, so can be read
+# while still being written.  Others (eg: xlsx, which is a zip file) seek back
+# to rewrite what they have already written.
+APPEND_ONLY_CONTENT_TYPES = frozenset(
+    [ContentType.CSV, ContentType.JSON_LINES, ContentType.PARQUET]
+)
+
+# content codings (which are also pyarrow codec names) of the precompressed
+# variants, in order of preference, with their file extensions
+ENCODINGS: Dict[str, str] = {"zstd": "zst", "gzip": "gz"}
+
 
 class RepCache:
     """A cache for representations of tables.
@@ -20,123 +37,152 @@ class RepCache:
     Reusing a previously generated representation is around 100 times faster
     than to regenerate so the speed impact of this is quite meaningful.
 
-    This is currently implemented with files, but that is completely
-    encapsulated so it should be easier to port to S3 later on.
+    Representations are kept in the object store (see csvbase.storage) under
+    repcache/<table_uuid>/<version>.<file extension>.  Compressible ones also
+    have precompressed variants, written at the same time, with a further
+    extension for the encoding (eg: .csv.gz).
 
     """
 
     def __init__(
-        self, table_uuid: UUID, content_type: ContentType, last_changed: datetime
+        self,
+        table_uuid: UUID,
+        content_type: ContentType,
+        version: int,
+        encoding: Optional[str] = None,
     ) -> None:
         self.table_uuid = table_uuid
         self.content_type = content_type
-        self.last_changed = last_changed
+        # representations are keyed by the table's version (rather than its
+        # last_changed, which can lag behind changes to the rows)
+        self.version = version
+        # the content coding, if this is a precompressed variant
+        self.encoding = encoding
+
+    def variants(self) -> List["RepCache"]:
+        """Return the precompressed variants of this representation."""
+        if self.encoding is None and self.content_type in COMPRESSIBLE_CONTENT_TYPES:
+            return [
+                RepCache(self.table_uuid, self.content_type, self.version, encoding)
+                for encoding in ENCODINGS
+            ]
+        else:
+            return []
 
     def write_in_progress(self) -> bool:
         """Returns true if this rep is currently being written."""
-        return self._temp_path().exists()
+        return get_object_store().write_in_progress(self._key())
 
     @contextlib.contextmanager
     def open(
         self,
         mode: str = "rb",
     ) -> Generator[IO[bytes], None, None]:
+        """Open the representation.
+
+        When writing, raises RepWriteInProgress if some other process is
+        already writing it.  With the local object store, reading a
+        representation that is still being written follows the write (or,
+        for formats that aren't written start to end, waits for it).
+
+        """
+        store = get_object_store()
         if "w" in mode:
-            try:
-                with self._temp_path().open(mode) as temp_file:
-                    # make sure the file exists on disk:
-                    temp_file.flush()
-                    yield temp_file
-                    # to avoid corrupting the cache with partway failures, the
-                    # tempfile is written first and hardlinked into the final
-                    # position
-                    os.link(
-                        temp_file.name,
-                        self._rep_path(),
-                    )
-            finally:
-                # try to ensure that the temp file is unlinked in the event of a crash
-                self._temp_path().unlink(missing_ok=True)
+            with store.open_write(self._key()) as rep_file:
+                # the variants are written in the same pass, and stored first,
+                # so that they exist once this does
+                with contextlib.ExitStack() as stack:
+                    compressors = [
+                        stack.enter_context(variant._open_compressor())
+                        for variant in self.variants()
+                    ]
+                    if len(compressors) > 0:
+                        yield cast(IO[bytes], TeeWriter(rep_file, compressors))
+                    else:
+                        yield rep_file
 
             logger.info(
                 "wrote new representation of %s (%s)",
                 self.table_uuid,
                 self.content_type,
             )
-            expected_dtstr = _safe_dtstr(self.last_changed)
-            for rep_path in _rep_dir(self.table_uuid).iterdir():
-                if rep_path.stem != expected_dtstr:
-                    rep_path.unlink()
+            expected_prefix = f"{_table_prefix(self.table_uuid)}{self.version}."
+            for key in store.sizes(_table_prefix(self.table_uuid)):
+                if not key.startswith(expected_prefix):
+                    store.delete(key)
                     logger.info(
-                        "deleted old representation of %s: %s",
-                        self.table_uuid,
-                        rep_path.name,
+                        "deleted old representation of %s: %s", self.table_uuid, key
                     )
 
         else:
             # it's a bit weird that we leave this open, but that is necessary
             # to stream responses at the web level
-            yield self._rep_path().open(mode=mode)
+            yield store.open_read(
+                self._key(), follow=self.content_type in APPEND_ONLY_CONTENT_TYPES
+            )
+
+    @contextlib.contextmanager
+    def _open_compressor(self) -> Generator[IO[bytes], None, None]:
+        with get_object_store().open_write(self._key()) as variant_file:
+            with pa.CompressedOutputStream(
+                pa.PythonFile(KeepOpen(variant_file), mode="w"), self.encoding
+            ) as compressor:
+                yield compressor
 
     def exists(self) -> bool:
-        rep_path = self._rep_path()
-        return rep_path.exists()
+        return get_object_store().exists(self._key())
 
     @staticmethod
-    def sizes(table_uuid: UUID, last_changed: datetime) -> Dict[ContentType, int]:
+    def sizes(table_uuid: UUID, version: int) -> Dict[ContentType, int]:
         """Return the sizes of the various representations held."""
 
         rv = {}
-        expected_dtstr = _safe_dtstr(last_changed)
-        for rep_path in _rep_dir(table_uuid).iterdir():
-            if rep_path.stem == expected_dtstr:
-                content_type = ContentType.from_file_extension(rep_path.suffix[1:])
+        expected_prefix = f"{_table_prefix(table_uuid)}{version}."
+        for key, size in get_object_store().sizes(_table_prefix(table_uuid)).items():
+            if key.startswith(expected_prefix):
+                content_type = ContentType.from_file_extension(
+                    key[len(expected_prefix) :]
+                )
                 if content_type is not None:
-                    size = rep_path.stat().st_size
                     rv[content_type] = size
         return rv
 
-    def path(self) -> str:
-        """Returns the path of a specific representation's file on disk,
-        relative to the repcache root directory.
-
-        This is used for X-Accel-Redirect.
+    @staticmethod
+    def evict(max_bytes: int) -> int:
+        """Delete the least recently used representations until the repcache
+        takes up no more than max_bytes.  Returns the number of bytes freed.
 
         """
-        rep_path = self._rep_path()
-        return str(rep_path.relative_to(_repcache_dir()))
-
-    def _rep_path(self) -> Path:
-        safe_dtstr = _safe_dtstr(self.last_changed)
-        rep_dir = _rep_dir(self.table_uuid)
-        return rep_dir / f"{safe_dtstr}.{self.content_type.file_extension()}"
-
-    def _temp_path(self) -> Path:
-        safe_dtstr = _safe_dtstr(self.last_changed)
-        rep_dir = _rep_dir(self.table_uuid)
-        return rep_dir / f"{safe_dtstr}.{self.content_type.file_extension()}.tmp"
-
+        return get_object_store().evict(REPCACHE_PREFIX, max_bytes)
 
-def _safe_dtstr(dt: datetime) -> str:
-    # cut out colons, which cause problems on ntfs
-    return dt.isoformat().replace(":", "_")
-
-
-def _rep_dir(table_uuid: UUID) -> Path:
-    rep_dir = _repcache_dir() / str(table_uuid)
-    if not rep_dir.exists():
-        rep_dir.mkdir()
-    return rep_dir
-
-
-_REPCACHE_DIR_EXISTS = False
+    def path(self) -> str:
+        """Returns the path of a specific representation's file, relative to
+        the repcache root directory.
 
+        This is used for X-Accel-Redirect (and so only with the local object
+        store).
 
-def _repcache_dir() -> Path:
-    """Returns the "stage dir" which is used for keeping generated files."""
-    global _REPCACHE_DIR_EXISTS
-    stage_dir = streams.cache_dir() / "repcache"
-    if not _REPCACHE_DIR_EXISTS:
-        stage_dir.mkdir(exist_ok=True)
-        _REPCACHE_DIR_EXISTS = True
-    return stage_dir
+        """
+        # checking marks it as used, so it isn't evicted before it is served
+        get_object_store().exists(self._key())
+        return self._key()[len(REPCACHE_PREFIX) :]
+
+    def url(self, filename: str) -> Optional[str]:
+        """Returns a url to redirect clients to in order to download the
+        representation, if the object store supports that."""
+        return get_object_store().presigned_url(
+            self._key(), filename, self.content_type.value, self.encoding
+        )
+
+    def _key(self) -> str:
+        key = (
+            f"{_table_prefix(self.table_uuid)}{self.version}."
+            f"{self.content_type.file_extension()}"
+        )
+        if self.encoding is not None:
+            key += f".{ENCODINGS[self.encoding]}"
+        return key
+
+
+def _table_prefix(table_uuid: UUID) -> str:
+    return f"{REPCACHE_PREFIX}{table_uuid}/"
@@ -0,0 +1,40 @@
+"""Where files (the repcache, temp uploads) are kept.
+
+By default that is the local filesystem, but to allow running on more than
+one machine it can instead be an S3-compatible object store.
+
+"""
+
+from logging import getLogger
+from typing import Any, List, Optional
+
+from ..config import get_config
+from ..streams import cache_dir
+from .core import ObjectStore
+from .local import LocalObjectStore
+
+logger = getLogger(__name__)
+
+__all__: List[Any] = [ObjectStore, LocalObjectStore, "get_object_store"]
+
+__object_store__: Optional[ObjectStore] = None
+
+
+def get_object_store() -> ObjectStore:
+    """Returns the object store, which is on S3 if that is configured."""
+    global __object_store__
+    if __object_store__ is None:
+        config = get_config()
+        if config.object_store == "s3":
+            # boto3 is only needed when S3 is in use
+            import boto3
+            from .s3 import S3ObjectStore
+
+            if config.s3_bucket is None:
+                raise RuntimeError("s3_bucket must be set to use s3")
+            client = boto3.client("s3", endpoint_url=config.s3_endpoint_url)
+            __object_store__ = S3ObjectStore(client, config.s3_bucket)
+            logger.info("using s3 (bucket: %s) for object store", config.s3_bucket)
+        else:
+            __object_store__ = LocalObjectStore(cache_dir())
+    return __object_store__
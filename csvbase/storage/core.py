@@ -0,0 +1,56 @@
+from typing import IO, ContextManager, Dict, Optional, Protocol
+
+
+class ObjectStore(Protocol):
+    """Somewhere to keep files (eg: the repcache and temp uploads).
+
+    Objects are named by keys, which are "/"-separated, path-like strings.
+
+    """
+
+    def open_write(self, key: str) -> ContextManager[IO[bytes]]:
+        """Open an object for writing.  The object only appears under the key
+        once the write has finished successfully.
+
+        Raises RepWriteInProgress if the store can tell that some other
+        process is already writing it.
+
+        """
+        ...
+
+    def write_in_progress(self, key: str) -> bool: ...
+
+    def open_read(self, key: str, follow: bool = True) -> IO[bytes]:
+        """Open an object for reading.  Raises FileNotFoundError if it doesn't
+        exist.
+
+        If the object is still being written (and the store can tell), follow
+        says whether to read it as it is written, which is only safe for
+        objects that are written from start to end without seeking back.
+        Otherwise this waits for the write to finish.
+
+        """
+        ...
+
+    def exists(self, key: str) -> bool: ...
+
+    def sizes(self, prefix: str) -> Dict[str, int]:
+        """Return the sizes of all the objects whose keys begin with the given
+        prefix (which should end with "/")."""
+        ...
+
+    def delete(self, key: str) -> None: ...
+
+    def evict(self, prefix: str, max_bytes: int) -> int:
+        """Delete objects under the prefix, least recently used first, until
+        they take up no more than max_bytes.  Returns the number of bytes
+        freed."""
+        ...
+
+    def presigned_url(
+        self, key: str, filename: str, mimetype: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        """Return a short-lived url which clients can be redirected to in order
+        to download the object, if the store supports that.  The encoding is
+        the object's Content-Encoding, if any."""
+        ...
@@ -0,0 +1,336 @@
+"""An object store on the local filesystem."""
+
+from logging import getLogger
+import io
+import os
+import errno
+import fcntl
+import struct
+import time
+import contextlib
+from functools import partial
+from datetime import timedelta
+from pathlib import Path
+from typing import IO, Callable, Dict, Generator, List, Optional, Tuple, cast
+
+from .. import exc
+
+logger = getLogger(__name__)
+
+# objects used more recently than this are never evicted, so that they're not
+# deleted out from under requests that are about to open them
+EVICTION_GRACE = timedelta(minutes=5)
+
+# how long readers following a write wait before checking for more
+FOLLOW_INTERVAL = timedelta(milliseconds=50)
+
+# readers give up on a write that has made no progress for this long (eg: its
+# writer is stuck), raising RepWriteInProgress
+FOLLOW_TIMEOUT = timedelta(minutes=2)
+
+
+class LocalObjectStore:
+    """Keeps objects as files under a root directory.
+
+    The mtime of each file is when it was last used, which is what eviction
+    goes by.
+
+    Each object is only written by one process at a time: the writer holds a
+    lock on a lock file next to it while it writes to a temp file.  Anyone
+    else who wants the object in the meantime can read it as it is written.
+    Readers only ever query the lock (so can't get in a writer's way), which
+    needs open file description locks, and so Linux.
+
+    """
+
+    def __init__(self, root: Path) -> None:
+        if not hasattr(fcntl, "F_OFD_SETLK"):
+            raise RuntimeError(
+                "the local object store needs open file description locks,"
+                " which are only available on Linux (use the s3 object store"
+                " elsewhere)"
+            )
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def _temp_path(self, key: str) -> Path:
+        return self.root / f"{key}.tmp"
+
+    def _lock_path(self, key: str) -> Path:
+        return self.root / f"{key}.lock"
+
+    @contextlib.contextmanager
+    def open_write(self, key: str) -> Generator[IO[bytes], None, None]:
+        path = self.path(key)
+        temp_path = self._temp_path(key)
+        lock_path = self._lock_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lock_fd = self._take_write_lock(lock_path)
+        try:
+            # anything already here was left behind by a writer that crashed
+            temp_path.unlink(missing_ok=True)
+            with temp_path.open("wb") as temp_file:
+                try:
+                    yield temp_file
+                    temp_file.flush()
+                    # to avoid corrupting the store with partway failures, the
+                    # temp file is written first and renamed into the final
+                    # position (while still locked, so anyone following the
+                    # write finds it there)
+                    os.rename(temp_path, path)
+                except BaseException:
+                    temp_path.unlink(missing_ok=True)
+                    raise
+        finally:
+            # unlinked before it is unlocked, see _take_write_lock
+            lock_path.unlink(missing_ok=True)
+            os.close(lock_fd)
+
+    def _take_write_lock(self, lock_path: Path) -> int:
+        """Create the lock file and take the write lock on it, returning the
+        file descriptor."""
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            if not _lock(fd):
+                os.close(fd)
+                raise exc.RepWriteInProgress()
+            try:
+                is_current = os.stat(lock_path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if is_current:
+                return fd
+            # otherwise the previous writer unlinked it after this process
+            # opened it but before it was locked, so start again
+            os.close(fd)
+
+    def write_in_progress(self, key: str) -> bool:
+        try:
+            lock_fd = os.open(self._lock_path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            return _is_locked(lock_fd)
+        finally:
+            os.close(lock_fd)
+
+    def open_read(self, key: str, follow: bool = True) -> IO[bytes]:
+        """Open an object for reading.
+
+        If it's still being written and follow is true, reads block until more
+        has been written (or the write finishes).  Otherwise, this waits for
+        the write to finish.
+
+        Either way, if the write makes no progress for FOLLOW_TIMEOUT,
+        RepWriteInProgress is raised.
+
+        """
+        path = self.path(key)
+        temp_path = self._temp_path(key)
+        last_size: Optional[int] = None
+        stalled_since = time.monotonic()
+        while True:
+            try:
+                obj_file = path.open("rb")
+            except FileNotFoundError:
+                pass
+            else:
+                self._mark_used(path)
+                return obj_file
+
+            if not self.write_in_progress(key):
+                # perhaps the write just finished
+                return path.open("rb")
+            elif follow:
+                try:
+                    temp_file = temp_path.open("rb")
+                except FileNotFoundError:
+                    # the writer has only just started (or finished)
+                    pass
+                else:
+                    return cast(
+                        IO[bytes],
+                        io.BufferedReader(
+                            _Follower(
+                                temp_file, path, partial(self.write_in_progress, key)
+                            )
+                        ),
+                    )
+
+            try:
+                size: Optional[int] = temp_path.stat().st_size
+            except FileNotFoundError:
+                size = None
+            if size != last_size:
+                last_size = size
+                stalled_since = time.monotonic()
+            elif time.monotonic() - stalled_since > FOLLOW_TIMEOUT.total_seconds():
+                logger.warning("gave up waiting for write of %s", key)
+                raise exc.RepWriteInProgress()
+            time.sleep(FOLLOW_INTERVAL.total_seconds())
+
+    def exists(self, key: str) -> bool:
+        """Returns true if the object exists, marking it as used if so."""
+        return self._mark_used(self.path(key))
+
+    def _mark_used(self, path: Path) -> bool:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            # a shared lock, so this can't happen partway through an eviction
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            os.utime(fd)
+        finally:
+            os.close(fd)
+        return True
+
+    def sizes(self, prefix: str) -> Dict[str, int]:
+        return {key: stat.st_size for key, stat in self._stat_objects(prefix).items()}
+
+    def _stat_objects(self, prefix: str) -> Dict[str, os.stat_result]:
+        rv: Dict[str, os.stat_result] = {}
+        prefix_dir = self.path(prefix)
+        if not prefix_dir.exists():
+            return rv
+        for path in prefix_dir.rglob("*"):
+            # leave in-progress writes alone
+            if path.suffix in (".tmp", ".lock"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                rv[path.relative_to(self.root).as_posix()] = stat
+        return rv
+
+    def delete(self, key: str) -> None:
+        self.path(key).unlink(missing_ok=True)
+
+    def evict(self, prefix: str, max_bytes: int) -> int:
+        """Delete the least recently used objects under the prefix.
+
+        Nothing used within the EVICTION_GRACE is evicted, even if that means
+        going over budget.  Objects that are already open (eg: being streamed
+        to a client) can still be read to the end once deleted.
+
+        """
+        objs: List[Tuple[float, int, str]] = [
+            (stat.st_mtime, stat.st_size, key)
+            for key, stat in self._stat_objects(prefix).items()
+        ]
+
+        total_bytes = sum(size for _, size, _ in objs)
+        freed = 0
+        cutoff = time.time() - EVICTION_GRACE.total_seconds()
+        for _, _, key in sorted(objs):
+            if total_bytes - freed <= max_bytes:
+                break
+            path = self.path(key)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # being marked as used right now
+                    continue
+                # check again, now that it can't be marked as used meanwhile
+                stat = os.fstat(fd)
+                if stat.st_mtime > cutoff:
+                    continue
+                path.unlink(missing_ok=True)
+            finally:
+                os.close(fd)
+            freed += stat.st_size
+            logger.info("evicted %s", key)
+        logger.info(
+            "evicted %d bytes from %s, %d remain", freed, prefix, total_bytes - freed
+        )
+        return freed
+
+    def presigned_url(
+        self, key: str, filename: str, mimetype: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        return None
+
+
+class _Follower(io.RawIOBase):
+    """Reads an object that is still being written, waiting for more each time
+    it catches up with the writer."""
+
+    def __init__(
+        self,
+        temp_file: io.BufferedReader,
+        path: Path,
+        write_in_progress: Callable[[], bool],
+    ) -> None:
+        self.temp_file = temp_file
+        self.path = path
+        self.write_in_progress = write_in_progress
+        self.write_finished = False
+        self.stalled_since = time.monotonic()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            bytes_read = self.temp_file.readinto(buffer)
+            if bytes_read:
+                self.stalled_since = time.monotonic()
+                return bytes_read
+            elif self.write_finished:
+                return bytes_read
+            elif not self.write_in_progress():
+                # everything the writer wrote is now readable, but check that
+                # it finished rather than failed
+                try:
+                    inode = os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    inode = None
+                if inode != os.fstat(self.temp_file.fileno()).st_ino:
+                    raise RuntimeError(f"write of {self.path} failed")
+                self.write_finished = True
+            elif time.monotonic() - self.stalled_since > FOLLOW_TIMEOUT.total_seconds():
+                logger.warning("gave up following write of %s", self.path)
+                raise exc.RepWriteInProgress()
+            else:
+                time.sleep(FOLLOW_INTERVAL.total_seconds())
+
+    def close(self) -> None:
+        self.temp_file.close()
+        super().close()
+
+
+# struct flock, for open file description locks
+_FLOCK_FORMAT = "@hhqqi4x"
+
+
+def _lock(fd: int) -> bool:
+    """Take the write lock on the given file, returning false if someone else
+    holds it."""
+    flock = struct.pack(_FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+    try:
+        fcntl.fcntl(fd, fcntl.F_OFD_SETLK, flock)
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    return True
+
+
+def _is_locked(fd: int) -> bool:
+    """Returns true if a writer holds the lock on the given file.  This only
+    queries the lock, without taking it."""
+    flock = struct.pack(_FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+    lock_type = struct.unpack(_FLOCK_FORMAT, fcntl.fcntl(fd, fcntl.F_OFD_GETLK, flock))[
+        0
+    ]
+    return lock_type != fcntl.F_UNLCK
@@ -0,0 +1,170 @@
+"""An object store on S3 (or anything compatible with it, eg: MinIO)."""
+
+from logging import getLogger
+import io
+import contextlib
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import IO, Any, Dict, Generator, List, Optional, Tuple, cast
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+logger = getLogger(__name__)
+
+# S3 requires every part of a multipart upload but the last to be at least 5MiB
+PART_SIZE = 8 * 1024 * 1024
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE
+)
+
+# objects are read in ranges of (up to) this size
+READ_RANGE_SIZE = 8 * 1024 * 1024
+
+PRESIGNED_URL_EXPIRY = timedelta(minutes=5)
+
+# objects written more recently than this are never evicted (see
+# LocalObjectStore)
+EVICTION_GRACE = timedelta(minutes=5)
+
+
+class S3ObjectStore:
+    """Keeps objects in an S3 bucket.
+
+    Big objects are uploaded in parts and reads are done in ranges, so
+    neither has to hold a whole object in memory.  Unlike with the local
+    store, concurrent writes of the same object are not detected (the last to
+    finish wins) and reads can't follow a write in progress.
+
+    """
+
+    def __init__(self, client: Any, bucket: str) -> None:
+        self.client = client
+        self.bucket = bucket
+
+    @contextlib.contextmanager
+    def open_write(self, key: str) -> Generator[IO[bytes], None, None]:
+        # the writers of representations need to seek (eg: zip files, for
+        # xlsx) so objects are spooled to disk, then uploaded in parts
+        with tempfile.TemporaryFile() as spool:
+            yield spool
+            spool.seek(0)
+            self.client.upload_fileobj(spool, self.bucket, key, Config=TRANSFER_CONFIG)
+
+    def write_in_progress(self, key: str) -> bool:
+        return False
+
+    def open_read(self, key: str, follow: bool = True) -> IO[bytes]:
+        size = self._head(key)
+        if size is None:
+            raise FileNotFoundError(key)
+        reader = _RangedReader(self.client, self.bucket, key, size)
+        return cast(IO[bytes], io.BufferedReader(reader, READ_RANGE_SIZE))
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def _head(self, key: str) -> Optional[int]:
+        """Return the size of the object, or None if it doesn't exist."""
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return response["ContentLength"]
+
+    def sizes(self, prefix: str) -> Dict[str, int]:
+        return {key: size for key, size, _ in self._list_objects(prefix)}
+
+    def _list_objects(self, prefix: str) -> List[Tuple[str, int, datetime]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        return [
+            (obj["Key"], obj["Size"], obj["LastModified"])
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+            for obj in page.get("Contents", [])
+        ]
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def evict(self, prefix: str, max_bytes: int) -> int:
+        """Delete the least recently written objects under the prefix.
+
+        S3 doesn't record when objects were last read, so this goes by when
+        they were written.
+
+        """
+        objs = sorted(self._list_objects(prefix), key=lambda obj: obj[2])
+        total_bytes = sum(size for _, size, _ in objs)
+        freed = 0
+        cutoff = datetime.now(timezone.utc) - EVICTION_GRACE
+        for key, size, last_modified in objs:
+            if total_bytes - freed <= max_bytes or last_modified > cutoff:
+                break
+            self.delete(key)
+            freed += size
+            logger.info("evicted %s", key)
+        logger.info(
+            "evicted %d bytes from %s, %d remain", freed, prefix, total_bytes - freed
+        )
+        return freed
+
+    def presigned_url(
+        self, key: str, filename: str, mimetype: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        params = {
+            "Bucket": self.bucket,
+            "Key": key,
+            "ResponseContentDisposition": f'attachment; filename="{filename}"',
+            "ResponseContentType": mimetype,
+        }
+        if encoding is not None:
+            params["ResponseContentEncoding"] = encoding
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params=params,
+            ExpiresIn=int(PRESIGNED_URL_EXPIRY.total_seconds()),
+        )
+
+
+class _RangedReader(io.RawIOBase):
+    """Reads an object a range at a time."""
+
+    def __init__(self, client: Any, bucket: str, key: str, size: int) -> None:
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        last = min(self.position + len(buffer), self.size) - 1
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={self.position}-{last}"
+        )
+        data = response["Body"].read()
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
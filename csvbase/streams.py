@@ -2,7 +2,20 @@
 
 import os
 from logging import getLogger
-from typing import Union, Tuple, Type, List, Dict, Set, IO, Optional, Sequence
+from typing import (
+    Union,
+    Tuple,
+    Type,
+    List,
+    Dict,
+    Set,
+    IO,
+    Optional,
+    Sequence,
+    FrozenSet,
+    Iterable,
+    cast,
+)
 from pathlib import Path
 import codecs
 import csv
@@ -181,6 +194,201 @@ def peek_csv(
     return dialect, cols
 
 
+class Utf8Reader(io.RawIOBase):
+    """Present a readable str buffer as a readable (utf-8) byte buffer.
+
+    This is for passing text streams to libraries that only read bytes, for
+    example pyarrow.
+
+    """
+
+    def __init__(self, str_buf: UserSubmittedCSVData) -> None:
+        self.str_buf = str_buf
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self.pending) < len(b):
+            chunk = self.str_buf.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            self.pending += chunk.encode("utf-8")
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+class IterableReader(io.RawIOBase):
+    """Present an iterable of byte strings as a readable byte buffer.
+
+    This is for streaming generated data into things that read from files,
+    for example psycopg2's copy_expert.
+
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self.pending) == 0:
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+class TeeWriter(io.BufferedIOBase):
+    """Write to a file and at the same time to other streams (eg: compressors).
+
+    The other streams can only be appended to, so while this can seek (eg: to
+    rewind once done) it can't write anywhere but the end.
+
+    """
+
+    def __init__(self, main: IO[bytes], others: Sequence[IO[bytes]]) -> None:
+        self.main = main
+        self.others = others
+        self.end = main.tell()
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if self.main.tell() != self.end:
+            raise io.UnsupportedOperation("can only write at the end")
+        written = self.main.write(b)
+        for other in self.others:
+            other.write(b)
+        self.end += written
+        return written
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.main.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.main.tell()
+
+    def flush(self) -> None:
+        self.main.flush()
+        for other in self.others:
+            other.flush()
+
+
+class KeepOpen(io.RawIOBase):
+    """Present a writable file such that closing it only flushes it.
+
+    This is for handing files to libraries that close them when finished
+    with, for example pyarrow's compressed streams.
+
+    """
+
+    def __init__(self, file_obj: IO[bytes]) -> None:
+        self.file_obj = file_obj
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        return self.file_obj.write(b)
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.file_obj.flush()
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+
+# encodings in which newlines and quotes are always the same single byte that
+# they are in ascii, so that a byte stream can be split on them without first
+# decoding it
+SPLITTABLE_ENCODINGS: FrozenSet[Encoding] = frozenset(
+    [Encoding.UTF_8, Encoding.ASCII, Encoding.LATIN_1]
+    + [
+        encoding
+        for encoding in Encoding
+        if encoding.value.startswith(("iso8859_", "cp125"))
+    ]
+)
+
+
+def splittable_byte_buf(
+    str_buf: UserSubmittedCSVData,
+) -> Optional[Tuple[IO[bytes], Encoding]]:
+    """If the str buffer is a (rewound) view over a seekable byte buffer, in an
+    encoding that can be split without decoding, return the byte buffer and
+    the encoding."""
+    if not isinstance(str_buf, codecs.StreamReader):
+        return None
+    for encoding in SPLITTABLE_ENCODINGS:
+        if type(str_buf) is codecs.getreader(encoding.value):
+            byte_buf = cast(IO[bytes], str_buf.stream)
+            if byte_buf.seekable() and byte_buf.tell() == 0:
+                return byte_buf, encoding
+    return None
+
+
+def csv_chunk_offsets(
+    byte_buf: IO[bytes], chunk_size: int, quotechar: Optional[str]
+) -> Optional[List[Tuple[int, int]]]:
+    """Divide a csv file into (start, end) byte ranges of roughly chunk_size,
+    each of which ends at the end of a row.
+
+    Rows end at newlines that are not inside quotes, and (with quotes escaped
+    by doubling them, as in RFC 4180) those are the newlines preceded by an
+    even number of quote characters.  If the quotes don't balance the file
+    can't be divided this way and None is returned.
+
+    """
+    quote = quotechar.encode("ascii") if quotechar else None
+    offsets: List[Tuple[int, int]] = []
+    start = 0
+    target = chunk_size
+    block_start = 0
+    quote_count = 0
+    with rewind(byte_buf):
+        while True:
+            block = byte_buf.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            block_end = block_start + len(block)
+            index = 0
+            while target < block_end:
+                newline = block.find(b"\n", max(index, target - block_start))
+                if newline == -1:
+                    break
+                if quote is not None:
+                    quote_count += block.count(quote, index, newline)
+                index = newline + 1
+                if quote_count % 2 == 0:
+                    offsets.append((start, block_start + index))
+                    start = block_start + index
+                    target = start + chunk_size
+            if quote is not None:
+                quote_count += block.count(quote, index)
+            block_start = block_end
+    if quote_count % 2 != 0:
+        return None
+    if start < block_start:
+        offsets.append((start, block_start))
+    return offsets
+
+
 class Seekable(Protocol):
     """A file that support seeking (don't care whether text or binary)."""
 
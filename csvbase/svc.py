@@ -7,6 +7,7 @@ from logging import getLogger
 from typing import Iterable, Optional, Sequence, Tuple, cast, List, Union
 from uuid import UUID, uuid4
 from dataclasses import dataclass
+from functools import partial
 
 import bleach
 from sqlalchemy import (
@@ -31,6 +32,7 @@ from . import exc, models, table_io
 from .userdata import PGUserdataAdapter
 from .value_objs import (
     Column,
+    ColumnType,
     Licence,
     Row,
     Table,
@@ -47,6 +49,8 @@ from .value_objs import (
 from .constants import FAR_FUTURE, MAX_UUID
 from .follow.git import GitSource, get_repo_path
 from .repcache import RepCache
+from .cache import get_metadata_cache, invalidate_table, invalidate_user
+from .config import get_config
 
 logger = getLogger(__name__)
 
@@ -78,8 +82,21 @@ def username_exists_insensitive(sesh: Session, username: str) -> bool:
     ).scalar()
 
 
+def _api_key(sesh: Session, user_uuid: UUID) -> bytes:
+    return (
+        sesh.query(models.APIKey.api_key)
+        .filter(models.APIKey.user_uuid == user_uuid)
+        .scalar()
+    )
+
+
 def user_by_name(sesh: Session, username: str) -> User:
-    # FIXME: This is quite a hot function, needs some caching
+    metadata_cache = get_metadata_cache()
+    cached, generation = metadata_cache.get_user_by_name(
+        username, partial(_api_key, sesh)
+    )
+    if cached is not None:
+        return cached
     rp = (
         sesh.query(
             models.User.user_uuid,
@@ -97,7 +114,7 @@ def user_by_name(sesh: Session, username: str) -> User:
         raise exc.UserDoesNotExistException(username)
     else:
         user_uuid, registered, api_key, email, settings = rp
-        return User(
+        user = User(
             user_uuid=user_uuid,
             username=username,
             registered=registered,
@@ -105,10 +122,17 @@ def user_by_name(sesh: Session, username: str) -> User:
             email=email,
             settings=UserSettings.from_json(settings),
         )
+        metadata_cache.put_user(user, generation)
+        return user
 
 
 def user_by_user_uuid(sesh, user_uuid: UUID) -> User:
-    # FIXME: Again, quite a hot function, needs some caching
+    metadata_cache = get_metadata_cache()
+    cached, generation = metadata_cache.get_user_by_uuid(
+        user_uuid, partial(_api_key, sesh)
+    )
+    if cached is not None:
+        return cached
     rp = (
         sesh.query(
             models.User.username,
@@ -126,7 +150,7 @@ def user_by_user_uuid(sesh, user_uuid: UUID) -> User:
         raise exc.UserDoesNotExistException(str(user_uuid))
     else:
         username, registered, api_key, email, settings = rp
-        return User(
+        user = User(
             user_uuid=user_uuid,
             username=username,
             registered=registered,
@@ -134,9 +158,12 @@ def user_by_user_uuid(sesh, user_uuid: UUID) -> User:
             email=email,
             settings=UserSettings.from_json(settings),
         )
+        metadata_cache.put_user(user, generation)
+        return user
 
 
 def update_user(sesh, new_user: User) -> None:
+    invalidate_user(sesh, new_user.user_uuid)
     current_user = user_by_user_uuid(sesh, new_user.user_uuid)
     sesh.query(models.User).filter(models.User.user_uuid == new_user.user_uuid).update(
         {"settings": new_user.settings.to_json()}
@@ -147,6 +174,7 @@ def update_user(sesh, new_user: User) -> None:
 
 
 def update_user_email(sesh, user: User) -> None:
+    invalidate_user(sesh, user.user_uuid)
     if user.email == "":
         logger.warning("empty string email address")
     # HTML forms submit empty fields as blank strings.
@@ -189,53 +217,142 @@ def get_table_by_uuid(sesh: Session, table_uuid: UUID) -> Table:
         return get_table(sesh, pair[0], pair[1])
 
 
+TABLE_METADATA_STMT = text(
+    """
+SELECT
+    t.table_uuid,
+    u.username,
+    t.table_name,
+    t.public,
+    t.caption,
+    t.created,
+    t.last_changed,
+    l.spdx_id,
+    gu.last_sha,
+    gu.last_modified,
+    gu.https_repo_url,
+    gu.branch,
+    gu.path,
+    (
+        SELECT
+            array_agg(uc.column_name)
+        FROM
+            metadata.unique_columns AS uc
+        WHERE
+            uc.table_uuid = t.table_uuid) AS unique_column_names,
+    (
+        SELECT
+            array_agg(ci.column_name)
+        FROM
+            metadata.column_indexes AS ci
+        WHERE
+            ci.table_uuid = t.table_uuid) AS indexed_column_names,
+    cols.column_names,
+    cols.sql_types,
+    (rc.row_count + coalesce(tc.row_count_change, 0))::bigint AS row_count,
+    rc.version,
+    greatest(rc.version, tc.version) AS latest_version
+FROM
+    metadata.tables AS t
+    JOIN metadata.users AS u ON t.user_uuid = u.user_uuid
+    LEFT JOIN metadata.github_follows AS gu ON gu.table_uuid = t.table_uuid
+    LEFT JOIN metadata.table_licences AS tl ON tl.table_uuid = t.table_uuid
+    LEFT JOIN metadata.licences AS l ON tl.licence_id = l.licence_id
+    LEFT JOIN metadata.row_counts AS rc ON rc.table_uuid = t.table_uuid
+    LEFT JOIN LATERAL (
+        SELECT
+            sum(row_count_change) AS row_count_change,
+            max(version) AS version
+        FROM
+            metadata.table_changes
+        WHERE
+            table_uuid = t.table_uuid) AS tc ON TRUE
+    LEFT JOIN pg_class AS pc ON pc.oid = to_regclass(
+        'userdata.table_' || replace(t.table_uuid::text, '-', ''))
+    LEFT JOIN LATERAL (
+        SELECT
+            array_agg(attname::text ORDER BY attnum) AS column_names,
+            array_agg(atttypid::regtype::text ORDER BY attnum) AS sql_types
+        FROM
+            pg_attribute
+        WHERE
+            attrelid = pc.oid
+            AND attnum > 0
+            AND NOT attisdropped) AS cols ON TRUE
+WHERE
+    u.username = :username
+    AND t.table_name = :table_name
+    """
+)
+
+
 def get_table(sesh: Session, username: str, table_name: str) -> Table:
-    # FIXME: this is very hot
-    # - should be cached
-    # - should be doing a single query
-    # o lord give me performance, but not yet
-    user = user_by_name(sesh, username)
-    table_model: Optional[models.Table] = (
-        sesh.query(models.Table)
-        .filter(
-            models.Table.user_uuid == user.user_uuid,
-            models.Table.table_name == table_name,
-        )
-        .first()
-    )
-    if table_model is None:
-        raise exc.TableDoesNotExistException(user.username, table_name)
-    backend = PGUserdataAdapter(sesh)
-    columns = backend.get_columns(table_model.table_uuid)
-    row_count = backend.count(table_model.table_uuid)
-    source: Optional[models.GitUpstream] = (
-        sesh.query(models.GitUpstream)
-        .filter(models.GitUpstream.table_uuid == table_model.table_uuid)
-        .first()
-    )
-    unique_column_names = (
-        sesh.query(func.array_agg(models.UniqueColumn.column_name))
-        .filter(models.UniqueColumn.table_uuid == table_model.table_uuid)
-        .scalar()
-    )
-    spdx_id: Optional[str] = (
-        sesh.query(models.Licence.spdx_id)
-        .join(
-            models.TableLicence,
-            models.TableLicence.licence_id == models.Licence.licence_id,
+    """Return the Table (ie: the metadata about a table).
+
+    This is very hot, so the result is cached (see csvbase.cache, possibly
+    shared via memcached) and a cache miss is answered with a single query.
+
+    """
+    metadata_cache = get_metadata_cache()
+    cached, generation = metadata_cache.get_table(username, table_name)
+    if cached is not None:
+        # so that the userdata adapter need not look the columns up again
+        PGUserdataAdapter(sesh).remember_columns(cached.table_uuid, cached.columns)
+        return cached
+
+    # textual statements don't autoflush, but pending changes (eg a newly
+    # created table) need to be visible
+    sesh.flush()
+    rp = sesh.execute(
+        TABLE_METADATA_STMT, dict(username=username, table_name=table_name)
+    ).one_or_none()
+    if rp is None:
+        # preserve the distinction between a missing user and a missing table
+        user_exists(sesh, username)
+        raise exc.TableDoesNotExistException(username, table_name)
+
+    columns = [
+        Column(name=name, type_=ColumnType.from_sql_type(sql_type))
+        for name, sql_type in zip(rp.column_names or [], rp.sql_types or [])
+    ]
+    if rp.last_sha is not None:
+        source: Optional[GitUpstream] = GitUpstream(
+            last_sha=bytes(rp.last_sha),
+            last_modified=rp.last_modified,
+            repo_url=rp.https_repo_url,
+            branch=rp.branch,
+            path=rp.path,
         )
-        .filter(models.TableLicence.table_uuid == table_model.table_uuid)
-        .scalar()
-    )
-    return _make_table(
-        user.username,
-        table_model,
-        columns,
-        row_count,
-        source,
-        unique_column_names,
-        spdx_id,
+    else:
+        source = None
+    if rp.unique_column_names is not None:
+        key: Optional[List[Column]] = [
+            c for c in columns if c.name in rp.unique_column_names
+        ]
+    else:
+        key = None
+    table = Table(
+        table_uuid=rp.table_uuid,
+        username=rp.username,
+        table_name=rp.table_name,
+        is_public=rp.public,
+        caption=rp.caption,
+        columns=columns,
+        created=rp.created,
+        row_count=RowCount(rp.row_count, rp.row_count),
+        last_changed=rp.last_changed,
+        version=rp.version or 0,
+        latest_version=rp.latest_version or 0,
+        upstream=source,
+        key=key,
+        licence=Licence.from_spdx_id(rp.spdx_id) if rp.spdx_id is not None else None,
+        indexed_columns=[
+            c for c in columns if c.name in (rp.indexed_column_names or [])
+        ],
     )
+    metadata_cache.put_table(table, generation)
+    PGUserdataAdapter(sesh).remember_columns(table.table_uuid, table.columns)
+    return table
 
 
 def delete_table_and_metadata(sesh: Session, username: str, table_name: str) -> None:
@@ -265,7 +382,11 @@ def delete_table_and_metadata(sesh: Session, username: str, table_name: str) ->
     sesh.query(models.UniqueColumn).filter(
         models.UniqueColumn.table_uuid == table_model.table_uuid
     ).delete()
+    sesh.query(models.ColumnIndex).filter(
+        models.ColumnIndex.table_uuid == table_model.table_uuid
+    ).delete()
     sesh.delete(table_model)
+    invalidate_table(sesh, table_model.table_uuid)
 
     # Make sure the metadata is purged prior to deleting the userdata,
     # otherwise the metadata remains present which can confuse readers (eg the
@@ -320,6 +441,7 @@ def create_table_metadata(
 
 
 def set_key(sesh: Session, table_uuid: UUID, key: Sequence[Column]) -> None:
+    invalidate_table(sesh, table_uuid)
     for column in key:
         sesh.add(models.UniqueColumn(table_uuid=table_uuid, column_name=column.name))
 
@@ -332,6 +454,7 @@ def get_key(sesh: Session, table_uuid: UUID) -> Sequence[str]:
 
 
 def create_git_upstream(sesh: Session, table_uuid: UUID, upstream: GitUpstream) -> None:
+    invalidate_table(sesh, table_uuid)
     sesh.add(
         models.GitUpstream(
             table_uuid=table_uuid,
@@ -362,6 +485,7 @@ def update_upstream(sesh: Session, table: Table) -> None:
 
 
 def set_version(sesh: Session, table_uuid: UUID, version: UpstreamVersion) -> None:
+    invalidate_table(sesh, table_uuid)
     sesh.query(models.GitUpstream).where(
         models.GitUpstream.table_uuid == table_uuid
     ).update(
@@ -381,6 +505,7 @@ def update_table_metadata(
 ) -> None:
     # If we have a table uuid, the table must exist
     table_obj = cast(models.Table, sesh.get(models.Table, table_uuid))
+    invalidate_table(sesh, table_uuid)
 
     table_obj.public = is_public
     table_obj.caption = caption
@@ -488,7 +613,6 @@ def get_a_made_up_row(sesh: Session, table_uuid: UUID) -> Row:
 
 
 def is_public(sesh: Session, username: str, table_name: str) -> bool:
-    # FIXME: This is in preparation for get_table to use memcache
     table = get_table(sesh, username, table_name)
     return table.is_public
 
@@ -657,36 +781,7 @@ def table_page(
         tk_a = satuple(t_a.last_changed, t_a.table_uuid)
         page_of_tables = sesh.query(t_a, u_a.username, gu_a).order_by(tk_a.desc())
 
-    backend = PGUserdataAdapter(sesh)
-    tables = []
-    for table_model, username, source in page_of_tables:
-        columns = backend.get_columns(table_model.table_uuid)
-        row_count = backend.count(table_model.table_uuid)
-        unique_column_names = (
-            sesh.query(func.array_agg(models.UniqueColumn.column_name))
-            .filter(models.UniqueColumn.table_uuid == table_model.table_uuid)
-            .scalar()
-        )
-        spdx_id: Optional[str] = (
-            sesh.query(models.Licence.spdx_id)
-            .join(
-                models.TableLicence,
-                models.TableLicence.licence_id == models.Licence.licence_id,
-            )
-            .filter(models.TableLicence.table_uuid == table_model.table_uuid)
-            .scalar()
-        )
-        tables.append(
-            _make_table(
-                username,
-                table_model,
-                columns,
-                row_count,
-                source,
-                unique_column_names,
-                spdx_id,
-            )
-        )
+    tables = _load_tables(sesh, page_of_tables.all())
 
     if len(tables) > 0:
         first_table = (tables[0].last_changed, tables[0].table_uuid)
@@ -703,18 +798,68 @@ def table_page(
     return UserTablePage(has_next=has_next, has_prev=has_prev, tables=tables)
 
 
+def _load_tables(
+    sesh: Session,
+    rows: Sequence[Tuple[models.Table, str, Optional[models.GitUpstream]]],
+) -> List[Table]:
+    """Make Table objects for many tables at once.
+
+    Columns, row counts, keys and licences are each looked up for all the
+    tables in one go, rather than table-by-table.
+
+    """
+    table_uuids = [table_model.table_uuid for table_model, _, _ in rows]
+    if len(table_uuids) == 0:
+        return []
+    backend = PGUserdataAdapter(sesh)
+    columns = backend.get_columns_many(table_uuids)
+    counts_and_versions = backend.counts_and_versions(table_uuids)
+    unique_column_names = dict(
+        sesh.query(
+            models.UniqueColumn.table_uuid,
+            func.array_agg(models.UniqueColumn.column_name),
+        )
+        .filter(models.UniqueColumn.table_uuid.in_(table_uuids))
+        .group_by(models.UniqueColumn.table_uuid)
+    )
+    spdx_ids = dict(
+        sesh.query(models.TableLicence.table_uuid, models.Licence.spdx_id)
+        .join(
+            models.Licence,
+            models.TableLicence.licence_id == models.Licence.licence_id,
+        )
+        .filter(models.TableLicence.table_uuid.in_(table_uuids))
+    )
+    return [
+        _make_table(
+            username,
+            table_model,
+            columns[table_model.table_uuid],
+            *counts_and_versions[table_model.table_uuid],
+            source,
+            unique_column_names.get(table_model.table_uuid),
+            spdx_ids.get(table_model.table_uuid),
+        )
+        for table_model, username, source in rows
+    ]
+
+
 def _make_table(
     username: str,
     table_model: models.Table,
     columns: Sequence[Column],
     row_count: RowCount,
+    version: int,
+    latest_version: int,
     source: Optional[models.GitUpstream],
     unique_column_names: Optional[Sequence[str]],
     spdx_id: Optional[str],
 ) -> Table:
     """Make a Table object from inputs"""
     if unique_column_names is not None:
-        key = [c for c in columns if c in unique_column_names]
+        key: Optional[List[Column]] = [
+            c for c in columns if c.name in unique_column_names
+        ]
     else:
         key = None
     licence = Licence.from_spdx_id(spdx_id) if spdx_id is not None else None
@@ -728,6 +873,8 @@ def _make_table(
         created=table_model.created,
         row_count=row_count,
         last_changed=table_model.last_changed,
+        version=version,
+        latest_version=latest_version,
         upstream=_make_source(source),
         key=key,
         licence=licence,
@@ -751,71 +898,65 @@ def _make_source(
 
 def get_newest_tables(sesh: Session, n: int = 10) -> Iterable[Table]:
     newest_tables = (
-        sesh.query(models.Table.table_name, models.User.username)
+        sesh.query(models.Table, models.User.username, models.GitUpstream)
         .join(models.User)
+        .outerjoin(models.GitUpstream)
         .where(models.Table.public)
         .order_by(models.Table.created.desc())
         .limit(n)
     )
-    for table_name, username in newest_tables:
-        yield get_table(sesh, username, table_name)
+    return _load_tables(sesh, newest_tables.all())
 
 
 def get_top_n(sesh: Session, n: int = 10) -> Iterable[Table]:
-    # FIXME: Put this in a materialized view and refresh every N minutes
+    """Return the top tables, according to the (precomputed) ranking.
+
+    The ranking is refreshed periodically by refresh_top_tables, and so can be
+    somewhat out of date.
+
+    """
+    top_uuids = get_top_n_uuids(sesh, n)
+    rows = {
+        table_model.table_uuid: (table_model, username, source)
+        for table_model, username, source in sesh.query(
+            models.Table, models.User.username, models.GitUpstream
+        )
+        .join(models.User)
+        .outerjoin(models.GitUpstream)
+        .filter(models.Table.table_uuid.in_(top_uuids))
+    }
+    # tables deleted in the meantime are skipped
+    return _load_tables(
+        sesh, [rows[table_uuid] for table_uuid in top_uuids if table_uuid in rows]
+    )
+
+
+def get_top_n_uuids(sesh: Session, n: int = 10) -> List[UUID]:
+    """Return the uuids of the top (public) tables, in order."""
     stmt = text(
         """
 SELECT
-    table_uuid,
-    username,
-    table_name,
-    caption,
-    created,
-    last_changed,
-    spdx_id
+    table_uuid
 FROM
-    metadata.tables AS t
-    JOIN metadata.users AS u on t.user_uuid = u.user_uuid
-    LEFT JOIN metadata.table_licences AS tl using (table_uuid)
-    LEFT JOIN metadata.licences AS l ON tl.licence_id = l.licence_id
-    LEFT JOIN metadata.praise USING (table_uuid)
-WHERE public
-GROUP BY
-    table_uuid, username, spdx_id
+    metadata.top_tables AS tt
+    JOIN metadata.tables AS t USING (table_uuid)
+WHERE t.public
 ORDER BY
-    count(praise_id) / extract(epoch FROM now() - created) DESC,
-    created DESC
+    tt.score DESC,
+    tt.created DESC
 LIMIT :n;
     """
     )
-    backend = PGUserdataAdapter(sesh)
-    rp = sesh.execute(stmt, dict(n=n))
-    for table_uuid, username, table_name, caption, created, last_changed, spdx_id in rp:
-        columns = backend.get_columns(table_uuid)
-        unique_column_names = (
-            sesh.query(func.array_agg(models.UniqueColumn.column_name))
-            .filter(models.UniqueColumn.table_uuid == table_uuid)
-            .scalar()
-        )
-        if unique_column_names is not None:
-            key = [c for c in columns if c in unique_column_names]
-        else:
-            key = None
-        licence = Licence.from_spdx_id(spdx_id) if spdx_id is not None else None
-        table = Table(
-            table_uuid,
-            username,
-            table_name,
-            True,
-            caption,
-            columns,
-            created,
-            backend.count(table_uuid),
-            last_changed,
-            key=key,
-            licence=licence,
-        )
-        yield table
+    return list(sesh.execute(stmt, dict(n=n)).scalars())
+
+
+def refresh_top_tables(sesh: Session) -> None:
+    """Recompute the ranking used by get_top_n.
+
+    This is done concurrently, so readers are not blocked while it runs.
+
+    """
+    sesh.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY metadata.top_tables"))
 
 
 def get_public_table_names(sesh: Session) -> Iterable[Tuple[str, str, date]]:
@@ -942,11 +1083,57 @@ RETURNING
 
 
 def mark_table_changed(sesh: Session, table_uuid: UUID) -> None:
+    invalidate_table(sesh, table_uuid)
     sesh.execute(
         update(models.Table)
         .where(models.Table.table_uuid == table_uuid)
         .values(last_changed=func.now())
     )
+    # changes to the userdata are logged by the triggers (and folded in here),
+    # but changes to the metadata need a new version too
+    PGUserdataAdapter(sesh).fold_changes(table_uuid)
+    sesh.execute(
+        update(models.TableRowCount)
+        .where(models.TableRowCount.table_uuid == table_uuid)
+        .values(version=models.table_versions.next_value())
+    )
+
+
+def mark_table_data_changed(sesh: Session, table_uuid: UUID) -> None:
+    """Mark that some rows of a table have changed (eg: via the row API).
+
+    Updating the metadata for every write would make concurrent writers to
+    the same table queue up on the locks for its metadata rows.  So if the
+    table_changed_interval is configured, nothing is updated here: the
+    triggers have already logged the change, which flush_table_changes folds
+    in, in the background.  Until then last_changed and the repcache lag
+    behind, but the latest_version (which etags of table pages go by) does
+    not.
+
+    """
+    if get_config().table_changed_interval is not None:
+        invalidate_table(sesh, table_uuid)
+    else:
+        mark_table_changed(sesh, table_uuid)
+
+
+def flush_table_changes(sesh: Session) -> List[UUID]:
+    """Fold in the logged changes to rows and bring last_changed up to date
+    (see mark_table_data_changed).  Returns the uuids of the tables updated."""
+    folded = PGUserdataAdapter(sesh).fold_changes()
+    stmt = (
+        update(models.Table)
+        .where(
+            models.TableRowCount.table_uuid == models.Table.table_uuid,
+            models.TableRowCount.data_changed > models.Table.last_changed,
+        )
+        .values(last_changed=models.TableRowCount.data_changed)
+        .returning(models.Table.table_uuid)
+    )
+    table_uuids = list(sesh.execute(stmt).scalars())
+    for table_uuid in set(folded) | set(table_uuids):
+        invalidate_table(sesh, table_uuid)
+    return table_uuids
 
 
 def get_usage(sesh: Session, user_uuid: UUID) -> Usage:
@@ -998,33 +1185,7 @@ def git_tables(sesh: Session) -> Iterable[Tuple[Table, GitUpstream]]:
         )
         .where(~models.GitUpstream.https_repo_url.like("https://example.com%"))
     )
-    backend = PGUserdataAdapter(sesh)
-    for table_model, username, git_upstream_model in rows:
-        columns = backend.get_columns(table_model.table_uuid)
-        row_count = backend.count(table_model.table_uuid)
-        unique_column_names = (
-            sesh.query(func.array_agg(models.UniqueColumn.column_name))
-            .filter(models.UniqueColumn.table_uuid == table_model.table_uuid)
-            .scalar()
-        )
-        spdx_id: Optional[str] = (
-            sesh.query(models.Licence.spdx_id)
-            .join(
-                models.TableLicence,
-                models.TableLicence.licence_id == models.Licence.licence_id,
-            )
-            .filter(models.TableLicence.table_uuid == table_model.table_uuid)
-            .scalar()
-        )
-        table = _make_table(
-            username,
-            table_model,
-            columns,
-            row_count,
-            git_upstream_model,
-            unique_column_names,
-            spdx_id,
-        )
+    for table in _load_tables(sesh, rows.all()):
         ext_source = cast(GitUpstream, table.upstream)
         yield (table, ext_source)
 
@@ -1032,21 +1193,30 @@ def git_tables(sesh: Session) -> Iterable[Tuple[Table, GitUpstream]]:
 def populate_repcache(
     sesh: Session, table_uuid: UUID, content_type: ContentType
 ) -> None:
-    """Populate the repcache for a given table and content type."""
+    """Populate the repcache for a given table and content type.
+
+    Raises RepWriteInProgress if some other process is already doing so.
+
+    """
     backend = PGUserdataAdapter(sesh)
     table = get_table_by_uuid(sesh, table_uuid)
-    repcache = RepCache(table_uuid, content_type, table.last_changed)
+    repcache = RepCache(table_uuid, content_type, table.version)
     if repcache.exists():
         logger.info(
             "not populated repcache for '%s'@%s, already present",
             table.ref(),
-            table.last_changed,
+            table.version,
         )
+        return
     with repcache.open(mode="wb") as rep_file:
         columns = backend.get_columns(table.table_uuid)
         rows = backend.table_as_rows(table.table_uuid)
         if content_type is ContentType.PARQUET:
-            table_io.rows_to_parquet(columns, rows, rep_file)
+            table_io.record_batches_to_parquet(
+                table_io.arrow_schema(columns),
+                backend.table_as_record_batches(table.table_uuid),
+                rep_file,
+            )
         elif content_type is ContentType.JSON_LINES:
             table_io.rows_to_jsonlines(columns, rows, rep_file)
         elif content_type is ContentType.XLSX:
@@ -1068,7 +1238,7 @@ def populate_repcache(
             )
         else:
             table_io.rows_to_csv(columns, rows, buf=rep_file)
-    logger.info("populated repcache for %s@%s", table.ref(), table.last_changed)
+    logger.info("populated repcache for %s@%s", table.ref(), table.version)
 
 
 def generate_email_verification_code(sesh: Session, user_uuid: UUID) -> bytes:
@@ -11,20 +11,28 @@ from typing import (
     Dict,
     Any,
     Optional,
+    Deque,
+    Union,
 )
 from logging import getLogger
 import io
 from dataclasses import dataclass
 import contextlib
 import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import xlsxwriter
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 
-from . import conv, exc
-from .streams import UserSubmittedCSVData, rewind
-from .value_objs import ColumnType, PythonType, Column, Table
+from . import conv, exc, streams
+from .config import get_config
+from .streams import UserSubmittedCSVData, Utf8Reader, rewind
+from .value_objs import ColumnType, PythonType, Column, Table, Encoding
 from .json import value_to_json
 
 logger = getLogger(__name__)
@@ -37,13 +45,7 @@ PARQUET_TYPE_MAP: Mapping[ColumnType, pa.lib.DataType] = {
     ColumnType.DATE: pa.date32(),
 }
 
-PARQUET_READ_TYPE_MAP: Mapping[Tuple[str, str], ColumnType] = {
-    ("INT64", "NONE"): ColumnType.INTEGER,
-    ("BYTE_ARRAY", "STRING"): ColumnType.TEXT,
-    ("INT32", "DATE"): ColumnType.DATE,
-    ("DOUBLE", "NONE"): ColumnType.FLOAT,
-    ("BOOLEAN", "NONE"): ColumnType.BOOLEAN,
-}
+PARQUET_MAGIC = b"PAR1"
 
 UnmappedRow = Sequence[PythonType]
 
@@ -58,29 +60,48 @@ def batched(iterable, n):
         yield batch
 
 
+# smaller is considerably better for csvbase as it keeps peak memory usage
+# down.  however there is evidence that very small numbers disportionately
+# slow down clients.  5k seems to be a just-about-workable midpoint.
+# https://duckdb.org/docs/guides/performance/file_formats#handling-parquet-files
+PARQUET_ROW_GROUP_SIZE = 5_000
+
+
+def arrow_schema(columns: Sequence[Column]) -> pa.Schema:
+    # necessary to supply a schema in our case because pyarrow does not infer a
+    # type for dates
+    return pa.schema([pa.field(c.name, PARQUET_TYPE_MAP[c.type_]) for c in columns])
+
+
 def rows_to_parquet(
     columns: Sequence[Column],
     rows: Iterable[UnmappedRow],
     buf: Optional[IO[bytes]] = None,
 ) -> IO[bytes]:
-    # smaller is considerably better for csvbase as it keeps peak memory usage
-    # down.  however there is evidence that very small numbers disportionately
-    # slow down clients.  5k seems to be a just-about-workable midpoint.
-    # https://duckdb.org/docs/guides/performance/file_formats#handling-parquet-files
-    batch_size = 5_000
-    buf = buf or io.BytesIO()
+    schema = arrow_schema(columns)
+    column_names = [c.name for c in columns]
+    record_batches = (
+        pa.RecordBatch.from_pydict(
+            {e[0]: pa.array(e[1]) for e in zip(column_names, zip(*batch))},
+            schema=schema,
+        )
+        for batch in batched(rows, PARQUET_ROW_GROUP_SIZE)
+    )
+    return record_batches_to_parquet(schema, record_batches, buf)
 
-    # necessary to supply a schema in our case because pyarrow does not infer a
-    # type for dates
-    schema = pa.schema([pa.field(c.name, PARQUET_TYPE_MAP[c.type_]) for c in columns])
 
-    column_names = [c.name for c in columns]
+def record_batches_to_parquet(
+    schema: pa.Schema,
+    record_batches: Iterable[pa.RecordBatch],
+    buf: Optional[IO[bytes]] = None,
+) -> IO[bytes]:
+    """Write arrow record batches to parquet, in row groups of a bounded
+    size."""
+    buf = buf or io.BytesIO()
     with rewind(buf):
         with contextlib.closing(pq.ParquetWriter(buf, schema)) as writer:
-            for batch in batched(rows, batch_size):
-                pydict = {e[0]: pa.array(e[1]) for e in zip(column_names, zip(*batch))}
-                record_batch = pa.RecordBatch.from_pydict(pydict, schema=schema)
-                writer.write_batch(record_batch)
+            for record_batch in record_batches:
+                writer.write_batch(record_batch, row_group_size=PARQUET_ROW_GROUP_SIZE)
     return buf
 
 
@@ -126,26 +147,483 @@ def csv_to_rows(
         raise exc.CSVParseError("parse error(s)", error_locations)
 
 
+# Values in these forms (after stripping) are converted by pyarrow.  Anything
+# else is passed to conv, value-by-value, so the results are always the same as
+# csv_to_rows
+_ARROW_INTEGER_REGEX = r"^-?[0-9,]+$"
+_ARROW_INTEGER_NO_COMMAS_REGEX = r"^-?[0-9]{1,18}$"
+_ARROW_FLOAT_REGEX = r"^-?[0-9,.]+(e[-+][0-9]+)?$"
+_ARROW_FLOAT_NO_COMMAS_REGEX = r"^-?([0-9]+\.?[0-9]*|\.[0-9]+)(e[-+][0-9]+)?$"
+_ARROW_DATE_REGEX = r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"
+_ARROW_TRUE_STRINGS = pa.array(["true", "t", "yes", "y"])
+_ARROW_BOOLEAN_STRINGS = pa.array(["true", "t", "yes", "y", "false", "f", "no", "n"])
+_ARROW_NULL_STRINGS = pa.array(sorted(conv.NULL_STRINGS))
+
+# integers outside of this range don't fit into an int64 (or a bigint)
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+
+def _arrow_candidates(column_type: ColumnType, stripped: pa.Array) -> pa.Array:
+    """Return a mask of which (stripped, non-null) strings are in a form that
+    pyarrow converts to the same value as conv does."""
+    if column_type is ColumnType.INTEGER:
+        return pc.and_(
+            pc.match_substring_regex(stripped, _ARROW_INTEGER_REGEX),
+            pc.match_substring_regex(
+                pc.replace_substring(stripped, ",", ""),
+                _ARROW_INTEGER_NO_COMMAS_REGEX,
+            ),
+        )
+    elif column_type is ColumnType.FLOAT:
+        return pc.and_(
+            pc.match_substring_regex(stripped, _ARROW_FLOAT_REGEX),
+            pc.match_substring_regex(
+                pc.replace_substring(stripped, ",", ""), _ARROW_FLOAT_NO_COMMAS_REGEX
+            ),
+        )
+    elif column_type is ColumnType.BOOLEAN:
+        return pc.is_in(pc.utf8_lower(stripped), value_set=_ARROW_BOOLEAN_STRINGS)
+    else:
+        # pyarrow doesn't check that dates exist (eg: 30th of Feb) so check
+        # that they survive a round trip
+        parsed = pc.strptime(stripped, format="%Y-%m-%d", unit="s", error_is_null=True)
+        return pc.and_(
+            pc.and_(
+                pc.match_substring_regex(stripped, _ARROW_DATE_REGEX),
+                pc.invert(pc.starts_with(stripped, "0000")),
+            ),
+            pc.fill_null(
+                pc.equal(pc.strftime(parsed, format="%Y-%m-%d"), stripped), False
+            ),
+        )
+
+
+def _arrow_convert(column_type: ColumnType, stripped: pa.Array) -> pa.Array:
+    if column_type is ColumnType.INTEGER:
+        return pc.cast(pc.replace_substring(stripped, ",", ""), pa.int64())
+    elif column_type is ColumnType.FLOAT:
+        return pc.cast(pc.replace_substring(stripped, ",", ""), pa.float64())
+    elif column_type is ColumnType.BOOLEAN:
+        return pc.if_else(
+            pc.is_null(stripped),
+            pa.scalar(None, pa.bool_()),
+            pc.is_in(pc.utf8_lower(stripped), value_set=_ARROW_TRUE_STRINGS),
+        )
+    else:
+        return pc.cast(stripped, pa.date32())
+
+
+def _convert_string_array(
+    column_type: ColumnType, strings: pa.Array
+) -> Tuple[pa.Array, List[int]]:
+    """Convert a whole column of strings from a csv file, as
+    conv.from_string_to_python would, value-by-value.
+
+    Returns the converted array and the indices of any unconvertable values.
+
+    """
+    arrow_type = PARQUET_TYPE_MAP[column_type]
+    if column_type is ColumnType.TEXT:
+        return pc.if_else(pc.equal(strings, ""), None, strings), []
+
+    stripped = pc.utf8_trim_whitespace(strings)
+    is_null = pc.is_in(pc.utf8_lower(stripped), value_set=_ARROW_NULL_STRINGS)
+    candidates = pc.and_(pc.invert(is_null), _arrow_candidates(column_type, stripped))
+    converted = _arrow_convert(
+        column_type, pc.if_else(candidates, stripped, pa.scalar(None, pa.string()))
+    )
+
+    # the rest (usually none) are non-null values in unusual forms, or errors
+    leftover_mask = pc.invert(pc.or_(is_null, candidates))
+    leftover_indices = pc.indices_nonzero(leftover_mask).to_pylist()
+    if len(leftover_indices) == 0:
+        return converted, []
+    error_indices = []
+    leftover_values: List[PythonType] = []
+    for index in leftover_indices:
+        try:
+            value = conv.from_string_to_python(column_type, strings[index].as_py())
+        except (exc.UnconvertableValueException, ValueError):
+            error_indices.append(index)
+            leftover_values.append(None)
+            continue
+        if isinstance(value, int) and not _INT64_MIN <= value <= _INT64_MAX:
+            error_indices.append(index)
+            leftover_values.append(None)
+        else:
+            leftover_values.append(value)
+    return (
+        pc.replace_with_mask(
+            converted, leftover_mask, pa.array(leftover_values, type=arrow_type)
+        ),
+        error_indices,
+    )
+
+
+def _arrow_parse_options(dialect) -> Optional[pacsv.ParseOptions]:
+    """Return the pyarrow equivalent of a csv dialect, if there is one."""
+    if dialect.skipinitialspace or len(dialect.delimiter) != 1:
+        return None
+    return pacsv.ParseOptions(
+        delimiter=dialect.delimiter,
+        quote_char=dialect.quotechar or False,
+        double_quote=dialect.doublequote,
+        escape_char=dialect.escapechar or False,
+        newlines_in_values=True,
+    )
+
+
+def _open_string_csv(
+    byte_buf: Union[IO[bytes], io.RawIOBase],
+    column_count: int,
+    parse_options: pacsv.ParseOptions,
+    skip_header: bool = True,
+    encoding: str = "utf8",
+) -> Optional[pacsv.CSVStreamingReader]:
+    """Open a csv file with pyarrow, reading every column as strings.
+
+    Returns None if there are no rows at all.
+
+    """
+    # the header is skipped and internal column names are used in case the
+    # header has duplicates
+    internal_names = [f"column_{i}" for i in range(column_count)]
+    try:
+        return pacsv.open_csv(
+            byte_buf,
+            read_options=pacsv.ReadOptions(
+                column_names=internal_names,
+                skip_rows=1 if skip_header else 0,
+                use_threads=True,
+                encoding=encoding,
+            ),
+            parse_options=parse_options,
+            convert_options=pacsv.ConvertOptions(
+                column_types={name: pa.string() for name in internal_names},
+                strings_can_be_null=False,
+            ),
+        )
+    except StopIteration:
+        return None
+    except pa.ArrowInvalid as e:
+        if "Empty CSV file" in str(e):
+            return None
+        raise
+
+
+def _convert_string_batch(
+    columns: Sequence[Column], string_batch: pa.RecordBatch
+) -> Tuple[pa.RecordBatch, List[Tuple[int, int, str]]]:
+    """Convert a record batch of strings into the column types.
+
+    Returns the converted batch and the (row index, column index, value) of any
+    unconvertable values, in row-major order.
+
+    """
+    arrays = []
+    errors: List[Tuple[int, int]] = []
+    for column_index, (column, strings) in enumerate(
+        zip(columns, string_batch.columns)
+    ):
+        array, error_indices = _convert_string_array(column.type_, strings)
+        arrays.append(array)
+        errors.extend((index, column_index) for index in error_indices)
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema(columns)), [
+        (index, column_index, string_batch.column(column_index)[index].as_py())
+        for index, column_index in sorted(errors)
+    ]
+
+
+def _parse_csv_chunk(
+    chunk: bytes,
+    encoding: str,
+    columns: Sequence[Column],
+    parse_options: pacsv.ParseOptions,
+    skip_header: bool,
+    error_threshold: int,
+) -> Tuple[List[pa.RecordBatch], List[Tuple[int, int, str]], int]:
+    """Parse one chunk of a csv file (in a worker process).
+
+    Returns the record batches, any errors (with row indexes relative to the
+    start of the chunk) and the number of rows in the chunk.  Batches are not
+    returned if there were errors.
+
+    """
+    record_batches: List[pa.RecordBatch] = []
+    errors: List[Tuple[int, int, str]] = []
+    rows_read = 0
+    reader = _open_string_csv(
+        pa.BufferReader(chunk), len(columns), parse_options, skip_header, encoding
+    )
+    if reader is None:
+        return record_batches, errors, rows_read
+    for string_batch in reader:
+        record_batch, batch_errors = _convert_string_batch(columns, string_batch)
+        errors.extend(
+            (rows_read + index, column_index, value)
+            for index, column_index, value in batch_errors
+        )
+        rows_read += string_batch.num_rows
+        if len(errors) > error_threshold:
+            break
+        elif len(errors) == 0:
+            record_batches.append(record_batch)
+    if errors:
+        record_batches = []
+    return record_batches, errors[: error_threshold + 1], rows_read
+
+
+def _csv_to_record_batches_parallel(
+    byte_buf: IO[bytes],
+    encoding: Encoding,
+    offsets: Sequence[Tuple[int, int]],
+    columns: Sequence[Column],
+    parse_options: pacsv.ParseOptions,
+    error_threshold: int,
+    workers: int,
+) -> Iterable[pa.RecordBatch]:
+    error_locations: List[CSVParseErrorLocation] = []
+    rows_read = 0
+    # chunks are read in the order they are needed, keeping a couple per worker
+    # in flight so that memory use is bounded
+    chunks = iter(enumerate(offsets))
+    pending: Deque[Future] = deque()
+    # spawn, rather than fork, as this may be running in a threaded web
+    # server, with connection pools, etc
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+
+        def submit_next() -> None:
+            for chunk_index, (start, end) in itertools.islice(chunks, 1):
+                byte_buf.seek(start)
+                pending.append(
+                    executor.submit(
+                        _parse_csv_chunk,
+                        byte_buf.read(end - start),
+                        encoding.value,
+                        columns,
+                        parse_options,
+                        chunk_index == 0,
+                        error_threshold,
+                    )
+                )
+
+        try:
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                try:
+                    record_batches, errors, row_count = pending.popleft().result()
+                except pa.ArrowInvalid as e:
+                    raise exc.CSVParseError(str(e)) from e
+                submit_next()
+                for index, column_index, value in errors:
+                    error_locations.append(
+                        CSVParseErrorLocation(
+                            rows_read + index + 1, columns[column_index], value
+                        )
+                    )
+                rows_read += row_count
+
+                # as with csv_to_rows, stop yielding once there are errors
+                if len(error_locations) > error_threshold:
+                    error_locations = error_locations[: error_threshold + 1]
+                    break
+                elif len(error_locations) == 0:
+                    yield from record_batches
+        finally:
+            for future in pending:
+                future.cancel()
+            byte_buf.seek(0)
+
+    if error_locations:
+        raise exc.CSVParseError("parse error(s)", error_locations)
+
+
+def csv_to_record_batches(
+    csv_buf: UserSubmittedCSVData,
+    columns: Sequence[Column],
+    dialect,
+    error_threshold=10,
+) -> Iterable[pa.RecordBatch]:
+    """Parse a csv file into arrow record batches.
+
+    This has the same results as csv_to_rows (including errors) but reads the
+    csv file with pyarrow and converts whole columns at a time, which is a lot
+    faster.  Dialects that pyarrow can't read are handled via csv_to_rows.
+
+    Large files are divided into chunks which are parsed in parallel, across
+    processes, if that is configured.
+
+    """
+    schema = arrow_schema(columns)
+    parse_options = _arrow_parse_options(dialect)
+    if parse_options is None:
+        logger.info("pyarrow can't read dialect, falling back to csv_to_rows")
+        for batch in batched(
+            csv_to_rows(csv_buf, columns, dialect, error_threshold),
+            PARQUET_ROW_GROUP_SIZE,
+        ):
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.array(column_values, type=field.type)
+                    for column_values, field in zip(zip(*batch), schema)
+                ],
+                schema=schema,
+            )
+        return
+
+    config = get_config()
+    splittable = streams.splittable_byte_buf(csv_buf)
+    if (
+        config.csv_parse_workers > 1
+        and splittable is not None
+        and not dialect.escapechar
+        and dialect.doublequote
+    ):
+        byte_buf, encoding = splittable
+        chunk_size = config.csv_parse_chunk_size
+        if streams.file_length(byte_buf) > chunk_size * 2:
+            offsets = streams.csv_chunk_offsets(byte_buf, chunk_size, dialect.quotechar)
+            if offsets is not None:
+                logger.info(
+                    "parsing csv in %d chunks across %d processes",
+                    len(offsets),
+                    config.csv_parse_workers,
+                )
+                yield from _csv_to_record_batches_parallel(
+                    byte_buf,
+                    encoding,
+                    offsets,
+                    columns,
+                    parse_options,
+                    error_threshold,
+                    config.csv_parse_workers,
+                )
+                return
+            logger.warning("unbalanced quotes, parsing csv in a single process")
+
+    try:
+        reader = _open_string_csv(Utf8Reader(csv_buf), len(columns), parse_options)
+    except pa.ArrowInvalid as e:
+        raise exc.CSVParseError(str(e)) from e
+    if reader is None:
+        return  # no rows at all
+
+    error_locations: List[CSVParseErrorLocation] = []
+    rows_read = 0
+    while True:
+        try:
+            string_batch = reader.read_next_batch()
+        except StopIteration:
+            break
+        except pa.ArrowInvalid as e:
+            raise exc.CSVParseError(str(e)) from e
+
+        record_batch, batch_errors = _convert_string_batch(columns, string_batch)
+        for index, column_index, value in batch_errors:
+            error_locations.append(
+                CSVParseErrorLocation(
+                    rows_read + index + 1, columns[column_index], value
+                )
+            )
+        rows_read += string_batch.num_rows
+
+        # as with csv_to_rows, stop yielding once there are errors
+        if len(error_locations) > error_threshold:
+            error_locations = error_locations[: error_threshold + 1]
+            break
+        elif len(error_locations) == 0:
+            yield record_batch
+
+    if error_locations:
+        raise exc.CSVParseError("parse error(s)", error_locations)
+
+
 def buf_to_pf(buf: IO[bytes]) -> pq.ParquetFile:
     return pq.ParquetFile(buf)
 
 
-def parquet_file_to_columns(pf: pq.ParquetFile) -> List[Column]:
-    columns = []
-    for pf_column in pf.schema:
-        type_str_pair: Tuple[str, str] = (
-            pf_column.physical_type,
-            pf_column.logical_type.type,
-        )
-        columns.append(Column(pf_column.name, PARQUET_READ_TYPE_MAP[type_str_pair]))
-    return columns
+def _parquet_column_type(arrow_type: pa.lib.DataType) -> ColumnType:
+    if pa.types.is_integer(arrow_type):
+        return ColumnType.INTEGER
+    elif pa.types.is_floating(arrow_type):
+        return ColumnType.FLOAT
+    elif pa.types.is_boolean(arrow_type):
+        return ColumnType.BOOLEAN
+    elif pa.types.is_date(arrow_type):
+        return ColumnType.DATE
+    else:
+        # strings, plus anything else that arrow can represent as a string
+        # (eg: timestamps and decimals)
+        return ColumnType.TEXT
+
+
+def parquet_file_to_columns(
+    pf: pq.ParquetFile, existing_columns: Optional[Sequence[Column]] = None
+) -> List[Column]:
+    """Return the columns of a parquet file.
+
+    As with peek_csv, if this is a parquet file for an existing table then the
+    existing columns are provided and those are used instead.
+
+    """
+    if existing_columns is not None:
+        existing_map = {column.name: column for column in existing_columns}
+        try:
+            return [existing_map[name] for name in pf.schema_arrow.names]
+        except KeyError:
+            # a extra column is present
+            raise exc.TableDefinitionMismatchException()
+    return [
+        Column(field.name, _parquet_column_type(field.type))
+        for field in pf.schema_arrow
+    ]
+
+
+def parquet_file_to_record_batches(
+    pf: pq.ParquetFile,
+    columns: Optional[Sequence[Column]] = None,
+    batch_size: int = PARQUET_ROW_GROUP_SIZE,
+) -> Iterable[pa.RecordBatch]:
+    """Read a parquet file as record batches, cast to the column types.
+
+    This streams through the file so (unlike ParquetFile.read()) memory usage
+    is bounded by the size of a row group.  If columns are given, only those
+    columns are read.
+
+    """
+    if columns is None:
+        columns = parquet_file_to_columns(pf)
+    schema = arrow_schema(columns)
+    try:
+        for record_batch in pf.iter_batches(
+            batch_size=batch_size, columns=[c.name for c in columns]
+        ):
+            yield record_batch.cast(schema)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise exc.TableDefinitionMismatchException() from e
+
+
+def parquet_file_to_rows(
+    pf: pq.ParquetFile, columns: Optional[Sequence[Column]] = None
+) -> Iterable[UnmappedRow]:
+    return record_batches_to_rows(parquet_file_to_record_batches(pf, columns))
+
+
+def record_batches_to_rows(
+    record_batches: Iterable[pa.RecordBatch],
+) -> Iterable[UnmappedRow]:
+    for record_batch in record_batches:
+        yield from zip(*(array.to_pylist() for array in record_batch.columns))
 
 
-def parquet_file_to_rows(pf: pq.ParquetFile) -> Iterable[UnmappedRow]:
-    table = pf.read()
-    for batch in table.to_batches():
-        as_dict = batch.to_pydict()
-        yield from zip(*as_dict.values())
+def is_parquet(byte_buf: IO[bytes]) -> bool:
+    """Whether a (seekable) byte buffer looks like a parquet file."""
+    with rewind(byte_buf):
+        return byte_buf.read(len(PARQUET_MAGIC)) == PARQUET_MAGIC
 
 
 def rows_to_csv(
@@ -1,14 +1,11 @@
 """A way to store uploads for short periods of time between pages, with auto-cleanup.
 
-This currently writes to the filesystem and so prevents scaling across multiple
-machines.  The API encapsulates that, and it should be an easy job later to
-adjust to that it writes to an object store.
+Files are kept in the object store (see csvbase.storage), under tmp/.
 
 """
 
 from typing import IO, Generator
 from logging import getLogger
-from pathlib import Path
 import secrets
 from datetime import datetime, timedelta, timezone
 from contextlib import contextmanager
@@ -16,19 +13,14 @@ import shutil
 import gzip
 
 from . import exc
-from .streams import rewind, cache_dir
+from .streams import rewind
+from .storage import get_object_store
 
 logger = getLogger(__name__)
 
 DEFAULT_RETENTION = timedelta(hours=1)
 
-
-def get_temp_dir() -> Path:
-    # using /tmp would mean we lose the cache between restarts
-    temp_dir = cache_dir() / "tmp"
-    if not temp_dir.exists():
-        temp_dir.mkdir()
-    return temp_dir
+TEMP_PREFIX = "tmp/"
 
 
 def store_temp_file(
@@ -42,34 +34,38 @@ def store_temp_file(
     expiry_str = expiry.isoformat().replace(":", "_")
     filename = f"expires{expiry_str}__{file_id}.gz"
     with rewind(filelike):
-        with gzip.GzipFile(get_temp_dir() / filename, mode="wb") as temp_file:
-            shutil.copyfileobj(filelike, temp_file)
+        with get_object_store().open_write(TEMP_PREFIX + filename) as obj_file:
+            with gzip.GzipFile(fileobj=obj_file, mode="wb") as temp_file:
+                shutil.copyfileobj(filelike, temp_file)
     return file_id
 
 
 @contextmanager
 def retrieve_temp_file(file_id: str) -> Generator[gzip.GzipFile, None, None]:
     cleanup_temp_files()
-    temp_dir = get_temp_dir()
-    globbed = list(temp_dir.glob(f"*__{file_id}.gz"))
-    if len(globbed) != 1:
+    store = get_object_store()
+    keys = [key for key in store.sizes(TEMP_PREFIX) if key.endswith(f"__{file_id}.gz")]
+    if len(keys) != 1:
         raise exc.MissingTempFile()
     else:
-        filename = globbed[0]
-        with gzip.GzipFile(filename, mode="rb") as filelike:
-            yield filelike
+        with store.open_read(keys[0]) as obj_file:
+            with gzip.GzipFile(fileobj=obj_file, mode="rb") as filelike:
+                yield filelike
 
 
 def cleanup_temp_files() -> None:
-    temp_dir = get_temp_dir()
+    store = get_object_store()
     delete_count = 0
     left_count = 0
     now = datetime.now(timezone.utc)
-    for e in temp_dir.glob("expires*__*.gz"):
-        expiry_str = e.name.split("__")[0][len("expires") :].replace("_", ":")
+    for key in store.sizes(TEMP_PREFIX):
+        filename = key[len(TEMP_PREFIX) :]
+        if not (filename.startswith("expires") and "__" in filename):
+            continue
+        expiry_str = filename.split("__")[0][len("expires") :].replace("_", ":")
         expiry = datetime.fromisoformat(expiry_str)
         if expiry < now:
-            e.unlink()
+            store.delete(key)
             delete_count += 1
         else:
             left_count += 1
@@ -1,39 +1,77 @@
 from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
     Iterable,
+    Iterator,
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     cast,
 )
 from uuid import UUID, uuid4
+from logging import getLogger
+from contextlib import closing, contextmanager
+import hashlib
+import io
+import operator
+import itertools
+import queue
+import threading
+import dataclasses
 
 from pgcopy import CopyManager
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from sqlalchemy import (
+    event,
     column as sacolumn,
     func,
     types as satypes,
     tuple_ as satuple,
     delete,
+    update,
     and_,
+    true,
+    not_,
+    literal_column,
+    values as sa_values,
+    cast as sacast,
     ColumnClause,
+    ColumnElement,
 )
-from sqlalchemy.orm import Session
+from sqlalchemy.engine import Connection
+from sqlalchemy.dialects.postgresql import Insert, insert as pg_insert
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.orm import Session, SessionTransaction
 from sqlalchemy.schema import Column as SAColumn, DDLElement
 from sqlalchemy.schema import CreateTable, DropTable, MetaData, Identity
 from sqlalchemy.schema import Table as SATable
 from sqlalchemy.sql.expression import (
     TableClause,
+    TextClause,
+    Select,
     select,
     table as satable,
     text,
-    Executable,
-    ClauseElement,
+    union_all,
 )
 from sqlalchemy.sql.dml import ReturningInsert
 from sqlalchemy.ext.compiler import compiles
-
+from typing_extensions import Literal
+
+from .. import models
+from ..cache import invalidate_table
+from ..config import get_config
+from ..constants import COPY_BUFFER_SIZE
+from ..streams import IterableReader
+from ..table_io import arrow_schema
 from ..value_objs import (
+    BinaryFilter,
+    BinaryOp,
     RowCount,
     Column,
     ColumnType,
@@ -41,10 +79,154 @@ from ..value_objs import (
     Page,
     PythonType,
     Row,
+    RowOperation,
+    RowOperationResult,
     Table,
+    UpsertCounts,
     ROW_ID_COLUMN,
 )
 
+logger = getLogger(__name__)
+
+# the key used in Session.info to hold the columns of userdata tables, which
+# are remembered until the transaction ends
+_COLUMNS_KEY = "csvbase_userdata_columns"
+
+# the most row operations (of a batch) done in one statement
+ROW_OPERATIONS_PER_STATEMENT = 1000
+
+# staging tables with more rows than this get an index on the key
+STAGING_INDEX_THRESHOLD = 100_000
+
+# a column of a table with at least this many rows gets an index after being
+# sorted or filtered by this many times (by any process)
+COLUMN_INDEX_MIN_ROWS = 10_000
+COLUMN_INDEX_THRESHOLD = 3
+
+# how many chunks (of COPY_BUFFER_SIZE) a COPY out can get ahead of its reader
+COPY_OUT_QUEUE_SIZE = 8
+
+FILTER_OPERATORS: Dict[BinaryOp, Callable[[Any, Any], Any]] = {
+    BinaryOp.EQ: operator.eq,
+    BinaryOp.NQE: operator.ne,
+    BinaryOp.GT: operator.gt,
+    BinaryOp.GTE: operator.ge,
+    BinaryOp.LT: operator.lt,
+    BinaryOp.LTE: operator.le,
+}
+
+
+class _CopyOut(io.RawIOBase):
+    """Run a COPY ... TO STDOUT in a thread, so that its output can be read
+    (via chunks()) as it arrives.
+
+    psycopg2 can only COPY out into a file, so this is that file: it puts
+    what is written onto a bounded queue in chunks of COPY_BUFFER_SIZE.  If
+    not everything is read, close() reads the rest of the COPY and discards
+    it, so that the connection is left usable.
+
+    """
+
+    def __init__(self, raw_conn: Any, copy_sql: str) -> None:
+        self.chunk_queue: "queue.Queue[Optional[bytes]]" = queue.Queue(
+            maxsize=COPY_OUT_QUEUE_SIZE
+        )
+        self.buf = bytearray()
+        self.abandoned = False
+        self.errors: List[BaseException] = []
+        self.thread = threading.Thread(
+            target=self._copy, args=(raw_conn, copy_sql), name="copy-out", daemon=True
+        )
+        self.thread.start()
+
+    def _copy(self, raw_conn: Any, copy_sql: str) -> None:
+        try:
+            with closing(raw_conn.cursor()) as cursor:
+                cursor.copy_expert(copy_sql, self)
+            self._put_buffered()
+        except BaseException as e:
+            self.errors.append(e)
+        finally:
+            self.chunk_queue.put(None)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if not self.abandoned:
+            self.buf += b
+            if len(self.buf) >= COPY_BUFFER_SIZE:
+                self._put_buffered()
+        return len(b)
+
+    def _put_buffered(self) -> None:
+        if len(self.buf) > 0 and not self.abandoned:
+            self.chunk_queue.put(bytes(self.buf))
+        self.buf.clear()
+
+    def chunks(self) -> Iterator[bytes]:
+        return iter(self.chunk_queue.get, None)
+
+    def close(self) -> None:
+        """Wait for the COPY to finish (discarding anything unread), raising
+        any error it had."""
+        if not self.closed:
+            self.abandoned = True
+            # the COPY may be waiting for room in the queue
+            while self.thread.is_alive():
+                try:
+                    self.chunk_queue.get_nowait()
+                except queue.Empty:
+                    self.thread.join(timeout=0.1)
+            # anything (else) still reading chunks is told that they're done,
+            # unless the queue is full - in which case it ends with that
+            try:
+                self.chunk_queue.put_nowait(None)
+            except queue.Full:
+                pass
+            super().close()
+            if len(self.errors) > 0:
+                raise self.errors[0]
+
+
+def _keyset_conditions(
+    key_columns: Sequence[ColumnClause], values: Tuple, op: Literal[">", "<"]
+) -> List[ColumnElement[bool]]:
+    """Return the conditions for keys that come after (">") or before ("<") the
+    given values, in ascending order with nulls last.
+
+    The keys are either the row id alone or a sort column (which may be null)
+    and then the row id.  Where the keys that are wanted include both nulls
+    and non-nulls there are two conditions, one for each.  They are kept apart
+    (rather than ORed together) so that each can be a range scan of the
+    column's index.
+
+    """
+    if len(key_columns) == 1:
+        if op == ">":
+            return [key_columns[0] > values[0]]
+        else:
+            return [key_columns[0] < values[0]]
+    sort_column, row_id_column = key_columns
+    sort_value, row_id = values
+    if sort_value is None:
+        among_nulls = and_(
+            sort_column.is_(None),
+            row_id_column > row_id if op == ">" else row_id_column < row_id,
+        )
+        if op == ">":
+            return [among_nulls]
+        else:
+            return [among_nulls, sort_column.is_not(None)]
+    elif op == ">":
+        # null sort values aren't greater than anything, so are added back in
+        return [
+            satuple(sort_column, row_id_column) > satuple(sort_value, row_id),
+            sort_column.is_(None),
+        ]
+    else:
+        return [satuple(sort_column, row_id_column) < satuple(sort_value, row_id)]
+
 
 class PGUserdataAdapter:
     def __init__(self, sesh: Session) -> None:
@@ -106,18 +288,154 @@ class PGUserdataAdapter:
         self.sesh.execute(stmt)
 
     def count(self, table_uuid: UUID) -> RowCount:
-        """Count the rows."""
-        # we don't need the columns here, just a table
-        tableclause = satable(
-            self._make_userdata_table_name(table_uuid), *[], schema="userdata"
+        """Count the rows.
+
+        This is cheap: the count is kept up to date by triggers on the table
+        (see _create_row_count_triggers).
+
+        """
+        return self.count_many([table_uuid])[table_uuid]
+
+    def count_many(self, table_uuids: Sequence[UUID]) -> Dict[UUID, RowCount]:
+        """Count the rows of many tables at once, in a single query."""
+        return {
+            table_uuid: row_count
+            for table_uuid, (row_count, _, _) in self.counts_and_versions(
+                table_uuids
+            ).items()
+        }
+
+    def counts_and_versions(
+        self, table_uuids: Sequence[UUID]
+    ) -> Dict[UUID, Tuple[RowCount, int, int]]:
+        """Return the row count, the version and the latest version of each
+        table.
+
+        The version is the one folded into row_counts (see fold_changes),
+        which is what the repcache goes by.  The latest version also covers
+        changes that are yet to be folded in, as does the row count.
+
+        """
+        if len(table_uuids) == 0:
+            return {}
+        row_counts = models.TableRowCount
+        unfolded = (
+            select(
+                models.TableChange.table_uuid,
+                func.sum(models.TableChange.row_count_change).label("row_count_change"),
+                func.max(models.TableChange.version).label("version"),
+            )
+            .where(models.TableChange.table_uuid.in_(table_uuids))
+            .group_by(models.TableChange.table_uuid)
+            .subquery()
+        )
+        stmt = (
+            select(
+                row_counts.table_uuid,
+                row_counts.row_count + func.coalesce(unfolded.c.row_count_change, 0),
+                row_counts.version,
+                func.greatest(row_counts.version, unfolded.c.version),
+            )
+            .outerjoin(unfolded, unfolded.c.table_uuid == row_counts.table_uuid)
+            .where(row_counts.table_uuid.in_(table_uuids))
+        )
+        return {
+            table_uuid: (RowCount(int(row_count), int(row_count)), version, latest)
+            for table_uuid, row_count, version, latest in self.sesh.execute(stmt)
+        }
+
+    def fold_changes(self, table_uuid: Optional[UUID] = None) -> List[UUID]:
+        """Fold the logged changes to the rows of a table (or of every table)
+        into its row count and version.  Returns the uuids of the tables that
+        had changes.
+
+        Changes committed while this runs are left for next time, and
+        concurrent folds don't count anything twice because each change is
+        deleted by only one of them.
+
+        """
+        where = "" if table_uuid is None else "WHERE table_uuid = :table_uuid"
+        stmt = text(
+            f"""
+        WITH folded AS (
+            DELETE FROM metadata.table_changes
+            {where}
+            RETURNING table_uuid, version, row_count_change, changed
+        ), totals AS (
+            SELECT
+                table_uuid,
+                sum(row_count_change) AS row_count_change,
+                max(version) AS version,
+                max(changed) AS changed
+            FROM folded
+            GROUP BY table_uuid
+        )
+        UPDATE metadata.row_counts AS rc
+        SET row_count = rc.row_count + totals.row_count_change,
+            version = greatest(rc.version, totals.version),
+            data_changed = greatest(rc.data_changed, totals.changed)
+        FROM totals
+        WHERE rc.table_uuid = totals.table_uuid
+        RETURNING rc.table_uuid
+        """
         )
-        exact, approx = cast(
-            Tuple[Optional[int], int],
-            self.sesh.execute(RowCountStatement(tableclause)).fetchone(),
+        return list(self.sesh.execute(stmt, dict(table_uuid=table_uuid)).scalars())
+
+    def _remembered_columns(self) -> Dict[UUID, List[Column]]:
+        return self.sesh.info.setdefault(_COLUMNS_KEY, {})
+
+    def remember_columns(self, table_uuid: UUID, columns: Sequence[Column]) -> None:
+        """Remember the columns of a table (eg: from its metadata) for the rest
+        of the transaction, so that they need not be looked up again."""
+        self._remembered_columns()[table_uuid] = list(columns)
+
+    def _forget_columns(self, table_uuid: UUID) -> None:
+        self._remembered_columns().pop(table_uuid, None)
+
+    def get_columns_many(self, table_uuids: Sequence[UUID]) -> Dict[UUID, List[Column]]:
+        """Get the columns of many tables at once, in a single query."""
+        remembered = self._remembered_columns()
+        rv: Dict[UUID, List[Column]] = {
+            table_uuid: list(remembered[table_uuid])
+            for table_uuid in table_uuids
+            if table_uuid in remembered
+        }
+        names = {
+            self._make_userdata_table_name(table_uuid, with_schema=True): table_uuid
+            for table_uuid in table_uuids
+            if table_uuid not in rv
+        }
+        if len(names) == 0:
+            return rv
+        stmt = text(
+            """
+        SELECT names.table_name, attname AS column_name, atttypid::regtype AS sql_type
+        FROM   unnest(CAST(:table_names AS text[])) AS names(table_name)
+        JOIN   pg_attribute ON attrelid = to_regclass(names.table_name)
+        WHERE  attnum > 0
+        AND    NOT attisdropped
+        ORDER  BY names.table_name, attnum
+        """
         )
-        return RowCount(exact, approx)
+        loaded: Dict[UUID, List[Column]] = {
+            table_uuid: [] for table_uuid in names.values()
+        }
+        for table_name, name, sql_type in self.sesh.execute(
+            stmt, {"table_names": list(names)}
+        ):
+            loaded[names[table_name]].append(
+                Column(name=name, type_=ColumnType.from_sql_type(sql_type))
+            )
+        for table_uuid, columns in loaded.items():
+            self.remember_columns(table_uuid, columns)
+        rv.update(loaded)
+        return rv
 
     def get_columns(self, table_uuid: UUID) -> List["Column"]:
+        remembered = self._remembered_columns()
+        if table_uuid in remembered:
+            return list(remembered[table_uuid])
+
         # lifted from https://dba.stackexchange.com/a/22420/28877
         attrelid = self._make_userdata_table_name(table_uuid, with_schema=True)
         stmt = text(
@@ -134,7 +452,8 @@ class PGUserdataAdapter:
         rv = []
         for name, sql_type in rs:
             rv.append(Column(name=name, type_=ColumnType.from_sql_type(sql_type)))
-        return rv
+        self.remember_columns(table_uuid, rv)
+        return list(rv)
 
     def get_row(self, table_uuid: UUID, row_id: int) -> Optional[Row]:
         columns = self.get_columns(table_uuid)
@@ -194,6 +513,7 @@ class PGUserdataAdapter:
             return {c: row._mapping[c.name] for c in columns}
 
     def insert_row(self, table_uuid: UUID, row: Row) -> int:
+        invalidate_table(self.sesh, table_uuid)
         table = self._get_userdata_tableclause(table_uuid)
         values = {c.name: v for c, v in row.items()}
         stmt: ReturningInsert[Tuple[int]] = (
@@ -208,6 +528,7 @@ class PGUserdataAdapter:
         row: Row,
     ) -> bool:
         """Update a given row, returning True if it existed (and was updated) and False otherwise."""
+        invalidate_table(self.sesh, table_uuid)
         table = self._get_userdata_tableclause(table_uuid)
         values = {c.name: v for c, v in row.items()}
         result = self.sesh.execute(
@@ -217,83 +538,328 @@ class PGUserdataAdapter:
 
     def delete_row(self, table_uuid: UUID, row_id: int) -> bool:
         """Update a given row, returning True if it existed (and was updated) and False otherwise."""
+        invalidate_table(self.sesh, table_uuid)
         table = self._get_userdata_tableclause(table_uuid)
         result = self.sesh.execute(
             table.delete().where(table.c.csvbase_row_id == row_id)
         )
         return result.rowcount > 0
 
-    def table_page(self, table: Table, keyset: KeySet) -> Page:
-        """Get a page from a table based on the provided KeySet"""
-        table_clause = self._get_userdata_tableclause(table.table_uuid)
-        key_names = [col.name for col in keyset.columns]
-        table_vals = satuple(
-            table_clause.c.csvbase_row_id,
-        )
-        keyset_vals = satuple(*keyset.values)
-        if keyset.op == "greater_than":
-            where_cond = table_vals > keyset_vals
-        else:
-            where_cond = table_vals < keyset_vals
-
-        keyset_page = table_clause.select().where(where_cond).limit(keyset.size)
-
-        if keyset.op == "greater_than":
-            keyset_page = keyset_page.order_by(table_vals)
-        else:
-            # if we're going backwards we need to reverse the order via a subquery
-            keyset_page = keyset_page.order_by(table_vals.desc())
-            keyset_sub = select(keyset_page.alias())
-            keyset_page = keyset_sub.order_by(*key_names)
+    def apply_row_operations(
+        self, table_uuid: UUID, operations: Iterable[RowOperation]
+    ) -> List[RowOperationResult]:
+        """Apply a batch of row operations, in order.
 
-        row_tuples = list(self.sesh.execute(keyset_page))
+        Consecutive operations of the same kind (and on different rows) are
+        done together, in one statement each.
 
-        if len(row_tuples) > 1:
-            first_row = row_tuples[0]
-            last_row = row_tuples[-1]
-
-            has_more_vals = satuple(
-                *[getattr(last_row, colname) for colname in key_names]
+        """
+        invalidate_table(self.sesh, table_uuid)
+        table = self._get_userdata_tableclause(table_uuid)
+        results: List[RowOperationResult] = []
+        run: List[RowOperation] = []
+        run_row_ids: Set[int] = set()
+        for operation in operations:
+            if len(run) > 0 and (
+                operation.op != run[0].op
+                or operation.row_id in run_row_ids
+                or len(run) >= ROW_OPERATIONS_PER_STATEMENT
+            ):
+                results.extend(self._apply_row_operation_run(table, run))
+                run = []
+                run_row_ids.clear()
+            run.append(operation)
+            if operation.row_id is not None:
+                run_row_ids.add(operation.row_id)
+        if len(run) > 0:
+            results.extend(self._apply_row_operation_run(table, run))
+        return results
+
+    def _apply_row_operation_run(
+        self, table: TableClause, run: List[RowOperation]
+    ) -> List[RowOperationResult]:
+        op = run[0].op
+        row_id_column = table.c.csvbase_row_id
+        if op == "create":
+            # the ids are taken up front so that they can be matched up with
+            # the rows
+            row_ids = sorted(
+                self.sesh.execute(
+                    select(
+                        func.nextval(
+                            func.pg_get_serial_sequence(
+                                table.fullname, "csvbase_row_id"
+                            )
+                        )
+                    ).select_from(func.generate_series(1, len(run)))
+                ).scalars()
             )
-            has_more_q = (
-                table_clause.select().where(table_vals > has_more_vals).exists()
+            self.sesh.execute(
+                table.insert().values(
+                    [
+                        {
+                            "csvbase_row_id": row_id,
+                            **{c.name: v for c, v in cast(Row, o.row).items()},
+                        }
+                        for row_id, o in zip(row_ids, run)
+                    ]
+                )
             )
-            has_more = self.sesh.query(has_more_q).scalar()
-            has_less_vals = satuple(
-                *[getattr(first_row, colname) for colname in key_names]
+            return [RowOperationResult(op, row_id, True) for row_id in row_ids]
+        elif op == "update":
+            columns = list(cast(Row, run[0].row).keys())
+            batch = (
+                sa_values(
+                    sacolumn("csvbase_row_id", satypes.BigInteger),
+                    *[sacolumn(c.name, c.type_.sqla_type()) for c in columns],
+                    name="batch",
+                )
+                .data(
+                    [(o.row_id, *[cast(Row, o.row)[c] for c in columns]) for o in run]
+                )
+                .alias("batch")
             )
-            has_less_q = (
-                table_clause.select().where(table_vals < has_less_vals).exists()
+            # the types of (eg: all null) columns of a VALUES list can't
+            # always be inferred, so they are cast
+            update_stmt = (
+                table.update()
+                .where(row_id_column == batch.c.csvbase_row_id)
+                .values(
+                    {
+                        c.name: sacast(batch.c[c.name], c.type_.sqla_type())
+                        for c in columns
+                    }
+                )
+                .returning(row_id_column)
             )
-            has_less = self.sesh.query(has_less_q).scalar()
+            changed = set(self.sesh.execute(update_stmt).scalars())
         else:
-            if keyset.op == "greater_than":
-                has_more = False
-                has_less = self.sesh.query(
-                    table_clause.select().where(table_vals < keyset_vals).exists()
-                ).scalar()
-            else:
-                has_more = self.sesh.query(
-                    table_clause.select().where(table_vals > keyset_vals).exists()
-                ).scalar()
-                has_less = False
+            delete_stmt = (
+                table.delete()
+                .where(row_id_column.in_([o.row_id for o in run]))
+                .returning(row_id_column)
+            )
+            changed = set(self.sesh.execute(delete_stmt).scalars())
+        return [
+            RowOperationResult(op, cast(int, o.row_id), o.row_id in changed)
+            for o in run
+        ]
+
+    def table_page(self, table: Table, keyset: KeySet) -> Page:
+        """Get a page from a table based on the provided KeySet.
+
+        This is one query: the page is outer joined onto the first and last
+        keys in the table, which tell whether there are rows either side of
+        it.
+
+        When sorting by a column, rows where that column is null come last
+        (after all the others, in row id order).
+
+        """
+        table_clause = self._get_tableclause(
+            self._make_userdata_table_name(table.table_uuid),
+            table.columns,
+            schema="userdata",
+        )
+        key_columns = [table_clause.c[c.name] for c in keyset.columns]
+        conditions = [
+            self._filter_condition(table_clause, binary_filter)
+            for binary_filter in keyset.filters
+        ]
+        # postgres sorts nulls last in ascending order (and first in
+        # descending) which is what is wanted, but they need handling
+        # specially when comparing keys
+        op: Literal[">", "<"] = ">" if keyset.op == "greater_than" else "<"
+        if len(keyset.values) > 0:
+            keyset_conditions = _keyset_conditions(key_columns, keyset.values, op)
+        else:
+            keyset_conditions = [true()]
+
+        def ordered(columns: Sequence[ColumnElement]) -> List[ColumnElement]:
+            return list(columns) if op == ">" else [c.desc() for c in columns]
+
+        segments = [
+            table_clause.select()
+            .where(*conditions, keyset_condition)
+            .order_by(*ordered(key_columns))
+            .limit(keyset.size)
+            for keyset_condition in keyset_conditions
+        ]
+        if len(segments) == 1:
+            page = segments[0]
+        else:
+            # each segment is a page of its own, and the page is the first of
+            # them all
+            segments_sub = union_all(*segments).subquery("segments")
+            page = (
+                select(segments_sub)
+                .order_by(*ordered([segments_sub.c[c.name] for c in keyset.columns]))
+                .limit(keyset.size)
+            )
+        page_sub = page.subquery("page")
+
+        # csvbase_ prefixed, so these can't clash with user columns
+        first_key = select(*key_columns).where(*conditions).order_by(*key_columns)
+        last_key = first_key.order_by(None).order_by(*[c.desc() for c in key_columns])
+        bounds = select(
+            *[
+                first_key.with_only_columns(c)
+                .limit(1)
+                .scalar_subquery()
+                .label(f"csvbase_first_{i}")
+                for i, c in enumerate(key_columns)
+            ],
+            *[
+                last_key.with_only_columns(c)
+                .limit(1)
+                .scalar_subquery()
+                .label(f"csvbase_last_{i}")
+                for i, c in enumerate(key_columns)
+            ],
+        ).subquery("bounds")
+        stmt = (
+            select(bounds, page_sub)
+            .select_from(bounds.outerjoin(page_sub, true()))
+            .order_by(*[page_sub.c[c.name] for c in keyset.columns])
+        )
+        row_tuples = list(self.sesh.execute(stmt))
+        mapping = row_tuples[0]._mapping
+        table_first_key = tuple(
+            mapping[f"csvbase_first_{i}"] for i in range(len(key_columns))
+        )
+        table_last_key = tuple(
+            mapping[f"csvbase_last_{i}"] for i in range(len(key_columns))
+        )
 
         rows = [
             {c: row_tup._mapping[c.name] for c in table.columns}
             for row_tup in row_tuples
+            # the page was empty
+            if row_tup.csvbase_row_id is not None
         ]
+        if len(rows) > 0:
+            # keys are unique, so (and as python doesn't know the collation
+            # order of text) just check whether the page has the ends
+            has_less = table_first_key != tuple(rows[0][c] for c in keyset.columns)
+            has_more = table_last_key != tuple(rows[-1][c] for c in keyset.columns)
+        else:
+            # off one end, or the table (after filtering) is empty
+            is_empty = table_first_key[-1] is None
+            has_less = keyset.op == "greater_than" and not is_empty
+            has_more = keyset.op == "less_than" and not is_empty
+
+        return Page(has_less=has_less, has_more=has_more, rows=rows)
+
+    def _filter_condition(
+        self, table_clause: TableClause, binary_filter: BinaryFilter
+    ) -> ColumnElement[bool]:
+        lhs = table_clause.c[binary_filter.lhs.name]
+        return FILTER_OPERATORS[binary_filter.op](lhs, binary_filter.rhs)
+
+    def note_column_use(self, table: Table, column: Column) -> bool:
+        """Count a sort or filter by a column of a table, returning True when
+        that has happened often enough that an index should be built.
+
+        Small tables are quick enough to sort without one.  Once a column is
+        indexed (or is about to be) it is no longer counted, so that reads stop
+        writing.
+
+        """
+        if (
+            table.row_count.best() < COLUMN_INDEX_MIN_ROWS
+            or column in table.indexed_columns
+        ):
+            return False
+        insert_stmt = pg_insert(models.ColumnUse).values(
+            table_uuid=table.table_uuid, column_name=column.name, uses=1
+        )
+        stmt = insert_stmt.on_conflict_do_update(
+            index_elements=[models.ColumnUse.table_uuid, models.ColumnUse.column_name],
+            set_={"uses": models.ColumnUse.uses + 1},
+            where=models.ColumnUse.uses < COLUMN_INDEX_THRESHOLD,
+        ).returning(models.ColumnUse.uses)
+        # counted outside of the session's transaction, which readers roll
+        # back, and so that the row lock is only held for this statement
+        with self._autocommit_connection() as conn:
+            uses = conn.execute(stmt).scalar_one_or_none()
+        return uses == COLUMN_INDEX_THRESHOLD
+
+    @contextmanager
+    def _autocommit_connection(self) -> Iterator[Connection]:
+        with self.sesh.get_bind().engine.connect() as conn:
+            yield conn.execution_options(isolation_level="AUTOCOMMIT")
+
+    def _column_index_name(self, table_uuid: UUID, column_name: str) -> str:
+        # column names are too long (and too varied) to go into the name
+        digest = hashlib.md5(column_name.encode("utf-8")).hexdigest()[:8]
+        return f"{self._make_userdata_table_name(table_uuid)}_{digest}"
+
+    def create_column_index(self, table_uuid: UUID, column_name: str) -> None:
+        """Create (if it doesn't already exist) an index for sorting and
+        filtering by a column, and record that it exists.
+
+        The index is built concurrently, so writes to the table carry on while
+        it is, but the build waits for any transaction that is already open -
+        so the session must not have begun one.
+
+        """
+        index_name = self._column_index_name(table_uuid, column_name)
+        with self._autocommit_connection() as conn:
+            # a concurrent build that failed leaves an invalid index behind,
+            # which IF NOT EXISTS would otherwise take as done
+            is_valid = conn.execute(
+                text(
+                    "SELECT indisvalid FROM pg_index"
+                    " WHERE indexrelid = to_regclass(:index_name)"
+                ),
+                {"index_name": f"userdata.{index_name}"},
+            ).scalar_one_or_none()
+            if is_valid is False:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY userdata.{index_name}"))
+            conn.execute(
+                self._create_column_index_stmt(
+                    table_uuid, column_name, concurrently=True
+                )
+            )
+        self.sesh.execute(
+            pg_insert(models.ColumnIndex)
+            .values(table_uuid=table_uuid, column_name=column_name)
+            .on_conflict_do_nothing()
+        )
+        # the indexed columns are part of the table's metadata
+        invalidate_table(self.sesh, table_uuid)
+
+    def _create_column_index_stmt(
+        self, table_uuid: UUID, column_name: str, concurrently: bool = False
+    ) -> TextClause:
+        quote = self.sesh.get_bind().dialect.identifier_preparer.quote
+        index_name = self._column_index_name(table_uuid, column_name)
+        table_name = self._make_userdata_table_name(table_uuid, with_schema=True)
+        return text(
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS {index_name} ON {table_name}"
+            f" ({quote(column_name)}, csvbase_row_id)"
+        )
 
-        return Page(
-            has_less=has_less,
-            has_more=has_more,
-            rows=rows[: keyset.size],
+    def column_indexes(self, table_uuid: UUID) -> List[str]:
+        """Return the names of the columns that have been indexed."""
+        return list(
+            self.sesh.execute(
+                select(models.ColumnIndex.column_name)
+                .where(models.ColumnIndex.table_uuid == table_uuid)
+                .order_by(models.ColumnIndex.column_name)
+            ).scalars()
         )
 
     def table_as_rows(
         self,
         table_uuid: UUID,
     ) -> Iterable[Sequence[PythonType]]:
-        # To a first approximation this is about 10 times slower than COPY
+        # The raw COPY of a table is about twice as fast as this, but decoding
+        # COPY's binary format in python costs more than it saves: psycopg2
+        # parses the text protocol in C.  See benchmarks/table_as_rows.py.
+        # Formats which can be produced without python rows should use COPY
+        # directly.
 
         batchsize = 10_000
         table_clause = self._get_userdata_tableclause(table_uuid)
@@ -305,21 +871,58 @@ class PGUserdataAdapter:
         )
         yield from self.sesh.execute(q)
 
+    def table_as_record_batches(
+        self, table_uuid: UUID
+    ) -> Generator[pa.RecordBatch, None, None]:
+        """Return the table as arrow record batches.
+
+        Postgres COPYs the table out as csv and pyarrow parses it, so no python
+        objects are made for each cell.  The COPY is streamed into the parser
+        as it arrives (see _CopyOut), so the first batch comes back straight
+        away and memory usage is bounded no matter the size of the table.
+
+        """
+        columns = self.get_columns(table_uuid)
+        table_clause = self._get_tableclause(
+            self._make_userdata_table_name(table_uuid), columns, schema="userdata"
+        )
+        q = select(*[getattr(table_clause.c, c.name) for c in columns]).order_by(
+            table_clause.c.csvbase_row_id
+        )
+        compiled_q = q.compile(dialect=self.sesh.get_bind().dialect)
+        schema = arrow_schema(columns)
+        raw_conn = self.sesh.connection().connection
+        copy_out = _CopyOut(raw_conn, f"COPY ({compiled_q}) TO STDOUT (FORMAT csv)")
+        with closing(copy_out):
+            chunks = copy_out.chunks()
+            first_chunk = next(chunks, None)
+            if first_chunk is None:
+                # pyarrow refuses to read an empty file
+                return
+            reader = pacsv.open_csv(
+                IterableReader(itertools.chain([first_chunk], chunks)),
+                read_options=pacsv.ReadOptions(column_names=schema.names),
+                parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                convert_options=pacsv.ConvertOptions(
+                    column_types=schema,
+                    true_values=["t"],
+                    false_values=["f"],
+                    # in postgres' csv, null is an empty field and the empty
+                    # string is a quoted empty field
+                    null_values=[""],
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            yield from reader
+
     def insert_table_data(
         self,
         table: Table,
         columns: Sequence[Column],
         rows: Iterable[Sequence[PythonType]],
     ) -> None:
-        temp_table_name = self._make_temp_table_name(prefix="insert")
-        main_table_name = self._make_userdata_table_name(
-            table.table_uuid, with_schema=True
-        )
-        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
-        self.sesh.execute(
-            CreateTempTableLike(satable(temp_table_name), main_tableclause)
-        )
-
+        temp_table_name = self._create_insert_temp_table(table)
         raw_conn = self.sesh.connection().connection
         column_names = [c.name for c in columns]
         copy_manager = CopyManager(
@@ -328,7 +931,65 @@ class PGUserdataAdapter:
             column_names,
         )
         copy_manager.copy(rows)
+        self._insert_from_temp_table(table, column_names, temp_table_name)
 
+    def insert_record_batches(
+        self,
+        table: Table,
+        columns: Sequence[Column],
+        record_batches: Iterable[pa.RecordBatch],
+    ) -> None:
+        """As insert_table_data, but for arrow record batches."""
+        temp_table_name = self._create_insert_temp_table(table)
+        self._copy_record_batches(temp_table_name, columns, record_batches)
+        self._insert_from_temp_table(table, [c.name for c in columns], temp_table_name)
+
+    def _copy_record_batches(
+        self,
+        temp_table_name: str,
+        columns: Sequence[Column],
+        record_batches: Iterable[pa.RecordBatch],
+    ) -> None:
+        """COPY arrow record batches into a (temp) table.
+
+        The batches are written out as csv by pyarrow and streamed into a
+        single COPY, so no python objects are made for each cell.
+
+        """
+        raw_conn = self.sesh.connection().connection
+        quote = self.sesh.get_bind().dialect.identifier_preparer.quote
+        copy_stmt = "COPY {} ({}) FROM STDIN (FORMAT csv)".format(
+            quote(temp_table_name), ", ".join(quote(c.name) for c in columns)
+        )
+        write_options = pacsv.WriteOptions(include_header=False)
+
+        def csv_chunks() -> Iterable[bytes]:
+            for record_batch in record_batches:
+                csv_buf = io.BytesIO()
+                pacsv.write_csv(record_batch, csv_buf, write_options)
+                yield csv_buf.getvalue()
+
+        with closing(raw_conn.cursor()) as cursor:
+            cursor.copy_expert(
+                copy_stmt, IterableReader(csv_chunks()), size=COPY_BUFFER_SIZE
+            )
+
+    def _create_insert_temp_table(self, table: Table) -> str:
+        invalidate_table(self.sesh, table.table_uuid)
+        temp_table_name = self._make_temp_table_name(prefix="insert")
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
+        self.sesh.execute(
+            CreateTempTableLike(satable(temp_table_name), main_tableclause)
+        )
+        return temp_table_name
+
+    def _insert_from_temp_table(
+        self, table: Table, column_names: Sequence[str], temp_table_name: str
+    ) -> None:
+        main_table_name = self._make_userdata_table_name(
+            table.table_uuid, with_schema=True
+        )
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
         temp_tableclause = self._get_tableclause(temp_table_name, table.columns)
 
         add_stmt_select_columns = [getattr(temp_tableclause.c, c) for c in column_names]
@@ -375,6 +1036,7 @@ class PGUserdataAdapter:
         The csvbase_row_id sequence is not reset in this case to avoid confusion.
 
         """
+        invalidate_table(self.sesh, table.table_uuid)
         main_tableclause = self._get_userdata_tableclause(table.table_uuid)
         main_fullname = main_tableclause.fullname
         # FIXME: should consider DELETE if table is small - that's faster in
@@ -382,11 +1044,120 @@ class PGUserdataAdapter:
         truncate_stmt = text(f"TRUNCATE {main_fullname};")
         self.sesh.execute(truncate_stmt)
 
+    def replace_record_batches(
+        self,
+        table: Table,
+        columns: Sequence[Column],
+        record_batches: Iterable[pa.RecordBatch],
+    ) -> None:
+        """Replace all data in the table with the record batches.
+
+        The new data is loaded into a shadow table which is then renamed into
+        place, so readers only wait for the swap and not for the load.  As
+        with delete_table_data, the csvbase_row_id sequence is not reset.
+
+        """
+        invalidate_table(self.sesh, table.table_uuid)
+        shadow_table = dataclasses.replace(table, table_uuid=uuid4())
+        self.create_table(shadow_table.table_uuid, table.columns)
+
+        main_table_name = self._make_userdata_table_name(
+            table.table_uuid, with_schema=True
+        )
+        shadow_table_name = self._make_userdata_table_name(
+            shadow_table.table_uuid, with_schema=True
+        )
+        main_seq, shadow_seq = (
+            cast(
+                str,
+                self.sesh.execute(
+                    select(func.pg_get_serial_sequence(name, "csvbase_row_id"))
+                ).scalar(),
+            )
+            for name in [main_table_name, shadow_table_name]
+        )
+        self.sesh.execute(
+            text(
+                f"SELECT setval('{shadow_seq}', last_value, is_called) FROM {main_seq}"
+            )
+        )
+        self.insert_record_batches(shadow_table, columns, record_batches)
+        # indexes are quicker to build after the load than to maintain during it
+        indexed_columns = self.column_indexes(table.table_uuid)
+        for column_name in indexed_columns:
+            # no one else can see the shadow table, so no need for concurrently
+            self.sesh.execute(
+                self._create_column_index_stmt(shadow_table.table_uuid, column_name)
+            )
+
+        # nothing up to here blocks readers of the main table.  its key index
+        # (if any) goes with it, and is recreated by the next upsert
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
+        self.sesh.execute(DropTable(main_tableclause))  # type: ignore
+        main_name = self._make_userdata_table_name(table.table_uuid)
+        self.sesh.execute(
+            text(f"ALTER TABLE {shadow_table_name} RENAME TO {main_name}")
+        )
+        self._forget_columns(shadow_table.table_uuid)
+        self.sesh.execute(
+            text(f"ALTER INDEX {shadow_table_name}_pkey RENAME TO {main_name}_pkey")
+        )
+        for column_name in indexed_columns:
+            shadow_index = self._column_index_name(shadow_table.table_uuid, column_name)
+            main_index = self._column_index_name(table.table_uuid, column_name)
+            self.sesh.execute(
+                text(f"ALTER INDEX userdata.{shadow_index} RENAME TO {main_index}")
+            )
+        self.sesh.execute(
+            text(
+                f"ALTER SEQUENCE {shadow_seq} RENAME TO {main_name}_csvbase_row_id_seq"
+            )
+        )
+        # the triggers now count for the main table, so should its count
+        self.sesh.execute(
+            delete(models.TableRowCount).where(
+                models.TableRowCount.table_uuid == table.table_uuid
+            )
+        )
+        self.sesh.execute(
+            update(models.TableRowCount)
+            .where(models.TableRowCount.table_uuid == shadow_table.table_uuid)
+            .values(table_uuid=table.table_uuid)
+        )
+        # as should its unfolded changes
+        self.sesh.execute(
+            delete(models.TableChange).where(
+                models.TableChange.table_uuid == table.table_uuid
+            )
+        )
+        self.sesh.execute(
+            update(models.TableChange)
+            .where(models.TableChange.table_uuid == shadow_table.table_uuid)
+            .values(table_uuid=table.table_uuid)
+        )
+
     def drop_table(self, table_uuid: UUID) -> None:
+        invalidate_table(self.sesh, table_uuid)
         sa_table = self._get_userdata_tableclause(table_uuid)
         self.sesh.execute(DropTable(sa_table))  # type: ignore
+        self._forget_columns(table_uuid)
+        self.sesh.execute(
+            delete(models.TableRowCount).where(
+                models.TableRowCount.table_uuid == table_uuid
+            )
+        )
+        self.sesh.execute(
+            delete(models.TableChange).where(
+                models.TableChange.table_uuid == table_uuid
+            )
+        )
+        self.sesh.execute(
+            delete(models.ColumnUse).where(models.ColumnUse.table_uuid == table_uuid)
+        )
 
     def create_table(self, table_uuid: UUID, columns: Iterable[Column]) -> UUID:
+        invalidate_table(self.sesh, table_uuid)
+        self._forget_columns(table_uuid)
         cols: List[SAColumn] = [
             SAColumn(
                 "csvbase_row_id", satypes.BigInteger, Identity(), primary_key=True
@@ -419,9 +1190,38 @@ class PGUserdataAdapter:
             schema="userdata",
         )
         self.sesh.execute(CreateTable(table))
+        self._create_row_count_triggers(table_uuid)
         return table_uuid
 
+    def _create_row_count_triggers(self, table_uuid: UUID) -> None:
+        """Count the rows of a new table in metadata.row_counts, via triggers.
+        The triggers log each change to metadata.table_changes, which gives
+        the table a new version (see fold_changes).
+
+        The triggers are statement-level, so bulk loads are counted once per
+        statement rather than once per row.
+
+        """
+        table_name = self._make_userdata_table_name(table_uuid, with_schema=True)
+        for trigger_name, trigger_event, referencing in [
+            ("count_inserts", "INSERT", "REFERENCING NEW TABLE AS new_rows"),
+            ("count_deletes", "DELETE", "REFERENCING OLD TABLE AS old_rows"),
+            ("count_truncates", "TRUNCATE", ""),
+            ("version_updates", "UPDATE", "REFERENCING NEW TABLE AS new_rows"),
+        ]:
+            self.sesh.execute(
+                text(
+                    f"CREATE TRIGGER {trigger_name} AFTER {trigger_event} ON {table_name}"
+                    f" {referencing} FOR EACH STATEMENT"
+                    " EXECUTE FUNCTION metadata.count_userdata_rows()"
+                )
+            )
+        self.sesh.execute(
+            pg_insert(models.TableRowCount).values(table_uuid=table_uuid, row_count=0)
+        )
+
     def copy_table_data(self, from_table_uuid: UUID, to_table_uuid: UUID) -> None:
+        invalidate_table(self.sesh, to_table_uuid)
         from_tableclause = self._get_userdata_tableclause(from_table_uuid)
         to_tableclause = self._get_userdata_tableclause(to_table_uuid)
         stmt = to_tableclause.insert().from_select(
@@ -430,61 +1230,323 @@ class PGUserdataAdapter:
         self.sesh.execute(stmt)
         self._reset_pk_sequence(to_tableclause)
 
-    # FIXME: this is "replace", not "upsert"
     def upsert_table_data(
         self,
         table: Table,
         row_columns: Sequence[Column],
         rows: Iterable[Sequence[PythonType]],
         key: Sequence[Column] = (ROW_ID_COLUMN,),
-    ) -> None:
+        delete_missing: bool = True,
+    ) -> UpsertCounts:
         """Upsert table data from rows into the SQL table.
 
+        Rows are correlated with existing rows by the key (by default, the
+        csvbase_row_id column).  Only rows that have actually changed are
+        updated.  If delete_missing is set, existing rows that aren't among
+        the new rows are deleted (ie: the table is replaced).
+
         Note that the columns being upserted can be a subset of the columns
-        that are present in the SQL table.  If the csvbase_row_id column is
-        present, it will be used to correlate changes.
+        that are present in the SQL table.
+
+        Returns counts of what happened to the rows.
 
         """
 
         # First, make a temp table and COPY the new rows into it
-        temp_table_name = self._make_temp_table_name(prefix="upsert")
-        main_table_name = self._make_userdata_table_name(
-            table.table_uuid, with_schema=True
-        )
-        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
-        self.sesh.execute(
-            CreateTempTableLike(satable(temp_table_name), main_tableclause)
-        )
+        temp_table_name = self._create_upsert_temp_table(table)
         raw_conn = self.sesh.connection().connection
         upsert_column_names = [c.name for c in row_columns]
-        existing_column_names = [c.name for c in table.columns]
         copy_manager = CopyManager(raw_conn, temp_table_name, upsert_column_names)
         copy_manager.copy(rows)
 
         # Next selectively use the temp table to update the 'main' one
-        temp_tableclause = self._get_tableclause(temp_table_name, table.columns)
+        return self._upsert_from_temp_table(table, temp_table_name, key, delete_missing)
 
+    def upsert_record_batches(
+        self,
+        table: Table,
+        row_columns: Sequence[Column],
+        record_batches: Iterable[pa.RecordBatch],
+        key: Sequence[Column] = (ROW_ID_COLUMN,),
+        delete_missing: bool = True,
+    ) -> UpsertCounts:
+        """As upsert_table_data, but for arrow record batches."""
+        temp_table_name = self._create_upsert_temp_table(table)
+        self._copy_record_batches(temp_table_name, row_columns, record_batches)
+        return self._upsert_from_temp_table(table, temp_table_name, key, delete_missing)
+
+    def _create_upsert_temp_table(self, table: Table) -> str:
+        invalidate_table(self.sesh, table.table_uuid)
+        temp_table_name = self._make_temp_table_name(prefix="upsert")
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
+        self.sesh.execute(
+            CreateTempTableLike(satable(temp_table_name), main_tableclause)
+        )
+        return temp_table_name
+
+    def _prepare_staging_table(
+        self, temp_tableclause: TableClause, key: Sequence[Column]
+    ) -> int:
+        """Get a freshly loaded staging table ready to be joined against the
+        main table, returning the number of rows in it.
+
+        Temp tables are never analyzed by autovacuum, so without this the
+        planner has no idea how big it is.
+
+        """
+        quote = self.sesh.get_bind().dialect.identifier_preparer.quote
+        temp_table_name = quote(temp_tableclause.name)
+        self.sesh.execute(text(f"ANALYZE {temp_table_name}"))
+        row_count = cast(
+            int,
+            self.sesh.execute(
+                select(func.count()).select_from(temp_tableclause)
+            ).scalar(),
+        )
+        if row_count > STAGING_INDEX_THRESHOLD:
+            self.sesh.execute(
+                text(
+                    f"CREATE INDEX ON {temp_table_name}"
+                    f" ({', '.join(quote(c.name) for c in key)})"
+                )
+            )
+
+        work_mem = get_config().upsert_work_mem
+        if work_mem is not None:
+            # only for the rest of this transaction
+            self.sesh.execute(
+                text("SELECT set_config('work_mem', :work_mem, true)"),
+                {"work_mem": work_mem},
+            )
+        return row_count
+
+    def _upsert_from_temp_table(
+        self,
+        table: Table,
+        temp_table_name: str,
+        key: Sequence[Column],
+        delete_missing: bool,
+    ) -> UpsertCounts:
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
+        temp_tableclause = self._get_tableclause(temp_table_name, table.columns)
         join_clause = [
             (main_tableclause.c[key_column.name] == temp_tableclause.c[key_column.name])
             for key_column in key
         ]
 
-        # 1. for removals
-        ids_to_delete = (
-            select(main_tableclause.c.csvbase_row_id)
-            .select_from(
-                main_tableclause.outerjoin(
-                    temp_tableclause,
-                    and_(*join_clause),
+        row_count = self._prepare_staging_table(temp_tableclause, key)
+
+        deleted = 0
+        if delete_missing:
+            ids_to_delete = (
+                select(main_tableclause.c.csvbase_row_id)
+                .select_from(
+                    main_tableclause.outerjoin(
+                        temp_tableclause,
+                        and_(*join_clause),
+                    )
+                )
+                .where(temp_tableclause.c[key[0].name].is_(None))
+            )
+            deleted = self.sesh.execute(
+                delete(main_tableclause).where(
+                    main_tableclause.c.csvbase_row_id.in_(ids_to_delete)
+                )
+            ).rowcount
+
+        if list(key) == [ROW_ID_COLUMN]:
+            inserted, updated = self._merge_by_row_id(
+                table, main_tableclause, temp_tableclause
+            )
+        elif self.create_key_index(table.table_uuid, key):
+            try:
+                with self.sesh.begin_nested():
+                    inserted, updated = self._merge_by_key(
+                        table, main_tableclause, temp_tableclause, key, join_clause
+                    )
+            except ProgrammingError:
+                # the new rows have duplicate keys, so they can't be upserted
+                # and the key index can't be kept
+                logger.warning("duplicate keys in %s, replacing instead", table.ref())
+                self.sesh.execute(
+                    text(f"DROP INDEX {self._key_index_name(table.table_uuid)}")
+                )
+                inserted, updated = self._replace_from_temp_table(
+                    table, temp_table_name, key
                 )
+        else:
+            inserted, updated = self._replace_from_temp_table(
+                table, temp_table_name, key
             )
-            .where(temp_tableclause.c[key[0].name].is_(None))
+
+        counts = UpsertCounts(
+            inserted=inserted,
+            updated=updated,
+            deleted=deleted,
+            # the new rows can contain duplicate keys, so don't go negative
+            unchanged=max(row_count - inserted - updated, 0),
         )
-        remove_stmt = delete(main_tableclause).where(
-            main_tableclause.c.csvbase_row_id.in_(ids_to_delete)
+        logger.info("upserted %s: %s", table.ref(), counts)
+        return counts
+
+    def _merge_by_row_id(
+        self,
+        table: Table,
+        main_tableclause: TableClause,
+        temp_tableclause: TableClause,
+    ) -> Tuple[int, int]:
+        # rows with a csvbase_row_id are upserted...
+        inserted, updated = self._execute_merge(
+            self._merge_stmt(
+                table,
+                main_tableclause,
+                [ROW_ID_COLUMN],
+                select(*[temp_tableclause.c[c.name] for c in table.columns]).where(
+                    temp_tableclause.c.csvbase_row_id.is_not(None)
+                ),
+            )
         )
+        self._reset_pk_sequence(main_tableclause)
+
+        # ...and those without are new
+        user_column_names = [c.name for c in table.user_columns()]
+        inserted += self.sesh.execute(
+            main_tableclause.insert().from_select(
+                user_column_names,
+                select(*[temp_tableclause.c[name] for name in user_column_names]).where(
+                    temp_tableclause.c.csvbase_row_id.is_(None)
+                ),
+            )
+        ).rowcount
+        return inserted, updated
+
+    def _merge_by_key(
+        self,
+        table: Table,
+        main_tableclause: TableClause,
+        temp_tableclause: TableClause,
+        key: Sequence[Column],
+        join_clause: Sequence[ColumnElement[bool]],
+    ) -> Tuple[int, int]:
+        # the join finds the csvbase_row_ids of existing rows - new rows get
+        # them from the sequence.  (if left to the column default the sequence
+        # would also be advanced for each existing row)
+        main_table_name = self._make_userdata_table_name(
+            table.table_uuid, with_schema=True
+        )
+        row_id = func.coalesce(
+            main_tableclause.c.csvbase_row_id,
+            func.nextval(
+                func.pg_get_serial_sequence(main_table_name, "csvbase_row_id")
+            ),
+        )
+        return self._execute_merge(
+            self._merge_stmt(
+                table,
+                main_tableclause,
+                key,
+                select(
+                    row_id, *[temp_tableclause.c[c.name] for c in table.user_columns()]
+                ).select_from(
+                    temp_tableclause.outerjoin(main_tableclause, and_(*join_clause))
+                )
+                # without a WHERE, postgres would take ON CONFLICT as part of
+                # the join
+                .where(true()),
+            )
+        )
+
+    def _merge_stmt(
+        self,
+        table: Table,
+        main_tableclause: TableClause,
+        key: Sequence[Column],
+        new_rows: Select,
+    ) -> Insert:
+        """Return an INSERT ... ON CONFLICT statement that inserts new rows and
+        updates existing rows, but only where something has changed."""
+        user_column_names = [c.name for c in table.user_columns()]
+        insert_stmt = pg_insert(main_tableclause)
+        return insert_stmt.from_select(
+            [c.name for c in table.columns], new_rows
+        ).on_conflict_do_update(
+            index_elements=[c.name for c in key],
+            set_={name: insert_stmt.excluded[name] for name in user_column_names},
+            where=satuple(
+                *[main_tableclause.c[name] for name in user_column_names]
+            ).is_distinct_from(
+                satuple(*[insert_stmt.excluded[name] for name in user_column_names])
+            ),
+        )
+
+    def _execute_merge(self, merge_stmt: Insert) -> Tuple[int, int]:
+        """Execute a statement from _merge_stmt, returning the number of rows
+        inserted and updated.
+
+        Rows that were unchanged are neither.
 
-        # 2. updates
+        """
+        # xmax is zero for rows that were freshly inserted
+        merged = merge_stmt.returning(
+            literal_column("xmax = 0", type_=satypes.Boolean).label("inserted")
+        ).cte("merged")
+        inserted, updated = self.sesh.execute(
+            select(
+                func.count().filter(merged.c.inserted),
+                func.count().filter(not_(merged.c.inserted)),
+            )
+        ).one()
+        return inserted, updated
+
+    def _key_index_name(self, table_uuid: UUID, with_schema: bool = True) -> str:
+        return f"{self._make_userdata_table_name(table_uuid, with_schema)}_key"
+
+    def create_key_index(self, table_uuid: UUID, key: Sequence[Column]) -> bool:
+        """Create (if it doesn't already exist) a unique index on the key
+        columns of a table.
+
+        Returns False if that isn't possible, because the table has duplicate
+        keys.
+
+        """
+        quote = self.sesh.get_bind().dialect.identifier_preparer.quote
+        index_name = self._key_index_name(table_uuid, with_schema=False)
+        table_name = self._make_userdata_table_name(table_uuid, with_schema=True)
+        stmt = text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name}"
+            f" ({', '.join(quote(c.name) for c in key)})"
+        )
+        try:
+            with self.sesh.begin_nested():
+                self.sesh.execute(stmt)
+        except IntegrityError:
+            logger.warning("unable to create key index for %s", table_uuid)
+            return False
+        return True
+
+    def _replace_from_temp_table(
+        self, table: Table, temp_table_name: str, key: Sequence[Column]
+    ) -> Tuple[int, int]:
+        """Update from the temp table by updating every matched row that has
+        changed, then inserting the rest.  Returns the number of rows inserted
+        and updated.
+
+        This is used when there isn't a unique index on the key.
+
+        """
+        main_table_name = self._make_userdata_table_name(
+            table.table_uuid, with_schema=True
+        )
+        main_tableclause = self._get_userdata_tableclause(table.table_uuid)
+        existing_column_names = [c.name for c in table.columns]
+        temp_tableclause = self._get_tableclause(temp_table_name, table.columns)
+
+        join_clause = [
+            (main_tableclause.c[key_column.name] == temp_tableclause.c[key_column.name])
+            for key_column in key
+        ]
+
+        # 1. updates
         update_values = {}
         for col in table.columns:
             if col == ROW_ID_COLUMN and ROW_ID_COLUMN not in key:
@@ -496,11 +1558,21 @@ class PGUserdataAdapter:
                 )
             else:
                 update_values[col.name] = getattr(temp_tableclause.c, col.name)
+        user_column_names = [c.name for c in table.user_columns()]
         update_stmt = (
-            main_tableclause.update().values(**update_values).where(and_(*join_clause))
+            main_tableclause.update()
+            .values(**update_values)
+            .where(
+                and_(*join_clause),
+                satuple(
+                    *[main_tableclause.c[name] for name in user_column_names]
+                ).is_distinct_from(
+                    satuple(*[temp_tableclause.c[name] for name in user_column_names])
+                ),
+            )
         )
 
-        # 3a. and additions where the csvbase_row_id as been set
+        # 2a. and additions where the csvbase_row_id as been set
         add_stmt_select_columns = [
             getattr(temp_tableclause.c, c.name) for c in table.columns
         ]
@@ -520,10 +1592,10 @@ class PGUserdataAdapter:
             ),
         )
 
-        # 3b. reset the sequence that allocates pks
+        # 2b. reset the sequence that allocates pks
         # <done by _reset_pk_sequence>
 
-        # 3c. additions which do not have a csvbase_row_id set
+        # 2c. additions which do not have a csvbase_row_id set
         select_columns = [
             func.coalesce(
                 func.nextval(
@@ -546,11 +1618,11 @@ class PGUserdataAdapter:
             ),
         )
 
-        self.sesh.execute(remove_stmt)
-        self.sesh.execute(update_stmt)
-        self.sesh.execute(add_stmt_no_blanks)
+        updated = self.sesh.execute(update_stmt).rowcount
+        inserted = self.sesh.execute(add_stmt_no_blanks).rowcount
         self._reset_pk_sequence(main_tableclause)
-        self.sesh.execute(add_stmt_blanks)
+        inserted += self.sesh.execute(add_stmt_blanks).rowcount
+        return inserted, updated
 
     def byte_count(self, table_uuid: UUID) -> int:
         # pg_total_relation_size returns the size of the table plus toast, plus
@@ -565,6 +1637,14 @@ class PGUserdataAdapter:
         return cast(int, rs.scalar())
 
 
+@event.listens_for(Session, "after_transaction_end")
+def _forget_all_columns(session: Session, transaction: SessionTransaction) -> None:
+    # other transactions can create, drop or replace tables, so columns are
+    # only remembered until the (outermost) transaction ends
+    if transaction.parent is None:
+        session.info.pop(_COLUMNS_KEY, None)
+
+
 class CreateTempTableLike(DDLElement):
     inherit_cache = False
 
@@ -583,35 +1663,3 @@ def visit_create_temp_table(element, compiler, **kw):
         element.temp_table,
         element.like_table,
     )
-
-
-class RowCountStatement(Executable, ClauseElement):
-    inherit_cache = False
-
-    def __init__(self, table: TableClause):
-        self.table = table
-
-
-@compiles(RowCountStatement, "postgresql")
-def visit_rowcount(element, compiler, **kw):
-    # In PG, exact counts are slow, so for bigger tables, do an approximate
-    # count and possibly include an exact count as well.
-    stmt = """
-SELECT
-    CASE WHEN reltuples >= 1000 THEN
-        null
-    ELSE
-        (
-            SELECT
-                COUNT(*)
-            FROM
-                %s)
-    END,
-    reltuples::bigint
-FROM
-    pg_class
-WHERE
-    relname = '%s';
-    """
-    x = stmt % (compiler.process(element.table, asfrom=True, **kw), element.table.name)
-    return x
@@ -20,6 +20,7 @@ from uuid import UUID
 from datetime import datetime, date, timedelta, timezone
 from dataclasses import (
     dataclass,
+    field,
     asdict as dataclass_as_dict,
 )
 import enum
@@ -84,26 +85,30 @@ class KeySet:
 
     https://use-the-index-luke.com/no-offset
 
+    The columns are either just csvbase_row_id, or a column to sort by
+    followed by csvbase_row_id (to break ties).  Empty values mean from the
+    start (greater_than) or from the end (less_than).
+
     """
 
     columns: List["Column"]
     values: Tuple
     op: Literal["greater_than", "less_than"]
     size: int = 10
+    filters: Sequence["BinaryFilter"] = ()
 
-
-# sketch for filters
-# @dataclass
-# class KeySetNG:
-#     filters: Sequence["BinaryFilter"]
-#     size: Optional[int] = 10
+    def sort_column(self) -> Optional["Column"]:
+        """The column being sorted by, if not csvbase_row_id."""
+        if self.columns[0] == ROW_ID_COLUMN:
+            return None
+        return self.columns[0]
 
 
-# @dataclass
-# class BinaryFilter:
-#     lhs: Union["Column"]
-#     rhs: Union["Column", "PythonType"]
-#     op: "BinaryOp"
+@dataclass
+class BinaryFilter:
+    lhs: "Column"
+    rhs: "PythonType"
+    op: "BinaryOp"
 
 
 @enum.unique
@@ -140,13 +145,45 @@ class RowCount:
     approx: int
 
     def best(self) -> int:
-        return self.exact or self.approx
+        return self.exact if self.exact is not None else self.approx
 
     def is_big(self) -> bool:
         # Big Data == "too big for excel"
         return self.best() > 1_048_576
 
 
+@dataclass
+class UpsertCounts:
+    """What happened to the rows of a table in an upsert."""
+
+    inserted: int
+    updated: int
+    deleted: int
+    unchanged: int
+
+
+@dataclass
+class RowOperation:
+    """One change to a row, as part of a batch.
+
+    Creates have a row but no row id, deletes have a row id but no row and
+    updates have both.
+
+    """
+
+    op: Literal["create", "update", "delete"]
+    row_id: Optional[int] = None
+    row: Optional[Row] = None
+
+
+@dataclass
+class RowOperationResult:
+    op: Literal["create", "update", "delete"]
+    row_id: int
+    # False when the row to update or delete did not exist
+    applied: bool
+
+
 @dataclass
 class Table:
     table_uuid: UUID
@@ -158,9 +195,17 @@ class Table:
     created: datetime
     row_count: RowCount
     last_changed: datetime
+    # increases with every change to the table (or its metadata), but changes
+    # to the rows may be folded in later (see svc.mark_table_data_changed).
+    # The repcache goes by this.
+    version: int
+    # increases with every change, straight away
+    latest_version: int
     licence: Optional["Licence"]
     key: Optional[Sequence["Column"]]
     upstream: Optional["GitUpstream"] = None
+    # columns that have an index for sorting and filtering
+    indexed_columns: Sequence["Column"] = field(default_factory=list)
 
     def has_caption(self) -> bool:
         return len(self.caption.strip()) > 0
@@ -2,8 +2,10 @@ import io
 from uuid import UUID
 from pathlib import Path
 import shutil
-from datetime import datetime, timedelta, timezone
+import tempfile
+from datetime import date, datetime, timedelta, timezone
 import codecs
+from dataclasses import asdict, replace
 from logging import getLogger
 from typing import (
     Any,
@@ -14,6 +16,7 @@ from typing import (
     cast,
     Iterator,
     IO,
+    Iterable,
     TypeVar,
     List,
     Union,
@@ -21,9 +24,11 @@ from typing import (
 )
 from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import hashlib
+import secrets
 import json
 
 import pydantic
+import pyarrow as pa
 from sqlalchemy.orm import Session
 from dateutil.zoneinfo import get_zonefile_instance
 import itsdangerous.url_safe
@@ -68,6 +73,7 @@ from ...json import value_to_json, json_to_row
 from ...markdown import render_markdown
 from ...sesh import get_sesh
 from ...userdata import PGUserdataAdapter
+from ... import conv
 from ...conv import DateConverter, IntegerConverter, FloatConverter
 from ...value_objs import (
     ROW_ID_COLUMN,
@@ -78,14 +84,16 @@ from ...value_objs import (
     Page,
     PythonType,
     Row,
+    RowOperation,
     Table,
     Backend,
     BinaryOp,
+    BinaryFilter,
     TableRepresentation,
 )
 from ...constants import COPY_BUFFER_SIZE, FAR_FUTURE, MAX_UUID
 from ..billing import svc as billing_svc
-from ...repcache import RepCache
+from ...repcache import RepCache, COMPRESSIBLE_CONTENT_TYPES, ENCODINGS
 from ...config import get_config
 from csvbase.bgwork import task_registry
 from .comments_views import init_comments_views
@@ -96,6 +104,12 @@ bp = Blueprint("csvbase", __name__)
 
 CORS_EXPIRY = timedelta(hours=8)
 
+# requests for more byte ranges than this get the whole representation
+# instead, so that a few bytes of request can't cause lots of tiny reads
+MAX_RANGES = 20
+
+CRLF = "\r\n"
+
 CORS(
     bp,
     resources={
@@ -152,9 +166,7 @@ class ConvertForm(MethodView):
                 "convert.html",
                 input_formats=[
                     ContentType.CSV,
-                    # FIXME: Parquet's type system needs more work to be able
-                    # to parse it in csvbase
-                    # ContentType.PARQUET,
+                    ContentType.PARQUET,
                 ],
                 output_formats=[
                     ContentType.CSV,
@@ -255,6 +267,7 @@ class TableView(MethodView):
         negotiate_content_type([ContentType.JSON])
 
         backend = PGUserdataAdapter(sesh)
+        body: Dict[str, Any] = {}
 
         if svc.table_exists(sesh, user.user_uuid, table_name):
             table = svc.get_table(sesh, username, table_name)
@@ -271,29 +284,28 @@ class TableView(MethodView):
                 if provided_etag != expected_etag:
                     raise exc.ETagMismatch()
 
-            str_buf = get_user_str_buf()
-            dialect, csv_columns = streams.peek_csv(str_buf, table.columns)
-            rows = table_io.csv_to_rows(str_buf, csv_columns, dialect)
+            columns, record_batches = get_user_record_batches(table.columns)
 
             # If there is no csvbase_row_id column, don't try to correlate
-            # updates, just wipe the table and insert everything.
-            if "csvbase_row_id" not in set(c.name for c in csv_columns):
-                backend.delete_table_data(table)
-                backend.insert_table_data(table, csv_columns, rows)
+            # updates, just replace the table with everything.
+            if "csvbase_row_id" not in set(c.name for c in columns):
+                backend.replace_record_batches(table, columns, record_batches)
             else:
-                backend.upsert_table_data(
-                    table,
-                    csv_columns,
-                    rows,
+                # ?delete_missing=false keeps rows that aren't in the upload
+                delete_missing = (
+                    request.args.get("delete_missing", default="true").lower()
+                    != "false"
                 )
+                counts = backend.upsert_record_batches(
+                    table, columns, record_batches, delete_missing=delete_missing
+                )
+                body.update(asdict(counts))
             status = 200
             message = f"upserted {username}/{table_name}"
         else:
             if not am_user(username):
                 raise exc.NotAllowedException()
-            str_buf = get_user_str_buf()
-            dialect, csv_columns = streams.peek_csv(str_buf)
-            rows = table_io.csv_to_rows(str_buf, csv_columns, dialect)
+            columns, record_batches = get_user_record_batches()
             is_public = request.args.get("public", default=False, type=bool)
             licence = licence_form_field_to_licence(request.form.get("licence", None))
             table_uuid = svc.create_table_metadata(
@@ -305,15 +317,15 @@ class TableView(MethodView):
                 backend=Backend.POSTGRES,
                 licence=licence,
             )
-            backend.create_table(table_uuid, csv_columns)
+            backend.create_table(table_uuid, columns)
             table = svc.get_table(sesh, username, table_name)
-            backend.insert_table_data(table, csv_columns, rows)
+            backend.insert_record_batches(table, columns, record_batches)
             status = 201
             message = f"created {username}/{table_name}"
         svc.update_upstream(sesh, table)
         svc.mark_table_changed(sesh, table.table_uuid)
         sesh.commit()
-        response = jsonify({"message": message})
+        response = jsonify({"message": message, **body})
         response.status_code = status
         return response
 
@@ -339,15 +351,13 @@ class TableView(MethodView):
 
         negotiate_content_type([ContentType.JSON])
 
-        str_buf = get_user_str_buf()
-        dialect, columns = streams.peek_csv(str_buf, table.columns)
-        rows = table_io.csv_to_rows(str_buf, columns, dialect)
+        columns, record_batches = get_user_record_batches(table.columns)
 
         # FIXME: check that columns is a subset of table_columns
         # table_columns = PGUserdataAdapter.get_columns(sesh, columns)
 
         backend = PGUserdataAdapter(sesh)
-        backend.insert_table_data(table, columns, rows)
+        backend.insert_record_batches(table, columns, record_batches)
 
         message = f"Updated {username}/{table_name}"
         response = jsonify({"message": message})
@@ -404,14 +414,28 @@ def ensure_not_over_the_top(table: Table, keyset: KeySet, page: Page) -> None:
         raise exc.PageDoesNotExistException(table.username, table.table_name, keyset)
 
 
+def request_column_indexes(
+    backend: PGUserdataAdapter, table: Table, keyset: KeySet
+) -> None:
+    """Ask for an index on any column that is often sorted or filtered by."""
+    columns = [binary_filter.lhs for binary_filter in keyset.filters]
+    sort_column = keyset.sort_column()
+    if sort_column is not None:
+        columns.append(sort_column)
+    for column in columns:
+        if column != ROW_ID_COLUMN and backend.note_column_use(table, column):
+            task_registry.create_column_index.delay(table.table_uuid, column.name)
+
+
 def make_table_view_response(sesh, content_type: ContentType, table: Table) -> Response:
     """Build a representation of a table for a content-type and return a
     response ready to be returned from a handler."""
     if content_type in {ContentType.HTML, ContentType.JSON}:
-        keyset = keyset_from_request_args()
+        keyset = keyset_from_request_args(table)
     else:
         keyset = None
-    etag = make_table_view_etag(table, content_type, keyset)
+    encoding = negotiate_encoding(content_type)
+    etag = make_table_view_etag(table, content_type, keyset, encoding)
 
     # First, check if we can early-exit without doing anything based on etags
     if_none_match = request.headers.get("If-None-Match", None)
@@ -433,19 +457,26 @@ def make_table_view_response(sesh, content_type: ContentType, table: Table) -> R
     if keyset is not None:
         page = backend.table_page(table, keyset)
         ensure_not_over_the_top(table, keyset, page)
+        request_column_indexes(backend, table, keyset)
         if content_type is ContentType.HTML:
-            min_row_id, max_row_id = backend.row_id_bounds(table.table_uuid)
-            row_ids = page.row_ids()
-            is_first_page = min_row_id is None or (min_row_id in row_ids)
-            is_last_page = max_row_id is None or (max_row_id in row_ids)
+            is_first_page = not page.has_less
+            is_last_page = not page.has_more
 
             template_kwargs = dict(
                 page_title=table.table_name,
                 page=page,
                 keyset=keyset,
+                page_urls=page_urls(table, keyset, page),
+                sort_urls={
+                    column.name: keyset_url(
+                        table,
+                        replace(keyset, columns=[column, ROW_ID_COLUMN], values=()),
+                        "gt",
+                    )
+                    for column in table.user_columns()
+                },
                 is_first_page=is_first_page,
                 is_last_page=is_last_page,
-                max_row_id=max_row_id,
                 highlight=request.args.get("highlight", None, type=int),
             )
 
@@ -463,7 +494,7 @@ def make_table_view_response(sesh, content_type: ContentType, table: Table) -> R
             add_table_metadata_headers(table, response)
             return response
         else:
-            response = jsonify(table_to_json_dict(table, page))
+            response = jsonify(table_to_json_dict(table, page, keyset))
             add_table_view_cache_headers(table, response, etag)
             add_table_metadata_headers(table, response)
             return response
@@ -472,8 +503,9 @@ def make_table_view_response(sesh, content_type: ContentType, table: Table) -> R
             table.username, table.table_name, content_type.file_extension()
         )
 
-        repcache = RepCache(table.table_uuid, content_type, table.last_changed)
-        if not repcache.exists():
+        repcache = RepCache(table.table_uuid, content_type, table.version)
+        # if some other request is already writing it, follow along
+        if not repcache.exists() and not repcache.write_in_progress():
             is_big = backend.count(table.table_uuid).is_big()
             if is_big:
                 if content_type is ContentType.XLSX:
@@ -485,33 +517,59 @@ def make_table_view_response(sesh, content_type: ContentType, table: Table) -> R
                         ContentType.HTML,
                     ]
                     raise exc.TooBigForContentType(other_content_types)
-                if not repcache.write_in_progress():
-                    task_registry.populate_repcache.delay(
-                        table.table_uuid, content_type.value
-                    )
+                task_registry.populate_repcache.delay(
+                    table.table_uuid, content_type.value
+                )
                 response = make_wait_response(table, content_type)
                 return response
 
-            svc.populate_repcache(sesh, table.table_uuid, content_type)
+            try:
+                svc.populate_repcache(sesh, table.table_uuid, content_type)
+            except exc.RepWriteInProgress:
+                # another request got there first
+                pass
 
-        if get_config().x_accel_redirect:
+        if encoding is not None:
+            variant = RepCache(table.table_uuid, content_type, table.version, encoding)
+            if variant.exists():
+                repcache = variant
+            else:
+                # eg: the variant is still being written
+                encoding = None
+                etag = make_table_view_etag(table, content_type, keyset)
+
+        # the object store (or nginx) serving the variant sets its encoding
+        presigned_url = repcache.url(download_filename)
+        if presigned_url is not None:
+            response = redirect(presigned_url)
+        elif get_config().x_accel_redirect and repcache.exists():
             response = make_response()
             repcache_path = repcache.path()
             response.headers["X-Accel-Redirect"] = f"/repcache/{repcache_path}"
         else:
-            with repcache.open(mode="rb") as response_buf:
-                response = make_streaming_response(
-                    response_buf, content_type, download_filename
-                )
+            try:
+                with repcache.open(mode="rb") as response_buf:
+                    response = make_ranged_response(
+                        response_buf, content_type, download_filename, etag
+                    )
+            except exc.RepWriteInProgress:
+                # the write is stuck, so come back later
+                return make_wait_response(table, content_type)
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
         add_table_view_cache_headers(table, response, etag)
         add_table_metadata_headers(table, response)
         return response
 
 
 def make_wait_response(table: Table, content_type: ContentType) -> Response:
-    wait_content_type = negotiate_content_type([ContentType.HTML])
     delay_seconds = 10
-    if wait_content_type is ContentType.HTML:
+    try:
+        negotiate_content_type([ContentType.HTML])
+    except exc.CantNegotiateContentType:
+        # eg: a client downloading csv, which is only told when to retry
+        response = make_response("", 503)
+    else:
         response = make_response(
             render_template(
                 "table_wait.html",
@@ -534,13 +592,19 @@ def keyset_to_dict(keyset: KeySet) -> Dict:
         "values": keyset.values,
         "op": keyset.op,
         "size": keyset.size,
+        "filters": [
+            (f.lhs.name, f.op.value, value_to_arg(f.rhs)) for f in keyset.filters
+        ],
     }
 
 
 def make_table_view_etag(
-    table: Table, content_type: ContentType, keyset: Optional[KeySet]
+    table: Table,
+    content_type: ContentType,
+    keyset: Optional[KeySet],
+    encoding: Optional[str] = None,
 ) -> str:
-    """Returns the ETag for a given (table, content_type, keyset)."""
+    """Returns the ETag for a given (table, content_type, keyset, encoding)."""
     current_user = get_current_user()
     current_username = (
         current_user.username if current_user is not None else "anonymous"
@@ -556,6 +620,15 @@ def make_table_view_etag(
         hash_.update(str(keyset_to_dict(keyset)).encode("utf-8"))
 
     hash_.update(content_type.value.encode("utf-8"))
+    if encoding is not None:
+        hash_.update(encoding.encode("utf-8"))
+    # last_changed can lag behind changes to the rows (see
+    # svc.mark_table_data_changed).  So can the version, but only
+    # representations from the repcache (which goes by it) go by that.
+    if keyset is None:
+        hash_.update(str(table.version).encode("utf-8"))
+    else:
+        hash_.update(str(table.latest_version).encode("utf-8"))
     hash_.update(table.last_changed.isoformat().encode("utf-8"))
     if content_type == ContentType.HTML:
         hash_.update(current_username.encode("utf-8"))
@@ -633,8 +706,9 @@ def add_table_view_cache_headers(
     response.cache_control.must_revalidate = True
 
     # The advice on "Vary" is to return the same value for every response from
-    # a URL, and we want the cache key to include "Cookie"
-    response.headers["Vary"] = "Accept, Cookie"
+    # a URL, and we want the cache key to include "Cookie" (and
+    # "Accept-Encoding", for precompressed representations)
+    response.headers["Vary"] = "Accept, Accept-Encoding, Cookie"
 
     # HTML views show usernames, other personal data.  "private" restricts
     # caching of these responses to local caches only.  This is also set for
@@ -732,6 +806,7 @@ def get_table_apidocs(username: str, table_name: str) -> Response:
         row_to_json_dict=row_to_json_dict,
         table_to_json_dict=table_to_json_dict,
         url_for_with_auth=url_for_with_auth,
+        max_row_operations=MAX_ROW_OPERATIONS,
     )
 
 
@@ -955,7 +1030,7 @@ def create_row(username: str, table_name: str) -> Response:
 
     backend = PGUserdataAdapter(sesh)
     row_id = backend.insert_row(table.table_uuid, row)
-    svc.mark_table_changed(sesh, table.table_uuid)
+    svc.mark_table_data_changed(sesh, table.table_uuid)
     svc.update_upstream(sesh, table)
     sesh.commit()
 
@@ -983,6 +1058,110 @@ def create_row(username: str, table_name: str) -> Response:
         )
 
 
+# the most operations that can be sent in one batch
+MAX_ROW_OPERATIONS = 10_000
+
+
+@bp.post("/<username:username>/<table_name:table_name>/rows/batch")
+@cross_origin(max_age=CORS_EXPIRY, methods=["POST"])
+def row_batch(username: str, table_name: str) -> Response:
+    """Create, update and delete many rows at once, in one transaction.
+
+    The body is either a JSON array of operations or JSON lines (one
+    operation per line).
+
+    """
+    sesh = get_sesh()
+    svc.user_exists(sesh, username)
+    table = svc.get_table(sesh, username, table_name)
+    ensure_table_access(sesh, table, "write")
+    ensure_not_read_only(table)
+
+    if request.mimetype == ContentType.JSON.value:
+        json_body = request.get_json(silent=True)
+        if not isinstance(json_body, list):
+            raise exc.InvalidRequest("expected a JSON array of operations")
+        json_operations: Iterable[Any] = json_body
+    elif request.mimetype == ContentType.JSON_LINES.value:
+        json_operations = json_lines_from_request()
+    else:
+        raise exc.WrongContentType(
+            [ContentType.JSON, ContentType.JSON_LINES], request.mimetype
+        )
+
+    def operations() -> Iterator[RowOperation]:
+        for index, json_operation in enumerate(json_operations):
+            if index >= MAX_ROW_OPERATIONS:
+                raise exc.InvalidRequest(
+                    f"no more than {MAX_ROW_OPERATIONS} operations at once"
+                )
+            yield json_to_row_operation(table.user_columns(), json_operation)
+
+    backend = PGUserdataAdapter(sesh)
+    results = backend.apply_row_operations(table.table_uuid, operations())
+    if any(result.applied for result in results):
+        svc.mark_table_data_changed(sesh, table.table_uuid)
+        svc.update_upstream(sesh, table)
+    sesh.commit()
+
+    return jsonify(
+        {
+            "results": [
+                {
+                    "op": result.op,
+                    "row_id": result.row_id,
+                    "applied": result.applied,
+                    "url": url_for(
+                        "csvbase.row_view",
+                        username=table.username,
+                        table_name=table.table_name,
+                        row_id=result.row_id,
+                        _external=True,
+                    ),
+                }
+                for result in results
+            ]
+        }
+    )
+
+
+def json_lines_from_request() -> Iterator[Any]:
+    for line in request.stream:
+        if line.strip() == b"":
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise exc.InvalidRequest("invalid JSON line")
+
+
+# the keys each kind of row operation has
+ROW_OPERATION_KEYS = {
+    "create": {"op", "row"},
+    "update": {"op", "row_id", "row"},
+    "delete": {"op", "row_id"},
+}
+
+
+def json_to_row_operation(columns: Sequence[Column], json_dict: Any) -> RowOperation:
+    if not isinstance(json_dict, dict):
+        raise exc.InvalidRequest("operations should be JSON objects")
+    op = json_dict.get("op")
+    if op not in ROW_OPERATION_KEYS or json_dict.keys() != ROW_OPERATION_KEYS[op]:
+        raise exc.InvalidRequest(f"invalid operation: {json_dict}")
+    row_id = json_dict.get("row_id")
+    if "row_id" in json_dict and (
+        not isinstance(row_id, int) or isinstance(row_id, bool)
+    ):
+        raise exc.InvalidRequest("row ids should be integers")
+    row: Optional[Row] = None
+    if "row" in json_dict:
+        if not isinstance(json_dict["row"], dict):
+            raise exc.InvalidRequest("rows should be JSON objects")
+        row = json_to_row(columns, json_dict["row"])
+    return RowOperation(op, row_id, row)
+
+
 class RowView(MethodView):
     """This covers the part of the row API that is concerned with named
     individual rows."""
@@ -1036,7 +1215,7 @@ class RowView(MethodView):
         if not backend.update_row(table.table_uuid, row_id, row):
             raise exc.RowDoesNotExistException(username, table_name, row_id)
         svc.update_upstream(sesh, table)
-        svc.mark_table_changed(sesh, table.table_uuid)
+        svc.mark_table_data_changed(sesh, table.table_uuid)
         sesh.commit()
         return jsonify(body)
 
@@ -1085,7 +1264,7 @@ class RowView(MethodView):
         backend = PGUserdataAdapter(sesh)
         backend.update_row(table.table_uuid, row_id, row)
         svc.update_upstream(sesh, table)
-        svc.mark_table_changed(sesh, table.table_uuid)
+        svc.mark_table_data_changed(sesh, table.table_uuid)
         sesh.commit()
         flash(f"Updated row {row_id}")
         return safe_redirect(whence)
@@ -1098,7 +1277,7 @@ class RowView(MethodView):
         if not backend.delete_row(table.table_uuid, row_id):
             raise exc.RowDoesNotExistException(username, table_name, row_id)
         svc.update_upstream(sesh, table)
-        svc.mark_table_changed(sesh, table.table_uuid)
+        svc.mark_table_data_changed(sesh, table.table_uuid)
         sesh.commit()
         response = make_response()
         response.status_code = 204
@@ -1148,7 +1327,7 @@ def delete_row_for_browsers(username: str, table_name: str, row_id: int) -> Resp
     if not backend.delete_row(table.table_uuid, row_id):
         raise exc.RowDoesNotExistException(username, table_name, row_id)
     svc.update_upstream(sesh, table)
-    svc.mark_table_changed(sesh, table.table_uuid)
+    svc.mark_table_data_changed(sesh, table.table_uuid)
     sesh.commit()
     flash(f"Deleted row {row_id}")
     return redirect(
@@ -1484,8 +1663,10 @@ def make_streaming_response(
     )
     response = current_app.response_class(generate(), mimetype=mimetype)
 
-    # Setting Content-Length is optional but helps clients allocate buffers
-    response.headers["Content-Length"] = str(streams.file_length(response_buf))
+    # Setting Content-Length is optional but helps clients allocate buffers.
+    # It isn't known for streams that are still being written.
+    if response_buf.seekable():
+        response.headers["Content-Length"] = str(streams.file_length(response_buf))
 
     if download_filename is not None:
         response.headers["Content-Disposition"] = (
@@ -1494,6 +1675,131 @@ def make_streaming_response(
     return response
 
 
+def make_ranged_response(
+    response_buf: IO[bytes],
+    content_type: ContentType,
+    download_filename: str,
+    etag: str,
+) -> Response:
+    """Turn a representation into a flask response, honouring the Range (and
+    If-Range) headers.
+
+    Representations that are still being written are always sent whole.
+
+    """
+    if not response_buf.seekable():
+        return make_streaming_response(response_buf, content_type, download_filename)
+
+    length = streams.file_length(response_buf)
+    byte_ranges = requested_byte_ranges(etag, length)
+    if byte_ranges is None:
+        response = make_streaming_response(
+            response_buf, content_type, download_filename
+        )
+    elif len(byte_ranges) == 0:
+        response = current_app.response_class(status=416)
+        response.headers["Content-Range"] = f"bytes */{length}"
+    elif len(byte_ranges) == 1:
+        start, stop = byte_ranges[0]
+        response = current_app.response_class(
+            generate_byte_range(response_buf, start, stop),
+            status=206,
+            mimetype=content_type.value,
+        )
+        response.headers["Content-Length"] = str(stop - start)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    else:
+        boundary = secrets.token_hex(16)
+        part_headers = [
+            (
+                f"{'' if index == 0 else CRLF}--{boundary}{CRLF}"
+                f"Content-Type: {content_type.value}{CRLF}"
+                f"Content-Range: bytes {start}-{stop - 1}/{length}{CRLF}{CRLF}"
+            ).encode("utf-8")
+            for index, (start, stop) in enumerate(byte_ranges)
+        ]
+        closing_delimiter = f"{CRLF}--{boundary}--{CRLF}".encode("utf-8")
+
+        def generate() -> Iterator[bytes]:
+            for part_header, (start, stop) in zip(part_headers, byte_ranges):
+                yield part_header
+                yield from generate_byte_range(response_buf, start, stop)
+            yield closing_delimiter
+
+        response = current_app.response_class(
+            generate(),
+            status=206,
+            mimetype=f"multipart/byteranges; boundary={boundary}",
+        )
+        response.headers["Content-Length"] = str(
+            sum(len(part_header) for part_header in part_headers)
+            + sum(stop - start for start, stop in byte_ranges)
+            + len(closing_delimiter)
+        )
+
+    response.headers["Accept-Ranges"] = "bytes"
+    if response.status_code == 206:
+        response.headers["Content-Disposition"] = (
+            f'attachment; filename="{download_filename}"'
+        )
+    return response
+
+
+def requested_byte_ranges(etag: str, length: int) -> Optional[List[Tuple[int, int]]]:
+    """Return the (start, stop) byte ranges asked for by the Range header, or
+    None if the whole representation should be sent instead.
+
+    An empty list means that none of the ranges can be satisfied.
+
+    """
+    range_ = request.range
+    if range_ is None or range_.units != "bytes" or len(range_.ranges) > MAX_RANGES:
+        return None
+
+    if "If-Range" in request.headers:
+        # The table etag is weak, but representations are written once per
+        # table version, so it is compared strongly here.  Dates are never
+        # matched because last_changed can lag behind changes to the rows.
+        if_range_etag = request.if_range.etag
+        if (
+            if_range_etag is None
+            or if_range_etag != werkzeug.http.unquote_etag(etag)[0]
+        ):
+            return None
+
+    rv = []
+    for begin, end in range_.ranges:
+        if begin < 0:
+            # a suffix, eg: the last 500 bytes
+            start, stop = max(length + begin, 0), length
+        else:
+            start, stop = begin, length if end is None else min(end, length)
+        if start < stop:
+            rv.append((start, stop))
+    return rv
+
+
+def generate_byte_range(
+    response_buf: IO[bytes], start: int, stop: int
+) -> Iterator[bytes]:
+    response_buf.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        minibuf = response_buf.read(min(COPY_BUFFER_SIZE, remaining))
+        if not minibuf:
+            break
+        remaining -= len(minibuf)
+        yield minibuf
+
+
+def negotiate_encoding(content_type: ContentType) -> Optional[str]:
+    """Pick which precompressed variant of a representation (if any) to serve,
+    from the Accept-Encoding header."""
+    if content_type not in COMPRESSIBLE_CONTENT_TYPES:
+        return None
+    return request.accept_encodings.best_match(list(ENCODINGS))
+
+
 def negotiate_content_type(supported_mediatypes: Sequence[ContentType]) -> ContentType:
     """Negotiate the format to send back to the client."""
     accepts = werkzeug.http.parse_accept_header(request.headers.get("Accept", "*/*"))
@@ -1516,15 +1822,119 @@ def json_or_400() -> Dict[str, Any]:
         return request.json
 
 
-def keyset_from_request_args() -> KeySet:
-    n: int = request.args.get("n", default=0, type=int)
+def keyset_from_request_args(table: Table) -> KeySet:
+    """Parse the keyset from the query string.
+
+    The sort column is given by "sort", and the position by "n" (the row id)
+    and "v" (the value of the sort column).  Filters are given as
+    <column>.<op>=<value>, eg: "?price.gte=10&price.lt=20".
+
+    """
+    columns_by_name = {column.name: column for column in table.columns}
+    sort_column = columns_by_name.get(request.args.get("sort", ROW_ID_COLUMN.name))
+    if sort_column is None:
+        raise exc.InvalidRequest("no such column to sort by")
     op: Literal["greater_than", "less_than"] = (
         "greater_than" if request.args.get("op", default="gt") == "gt" else "less_than"
     )
-    keyset = KeySet(
-        [Column("csvbase_row_id", ColumnType.INTEGER)], (n,), op=op, size=10
+    n: Optional[int] = request.args.get("n", type=int)
+    values: Tuple = ()
+    if sort_column == ROW_ID_COLUMN:
+        columns = [ROW_ID_COLUMN]
+        if n is not None:
+            values = (n,)
+    else:
+        columns = [sort_column, ROW_ID_COLUMN]
+        # rows where the sort column is null come last, and have no "v"
+        v = request.args.get("v")
+        if n is not None:
+            values = (arg_to_value(sort_column, v) if v is not None else None, n)
+
+    filters = []
+    for arg, arg_value in request.args.items(multi=True):
+        column_name, dot, op_str = arg.rpartition(".")
+        if dot == "":
+            continue
+        try:
+            column = columns_by_name[column_name]
+            binary_op = BinaryOp(op_str)
+        except (KeyError, ValueError):
+            raise exc.InvalidRequest(f"unknown filter: {arg}")
+        filters.append(BinaryFilter(column, arg_to_value(column, arg_value), binary_op))
+
+    return KeySet(columns, values, op=op, size=10, filters=filters)
+
+
+def arg_to_value(column: Column, arg_value: str) -> PythonType:
+    value = conv.from_string_to_python(column.type_, arg_value)
+    if value is None:
+        raise exc.InvalidRequest(f"no value given for {column.name}")
+    return value
+
+
+def value_to_arg(value: PythonType) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, date):
+        return value.isoformat()
+    else:
+        return str(value)
+
+
+def keyset_url(
+    table: Table,
+    keyset: KeySet,
+    op: Literal["gt", "lt"],
+    values: Tuple = (),
+    _external: bool = False,
+) -> str:
+    """Build the url for a page of the table, keeping the sort and filters of
+    the given keyset.  Empty values means the first (or last) page."""
+    args: Dict[str, Any] = {}
+    sort_column = keyset.sort_column()
+    if sort_column is not None:
+        args["sort"] = sort_column.name
+    for binary_filter in keyset.filters:
+        args[f"{binary_filter.lhs.name}.{binary_filter.op.value}"] = value_to_arg(
+            binary_filter.rhs
+        )
+    if op == "lt":
+        args["op"] = "lt"
+    if len(values) > 0:
+        args["n"] = values[-1]
+        if sort_column is not None and values[0] is not None:
+            args["v"] = value_to_arg(values[0])
+    return url_for(
+        "csvbase.table_view",
+        username=table.username,
+        table_name=table.table_name,
+        _external=_external,
+        **args,
     )
-    return keyset
+
+
+def page_urls(
+    table: Table, keyset: KeySet, page: Page, _external: bool = False
+) -> Dict[str, Optional[str]]:
+    """The urls of the first, previous, next and last pages (where they
+    exist)."""
+    urls: Dict[str, Optional[str]] = {
+        "first": None,
+        "previous": None,
+        "next": None,
+        "last": None,
+    }
+    if page.has_less:
+        urls["first"] = keyset_url(table, keyset, "gt", _external=_external)
+        first_key = tuple(page.rows[0][c] for c in keyset.columns)
+        urls["previous"] = keyset_url(
+            table, keyset, "lt", first_key, _external=_external
+        )
+    if page.has_more:
+        urls["last"] = keyset_url(table, keyset, "lt", _external=_external)
+        last_key = tuple(page.rows[-1][c] for c in keyset.columns)
+        urls["next"] = keyset_url(table, keyset, "gt", last_key, _external=_external)
+    return urls
 
 
 def row_to_json_dict(table: Table, row: Row, omit_row_id=False) -> Dict[str, Any]:
@@ -1553,37 +1963,18 @@ def row_id_from_row(row: Row) -> int:
     return cast(int, row[ROW_ID_COLUMN])
 
 
-def page_to_json_dict(table: Table, page: Page) -> Dict[str, Any]:
+def page_to_json_dict(table: Table, page: Page, keyset: KeySet) -> Dict[str, Any]:
     rv: Dict[str, Any] = {}
     rv["rows"] = [row_to_json_dict(table, row) for row in page.rows]
-    if page.has_less:
-        # FIXME: these url_fors should be shared with the table_view template
-        rv["previous_page_url"] = url_for(
-            "csvbase.table_view",
-            username=table.username,
-            table_name=table.table_name,
-            op="lt",
-            n=page.rows[-1][ROW_ID_COLUMN],
-            _external=True,
-        )
-    else:
-        rv["previous_page_url"] = None
-
-    if page.has_more:
-        rv["next_page_url"] = url_for(
-            "csvbase.table_view",
-            username=table.username,
-            table_name=table.table_name,
-            op="gt",
-            n=page.rows[-1][ROW_ID_COLUMN],
-            _external=True,
-        )
-    else:
-        rv["next_page_url"] = None
+    urls = page_urls(table, keyset, page, _external=True)
+    rv["previous_page_url"] = urls["previous"]
+    rv["next_page_url"] = urls["next"]
     return rv
 
 
-def table_to_json_dict(table: Table, page: Optional[Page] = None) -> Dict[str, Any]:
+def table_to_json_dict(
+    table: Table, page: Optional[Page] = None, keyset: Optional[KeySet] = None
+) -> Dict[str, Any]:
     """Converts a table to a dict (including first page) for JSON."""
     if table.licence is not None:
         licence = table.licence.spdx_id
@@ -1603,7 +1994,9 @@ def table_to_json_dict(table: Table, page: Optional[Page] = None) -> Dict[str, A
         "approx_size": table.row_count.best(),
     }
     if page is not None:
-        rv["page"] = page_to_json_dict(table, page)
+        if keyset is None:
+            keyset = KeySet([ROW_ID_COLUMN], (), op="greater_than")
+        rv["page"] = page_to_json_dict(table, page, keyset)
     return rv
 
 
@@ -1705,6 +2098,29 @@ def get_user_str_buf() -> codecs.StreamReader:
     return str_buf
 
 
+def get_user_record_batches(
+    existing_columns: Optional[Sequence[Column]] = None,
+) -> Tuple[List[Column], Iterable[pa.RecordBatch]]:
+    """Return the columns and data of the table the user supplied in the
+    request body.
+
+    This is csv unless the content type says that it is parquet.
+
+    """
+    if request.mimetype == ContentType.PARQUET.value:
+        # parquet files have to be seekable, so spool to disk
+        byte_buf = tempfile.TemporaryFile()
+        with streams.rewind(byte_buf):
+            shutil.copyfileobj(request.stream, byte_buf)
+        pf = table_io.buf_to_pf(byte_buf)
+        columns = table_io.parquet_file_to_columns(pf, existing_columns)
+        return columns, table_io.parquet_file_to_record_batches(pf, columns)
+    else:
+        str_buf = get_user_str_buf()
+        dialect, columns = streams.peek_csv(str_buf, existing_columns)
+        return columns, table_io.csv_to_record_batches(str_buf, columns, dialect)
+
+
 def get_table_reps(sesh: Session, table: Table) -> List[TableRepresentation]:
     supported_content_types = [
         ContentType.CSV,
@@ -1713,7 +2129,7 @@ def get_table_reps(sesh: Session, table: Table) -> List[TableRepresentation]:
         ContentType.JSON_LINES,
     ]
 
-    rep_sizes = RepCache.sizes(table.table_uuid, table.last_changed)
+    rep_sizes = RepCache.sizes(table.table_uuid, table.version)
     backend = PGUserdataAdapter(sesh)
     is_big = backend.count(table.table_uuid).is_big()
 
@@ -5,7 +5,7 @@ import json
 import zlib
 import io
 from logging import getLogger
-from typing import List, Tuple, Dict, Mapping
+from typing import List, Tuple, Dict, Mapping, IO, Optional, cast
 import secrets
 from urllib.parse import urlparse, ParseResult
 
@@ -213,9 +213,12 @@ class CreateTableConfirm(MethodView):
             backend.create_table(table_uuid, columns)
             str_buf = streams.byte_buf_to_str_buf(gh_f.filelike)
             dialect = streams.sniff_csv(str_buf)
-            rows = table_io.csv_to_rows(str_buf, columns, dialect)
+            record_batches = table_io.csv_to_record_batches(str_buf, columns, dialect)
             table = svc.get_table(sesh, current_user.username, table_name)
-            backend.insert_table_data(table, columns, rows)
+            backend.insert_record_batches(table, columns, record_batches)
+            if len(unique_columns) > 0:
+                # created after loading, which is quicker than maintaining it
+                backend.create_key_index(table_uuid, unique_columns)
         svc.mark_table_changed(sesh, table.table_uuid)
         sesh.commit()
         return redirect(
@@ -268,26 +271,35 @@ def new_table_form_submission() -> Response:
     backend = PGUserdataAdapter(sesh)
 
     textarea = request.form.get("csv-textarea")
-    if textarea:
-        csv_buf = io.StringIO(textarea)
+    byte_buf: Optional[IO[bytes]] = (
+        None if textarea else cast(IO[bytes], request.files["csv-file"])
+    )
+    if byte_buf is not None and table_io.is_parquet(byte_buf):
+        pf = table_io.buf_to_pf(byte_buf)
+        columns = table_io.parquet_file_to_columns(pf)
+        backend.create_table(table_uuid, columns)
+        table = svc.get_table(sesh, current_user.username, table_name)
+        backend.insert_record_batches(
+            table, columns, table_io.parquet_file_to_record_batches(pf, columns)
+        )
     else:
-        byte_buf = request.files["csv-file"]
-        encoding = request.form.get("encoding", type=Encoding)
-        csv_buf = streams.byte_buf_to_str_buf(byte_buf, encoding)
+        if byte_buf is None:
+            csv_buf = io.StringIO(textarea)
+        else:
+            encoding = request.form.get("encoding", type=Encoding)
+            csv_buf = streams.byte_buf_to_str_buf(byte_buf, encoding)
 
-    try:
-        dialect, columns = streams.peek_csv(csv_buf)
-        backend.create_table(table_uuid, columns)
-        rows = table_io.csv_to_rows(csv_buf, columns, dialect)
-    except UnicodeDecodeError as e:
-        raise exc.WrongEncodingException() from e
-
-    table = svc.get_table(sesh, current_user.username, table_name)
-    backend.insert_table_data(
-        table,
-        columns,
-        rows,
-    )
+        try:
+            dialect, columns = streams.peek_csv(csv_buf)
+            backend.create_table(table_uuid, columns)
+            table = svc.get_table(sesh, current_user.username, table_name)
+            backend.insert_record_batches(
+                table,
+                columns,
+                table_io.csv_to_record_batches(csv_buf, columns, dialect),
+            )
+        except UnicodeDecodeError as e:
+            raise exc.WrongEncodingException() from e
     svc.mark_table_changed(sesh, table.table_uuid)
     sesh.commit()
     return redirect(
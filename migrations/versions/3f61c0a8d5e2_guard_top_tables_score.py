@@ -0,0 +1,59 @@
+"""Guard the top tables score against tables created after now()
+
+Revision ID: 3f61c0a8d5e2
+Revises: 7d3e91b0c2f4
+Create Date: 2026-10-17 19:02:44.180936+01:00
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "3f61c0a8d5e2"
+down_revision = "7d3e91b0c2f4"
+branch_labels = None
+depends_on = None
+
+# now() is the start of the refreshing transaction, which can be before a
+# table was created (eg: in the same transaction), which made the age zero or
+# negative
+SCORE_V1 = "count(praise_id) / extract(epoch FROM now() - created)"
+SCORE_V2 = "count(praise_id) / greatest(extract(epoch FROM now() - created), 1)"
+
+
+def create_view(score: str) -> None:
+    op.execute(
+        f"""
+    CREATE MATERIALIZED VIEW metadata.top_tables AS
+    SELECT
+        table_uuid,
+        {score} AS score,
+        created
+    FROM
+        metadata.tables
+        LEFT JOIN metadata.praise USING (table_uuid)
+    WHERE
+        public
+    GROUP BY
+        table_uuid
+    """
+    )
+    # a unique index is required to refresh concurrently
+    op.execute(
+        "CREATE UNIQUE INDEX top_tables_table_uuid ON metadata.top_tables (table_uuid)"
+    )
+    op.execute(
+        "CREATE INDEX top_tables_score ON metadata.top_tables"
+        " (score DESC, created DESC)"
+    )
+
+
+def upgrade():
+    op.execute("DROP MATERIALIZED VIEW metadata.top_tables")
+    create_view(SCORE_V2)
+
+
+def downgrade():
+    op.execute("DROP MATERIALIZED VIEW metadata.top_tables")
+    create_view(SCORE_V1)
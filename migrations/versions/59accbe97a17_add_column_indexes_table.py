@@ -0,0 +1,39 @@
+"""Add column indexes table
+
+Revision ID: 59accbe97a17
+Revises: a834ff8fe5b2
+Create Date: 2026-10-17 12:41:09.330118+01:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "59accbe97a17"
+down_revision = "a834ff8fe5b2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "column_indexes",
+        sa.Column("table_uuid", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("column_name", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["table_uuid"],
+            ["metadata.tables.table_uuid"],
+            name=op.f("fk_column_indexes_table_uuid_tables"),
+        ),
+        sa.PrimaryKeyConstraint(
+            "table_uuid", "column_name", name=op.f("pk_column_indexes")
+        ),
+        schema="metadata",
+    )
+
+
+def downgrade():
+    op.drop_table("column_indexes", schema="metadata")
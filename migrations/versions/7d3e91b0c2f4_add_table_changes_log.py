@@ -0,0 +1,150 @@
+"""Log userdata changes rather than updating row_counts
+
+Revision ID: 7d3e91b0c2f4
+Revises: a4b0ec1725ed
+Create Date: 2026-10-17 18:21:09.553102+01:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "7d3e91b0c2f4"
+down_revision = "a4b0ec1725ed"
+branch_labels = None
+depends_on = None
+
+COUNT_USERDATA_ROWS_V2 = """
+CREATE OR REPLACE FUNCTION metadata.count_userdata_rows() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed_table_uuid uuid := substring(TG_TABLE_NAME FROM 7)::uuid;
+    changed_rows bigint := 0;
+    row_count_change bigint := 0;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+        row_count_change := changed_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT count(*) INTO changed_rows FROM old_rows;
+        row_count_change := -changed_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+    END IF;
+
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE metadata.row_counts
+        SET row_count = 0,
+            version = nextval('metadata.table_versions'),
+            data_changed = now()
+        WHERE table_uuid = changed_table_uuid;
+    ELSIF changed_rows > 0 THEN
+        UPDATE metadata.row_counts
+        SET row_count = row_count + row_count_change,
+            version = nextval('metadata.table_versions'),
+            data_changed = now()
+        WHERE table_uuid = changed_table_uuid;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# changes are appended to metadata.table_changes, which doesn't lock anything
+# that other writers need.  Truncates still update row_counts directly, but
+# they already take an exclusive lock on the whole table.
+COUNT_USERDATA_ROWS_V3 = """
+CREATE OR REPLACE FUNCTION metadata.count_userdata_rows() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed_table_uuid uuid := substring(TG_TABLE_NAME FROM 7)::uuid;
+    changed_rows bigint := 0;
+    row_count_change bigint := 0;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+        row_count_change := changed_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT count(*) INTO changed_rows FROM old_rows;
+        row_count_change := -changed_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+    END IF;
+
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM metadata.table_changes
+        WHERE table_uuid = changed_table_uuid;
+        UPDATE metadata.row_counts
+        SET row_count = 0,
+            version = nextval('metadata.table_versions'),
+            data_changed = now()
+        WHERE table_uuid = changed_table_uuid;
+    ELSIF changed_rows > 0 THEN
+        INSERT INTO metadata.table_changes (table_uuid, row_count_change)
+        VALUES (changed_table_uuid, row_count_change);
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def upgrade():
+    op.create_table(
+        "table_changes",
+        sa.Column(
+            "version",
+            sa.BigInteger(),
+            server_default=sa.text("nextval('metadata.table_versions')"),
+            nullable=False,
+        ),
+        sa.Column("table_uuid", postgresql.UUID(), nullable=False),
+        sa.Column("row_count_change", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "changed",
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("version", name=op.f("pk_table_changes")),
+        schema="metadata",
+    )
+    op.create_index(
+        op.f("ix_metadata_table_changes_table_uuid"),
+        "table_changes",
+        ["table_uuid"],
+        unique=False,
+        schema="metadata",
+    )
+    op.execute(COUNT_USERDATA_ROWS_V3)
+
+
+def downgrade():
+    op.execute(COUNT_USERDATA_ROWS_V2)
+    # fold any outstanding changes in before dropping the log
+    op.execute(
+        """
+    UPDATE metadata.row_counts AS rc
+    SET row_count = rc.row_count + tc.row_count_change,
+        version = greatest(rc.version, tc.version),
+        data_changed = greatest(rc.data_changed, tc.changed)
+    FROM (
+        SELECT
+            table_uuid,
+            sum(row_count_change) AS row_count_change,
+            max(version) AS version,
+            max(changed) AS changed
+        FROM metadata.table_changes
+        GROUP BY table_uuid) AS tc
+    WHERE tc.table_uuid = rc.table_uuid
+    """
+    )
+    op.drop_index(
+        op.f("ix_metadata_table_changes_table_uuid"),
+        table_name="table_changes",
+        schema="metadata",
+    )
+    op.drop_table("table_changes", schema="metadata")
@@ -0,0 +1,149 @@
+"""Add table versions
+
+Revision ID: a4b0ec1725ed
+Revises: 59accbe97a17
+Create Date: 2026-10-17 13:52:30.104211+01:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "a4b0ec1725ed"
+down_revision = "59accbe97a17"
+branch_labels = None
+depends_on = None
+
+COUNT_USERDATA_ROWS_V1 = """
+CREATE OR REPLACE FUNCTION metadata.count_userdata_rows() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed_table_uuid uuid := substring(TG_TABLE_NAME FROM 7)::uuid;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE metadata.row_counts
+        SET row_count = row_count + (SELECT count(*) FROM new_rows)
+        WHERE table_uuid = changed_table_uuid;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE metadata.row_counts
+        SET row_count = row_count - (SELECT count(*) FROM old_rows)
+        WHERE table_uuid = changed_table_uuid;
+    ELSE
+        UPDATE metadata.row_counts
+        SET row_count = 0
+        WHERE table_uuid = changed_table_uuid;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# as well as counting rows, every statement that changes any gives the table
+# a new version
+COUNT_USERDATA_ROWS_V2 = """
+CREATE OR REPLACE FUNCTION metadata.count_userdata_rows() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    changed_table_uuid uuid := substring(TG_TABLE_NAME FROM 7)::uuid;
+    changed_rows bigint := 0;
+    row_count_change bigint := 0;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+        row_count_change := changed_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT count(*) INTO changed_rows FROM old_rows;
+        row_count_change := -changed_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        SELECT count(*) INTO changed_rows FROM new_rows;
+    END IF;
+
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE metadata.row_counts
+        SET row_count = 0,
+            version = nextval('metadata.table_versions'),
+            data_changed = now()
+        WHERE table_uuid = changed_table_uuid;
+    ELSIF changed_rows > 0 THEN
+        UPDATE metadata.row_counts
+        SET row_count = row_count + row_count_change,
+            version = nextval('metadata.table_versions'),
+            data_changed = now()
+        WHERE table_uuid = changed_table_uuid;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+
+def userdata_tables():
+    return [
+        row[0]
+        for row in op.get_bind().execute(
+            sa.text(
+                "SELECT tablename FROM pg_tables WHERE schemaname = 'userdata'"
+                " AND tablename ~ '^table_[0-9a-f]{32}$'"
+            )
+        )
+    ]
+
+
+def upgrade():
+    op.execute("CREATE SEQUENCE metadata.table_versions")
+    op.add_column(
+        "row_counts",
+        sa.Column(
+            "version",
+            sa.BigInteger(),
+            server_default=sa.text("nextval('metadata.table_versions')"),
+            nullable=False,
+        ),
+        schema="metadata",
+    )
+    op.add_column(
+        "row_counts",
+        sa.Column(
+            "data_changed",
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        schema="metadata",
+    )
+    # otherwise every table would look changed since last_changed
+    op.execute(
+        """
+    UPDATE metadata.row_counts AS rc
+    SET data_changed = t.last_changed
+    FROM metadata.tables AS t
+    WHERE t.table_uuid = rc.table_uuid
+    """
+    )
+    op.execute(COUNT_USERDATA_ROWS_V2)
+    tables = userdata_tables()
+    with op.get_context().autocommit_block():
+        for userdata_table in tables:
+            op.execute(
+                f"""
+            CREATE TRIGGER version_updates AFTER UPDATE ON userdata.{userdata_table}
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT
+            EXECUTE FUNCTION metadata.count_userdata_rows();
+            """
+            )
+
+
+def downgrade():
+    tables = userdata_tables()
+    with op.get_context().autocommit_block():
+        for userdata_table in tables:
+            op.execute(
+                f"DROP TRIGGER IF EXISTS version_updates ON userdata.{userdata_table}"
+            )
+    op.execute(COUNT_USERDATA_ROWS_V1)
+    op.drop_column("row_counts", "data_changed", schema="metadata")
+    op.drop_column("row_counts", "version", schema="metadata")
+    op.execute("DROP SEQUENCE metadata.table_versions")
@@ -0,0 +1,47 @@
+"""Add top tables materialized view
+
+Revision ID: a4c2f1d9e803
+Revises: 757b465597b4
+Create Date: 2026-10-17 10:12:31.204761+01:00
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "a4c2f1d9e803"
+down_revision = "757b465597b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+    CREATE MATERIALIZED VIEW metadata.top_tables AS
+    SELECT
+        table_uuid,
+        count(praise_id) / extract(epoch FROM now() - created) AS score,
+        created
+    FROM
+        metadata.tables
+        LEFT JOIN metadata.praise USING (table_uuid)
+    WHERE
+        public
+    GROUP BY
+        table_uuid
+    """
+    )
+    # a unique index is required to refresh concurrently
+    op.execute(
+        "CREATE UNIQUE INDEX top_tables_table_uuid ON metadata.top_tables (table_uuid)"
+    )
+    op.execute(
+        "CREATE INDEX top_tables_score ON metadata.top_tables"
+        " (score DESC, created DESC)"
+    )
+
+
+def downgrade():
+    op.execute("DROP MATERIALIZED VIEW metadata.top_tables")
@@ -0,0 +1,106 @@
+"""Add trigger-maintained row counts
+
+Revision ID: a834ff8fe5b2
+Revises: a4c2f1d9e803
+Create Date: 2026-10-17 11:02:47.518230+01:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "a834ff8fe5b2"
+down_revision = "a4c2f1d9e803"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "row_counts",
+        sa.Column("table_uuid", postgresql.UUID(), nullable=False),
+        sa.Column("row_count", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("table_uuid", name=op.f("pk_row_counts")),
+        schema="metadata",
+    )
+    # the table uuid is taken from the name of the userdata table, so that
+    # the triggers survive the table being renamed into place
+    op.execute(
+        """
+    CREATE FUNCTION metadata.count_userdata_rows() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        changed_table_uuid uuid := substring(TG_TABLE_NAME FROM 7)::uuid;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE metadata.row_counts
+            SET row_count = row_count + (SELECT count(*) FROM new_rows)
+            WHERE table_uuid = changed_table_uuid;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE metadata.row_counts
+            SET row_count = row_count - (SELECT count(*) FROM old_rows)
+            WHERE table_uuid = changed_table_uuid;
+        ELSE
+            UPDATE metadata.row_counts
+            SET row_count = 0
+            WHERE table_uuid = changed_table_uuid;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """
+    )
+    # each table is done in its own transaction, otherwise a lock is held on
+    # every userdata table at once
+    userdata_tables = [
+        row[0]
+        for row in op.get_bind().execute(
+            sa.text(
+                "SELECT tablename FROM pg_tables WHERE schemaname = 'userdata'"
+                " AND tablename ~ '^table_[0-9a-f]{32}$'"
+            )
+        )
+    ]
+    with op.get_context().autocommit_block():
+        for userdata_table in userdata_tables:
+            op.execute(
+                f"""
+            CREATE TRIGGER count_inserts AFTER INSERT ON userdata.{userdata_table}
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT
+            EXECUTE FUNCTION metadata.count_userdata_rows();
+            CREATE TRIGGER count_deletes AFTER DELETE ON userdata.{userdata_table}
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT
+            EXECUTE FUNCTION metadata.count_userdata_rows();
+            CREATE TRIGGER count_truncates AFTER TRUNCATE ON userdata.{userdata_table}
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION metadata.count_userdata_rows();
+            INSERT INTO metadata.row_counts (table_uuid, row_count)
+            SELECT '{userdata_table[6:]}', count(*) FROM userdata.{userdata_table};
+            """
+            )
+
+
+def downgrade():
+    userdata_tables = [
+        row[0]
+        for row in op.get_bind().execute(
+            sa.text(
+                "SELECT tablename FROM pg_tables WHERE schemaname = 'userdata'"
+                " AND tablename ~ '^table_[0-9a-f]{32}$'"
+            )
+        )
+    ]
+    with op.get_context().autocommit_block():
+        for userdata_table in userdata_tables:
+            op.execute(
+                f"""
+            DROP TRIGGER IF EXISTS count_inserts ON userdata.{userdata_table};
+            DROP TRIGGER IF EXISTS count_deletes ON userdata.{userdata_table};
+            DROP TRIGGER IF EXISTS count_truncates ON userdata.{userdata_table};
+            """
+            )
+    op.execute("DROP FUNCTION metadata.count_userdata_rows()")
+    op.drop_table("row_counts", schema="metadata")
@@ -0,0 +1,35 @@
+"""Add column uses table
+
+Revision ID: b52e07d9a1c3
+Revises: 3f61c0a8d5e2
+Create Date: 2026-10-17 21:04:37.219846+01:00
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "b52e07d9a1c3"
+down_revision = "3f61c0a8d5e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "column_uses",
+        sa.Column("table_uuid", postgresql.UUID(), nullable=False),
+        sa.Column("column_name", sa.String(), nullable=False),
+        sa.Column("uses", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint(
+            "table_uuid", "column_name", name=op.f("pk_column_uses")
+        ),
+        schema="metadata",
+    )
+
+
+def downgrade():
+    op.drop_table("column_uses", schema="metadata")
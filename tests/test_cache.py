@@ -0,0 +1,246 @@
+from datetime import datetime, timedelta, timezone
+from typing import Generator
+from unittest.mock import patch
+
+import pytest
+
+from csvbase import svc
+from csvbase.cache import (
+    get_metadata_cache,
+    MetadataCache,
+    LocalClient,
+    TABLE,
+    USER,
+    _name_key,
+)
+from csvbase.exc import UserDoesNotExistException
+from csvbase.value_objs import (
+    Column,
+    ColumnType,
+    GitUpstream,
+    Licence,
+    ROW_ID_COLUMN,
+)
+from csvbase.userdata import PGUserdataAdapter
+
+from .utils import create_table, random_string, count_queries
+
+
+def test_get_table__loads_everything(sesh, test_user):
+    a_col = Column("a", ColumnType.TEXT)
+    licence = Licence.from_spdx_id("CC0-1.0")
+    table = create_table(sesh, test_user, [a_col], caption="cached", licence=licence)
+    svc.set_key(sesh, table.table_uuid, [a_col])
+    sesh.commit()
+
+    actual = svc.get_table(sesh, test_user.username, table.table_name)
+    assert actual.columns == [ROW_ID_COLUMN, a_col]
+    assert actual.caption == "cached"
+    assert actual.licence == licence
+    assert actual.key == [a_col]
+    assert actual.row_count.exact == 0
+    assert actual.upstream is None
+
+
+def test_get_table__cache_hit_makes_no_queries(sesh, ten_rows):
+    svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    with count_queries(sesh) as statements:
+        table = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert statements == []
+    assert table.row_count.best() == 10
+
+
+def test_get_table__miss_is_one_query_for_metadata(sesh, ten_rows):
+    get_metadata_cache().client.flush_all()
+    with count_queries(sesh) as statements:
+        svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    # the row count comes along with the metadata
+    assert len(statements) == 1
+
+
+def test_get_table__invalidated_by_mark_table_changed(sesh, ten_rows):
+    before = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    svc.mark_table_changed(sesh, ten_rows.table_uuid)
+    sesh.commit()
+    after = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert after.last_changed > before.last_changed
+
+
+def test_get_table__invalidated_by_settings_change(sesh, ten_rows):
+    svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    svc.update_table_metadata(sesh, ten_rows.table_uuid, False, "new caption", None)
+    sesh.commit()
+    after = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert after.caption == "new caption"
+    assert not after.is_public
+
+
+def test_get_table__invalidated_by_row_writes(sesh, ten_rows):
+    backend = PGUserdataAdapter(sesh)
+    svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    backend.delete_row(ten_rows.table_uuid, 1)
+    sesh.commit()
+    after = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert after.row_count.best() == 9
+
+
+def test_get_table__rollback_invalidates(sesh, ten_rows):
+    svc.update_table_metadata(sesh, ten_rows.table_uuid, True, "uncommitted", None)
+    uncommitted = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert uncommitted.caption == "uncommitted"
+    sesh.rollback()
+    after = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert after.caption == "Roman numerals"
+
+
+def test_get_table__copies_are_returned(sesh, ten_rows):
+    first = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    first.caption = "mutated"
+    second = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert second.caption == "Roman numerals"
+
+
+@pytest.fixture()
+def shared_cache() -> Generator[MetadataCache, None, None]:
+    """Swap in a cache which behaves like memcached, ie: with no expiry."""
+    metadata_cache = MetadataCache(LocalClient(), timedelta(days=1))
+    with patch("csvbase.cache.__metadata_cache__", metadata_cache):
+        yield metadata_cache
+
+
+def test_shared_cache__invalidation_from_another_process(sesh, ten_rows, shared_cache):
+    # first get resolves the name, second stores the table, third is a hit
+    for _ in range(3):
+        svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    with count_queries(sesh) as statements:
+        svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert statements == []
+
+    # a different process, sharing the same memcached
+    other_process_cache = MetadataCache(shared_cache.client, timedelta(days=1))
+    other_process_cache.invalidate("table", ten_rows.table_uuid)
+
+    with count_queries(sesh) as statements:
+        svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert len(statements) > 0
+
+
+def test_shared_cache__stale_puts_are_never_used(ten_rows, shared_cache):
+    shared_cache.put_table(ten_rows, None)
+    _, generation = shared_cache.get_table(ten_rows.username, ten_rows.table_name)
+
+    # it changes while being loaded from the db...
+    shared_cache.invalidate("table", ten_rows.table_uuid)
+    shared_cache.put_table(ten_rows, generation)
+
+    table, _ = shared_cache.get_table(ten_rows.username, ten_rows.table_name)
+    assert table is None
+
+
+def test_shared_cache__table_roundtrip(ten_rows, shared_cache):
+    ten_rows.licence = Licence.from_spdx_id("CC0-1.0")
+    ten_rows.key = [ten_rows.columns[1]]
+    ten_rows.upstream = GitUpstream(
+        last_modified=datetime(2018, 1, 3, tzinfo=timezone.utc),
+        last_sha=b"f" * 20,
+        repo_url="https://github.com/calpaterson/csvbase.git",
+        branch="main",
+        path="examples/moocows.csv",
+    )
+    ten_rows.indexed_columns = [ten_rows.columns[2]]
+    shared_cache.put_table(ten_rows, None)
+    _, generation = shared_cache.get_table(ten_rows.username, ten_rows.table_name)
+    shared_cache.put_table(ten_rows, generation)
+
+    actual, _ = shared_cache.get_table(ten_rows.username, ten_rows.table_name)
+    assert actual == ten_rows
+
+
+def test_shared_cache__users(sesh, test_user, shared_cache):
+    for _ in range(2):
+        svc.user_by_name(sesh, test_user.username)
+    # only the api key is loaded
+    with count_queries(sesh) as statements:
+        by_name = svc.user_by_name(sesh, test_user.username)
+        by_uuid = svc.user_by_user_uuid(sesh, test_user.user_uuid)
+    assert len(statements) == 2
+    assert by_name == by_uuid
+    assert by_name.api_key == test_user.api_key
+
+    by_name.settings.timezone = "Europe/London"
+    svc.update_user(sesh, by_name)
+    sesh.commit()
+
+    assert svc.user_by_name(sesh, test_user.username).settings.timezone == (
+        "Europe/London"
+    )
+
+
+def test_shared_cache__api_keys_are_not_stored(sesh, test_user, shared_cache):
+    for _ in range(2):
+        svc.user_by_name(sesh, test_user.username)
+    stored = b"".join(value for _, value in shared_cache.client._entries.values())
+    assert test_user.hex_api_key().encode("utf-8") not in stored
+    assert test_user.api_key not in stored
+
+
+def test_shared_cache__name_given_to_another_table(ten_rows, shared_cache):
+    shared_cache.put_table(ten_rows, None)
+    _, generation = shared_cache.get_table(ten_rows.username, ten_rows.table_name)
+    shared_cache.put_table(ten_rows, generation)
+
+    # a stale name points at a table that is now called something else
+    other_name = random_string()
+    shared_cache.client.set_many(
+        {
+            _name_key(TABLE, f"{ten_rows.username}/{other_name}"): str(
+                ten_rows.table_uuid
+            ).encode("utf-8")
+        }
+    )
+    assert shared_cache.get_table(ten_rows.username, other_name) == (None, None)
+
+
+def test_shared_cache__name_given_to_another_user(sesh, test_user, shared_cache):
+    for _ in range(2):
+        svc.user_by_name(sesh, test_user.username)
+
+    other_name = random_string()
+    shared_cache.client.set_many(
+        {_name_key(USER, other_name): str(test_user.user_uuid).encode("utf-8")}
+    )
+    with pytest.raises(UserDoesNotExistException):
+        svc.user_by_name(sesh, other_name)
+
+
+def test_shared_cache__deleted_and_recreated_table(sesh, test_user, shared_cache):
+    table_name = random_string()
+    first = create_table(sesh, test_user, table_name=table_name)
+    sesh.commit()
+    svc.get_table(sesh, test_user.username, table_name)
+
+    svc.delete_table_and_metadata(sesh, test_user.username, table_name)
+    sesh.commit()
+    second = create_table(sesh, test_user, table_name=table_name)
+    sesh.commit()
+
+    for _ in range(2):
+        actual = svc.get_table(sesh, test_user.username, table_name)
+        assert actual.table_uuid == second.table_uuid != first.table_uuid
+
+
+class BrokenClient:
+    def get_many(self, keys):
+        raise ConnectionRefusedError()
+
+    def set_many(self, values, expire=0):
+        raise ConnectionRefusedError()
+
+
+def test_shared_cache__unavailable(sesh, ten_rows):
+    with patch(
+        "csvbase.cache.__metadata_cache__",
+        MetadataCache(BrokenClient(), timedelta(days=1)),
+    ):
+        table = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    assert table.table_uuid == ten_rows.table_uuid
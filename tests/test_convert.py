@@ -69,6 +69,25 @@ def test_convert__a_to_b(client, test_user, from_format, to_format):
     assert_frame_equal(SAMPLE_DATAFRAME, actual_dataframe)
 
 
+def test_convert__from_parquet(client):
+    df = pd.DataFrame({"id": [3, 1, 2], "value": ["a", "b", "c"]})
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False)
+    buf.seek(0)
+
+    post_resp = client.post(
+        "/convert",
+        data={
+            "from-format": ContentType.PARQUET.value,
+            "to-format": ContentType.JSON_LINES.value,
+            "file": (FileStorage(buf, "test.parquet")),
+        },
+        content_type="multipart/form-data",
+    )
+    assert post_resp.status_code == 200
+    assert_frame_equal(df, pd.read_json(io.BytesIO(post_resp.data), lines=True))
+
+
 @pytest.mark.xfail(reason="not implemented")
 def test_convert__unreadable_file():
     assert False
@@ -96,6 +96,27 @@ def test_uploading_a_table(client, test_user):
         assert resp.headers["Location"] == f"/{test_user.username}/{table_name}"
 
 
+def test_uploading_a_table__parquet(client, test_user):
+    table_name = f"test-table-{random_string()}"
+    parquet_buf = BytesIO()
+    pd.DataFrame({"a": [1, 2], "b": ["x", "y"]}).to_parquet(parquet_buf, index=False)
+    parquet_buf.seek(0)
+    with current_user(test_user):
+        resp = client.post(
+            "/new-table",
+            data={
+                "table-name": table_name,
+                "licence": "CC-BY-SA-4.0",
+                "csv-file": (FileStorage(parquet_buf, "test.parquet")),
+            },
+            content_type="multipart/form-data",
+        )
+        assert resp.status_code == 302
+
+        actual_df = get_df_as_csv(client, f"/{test_user.username}/{table_name}")
+    assert actual_df.to_dict(orient="list") == {"a": [1, 2], "b": ["x", "y"]}
+
+
 def test_uploading_a_table__csvbase_row_ids(client, test_user, ten_rows):
     """Test that users can export tables with the row ids in them and then
     re-upload them.
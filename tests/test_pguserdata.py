@@ -1,7 +1,33 @@
-from csvbase.value_objs import Column, ColumnType, ROW_ID_COLUMN
-from csvbase.userdata import PGUserdataAdapter
+from contextlib import closing
+from dataclasses import replace
+from datetime import date
+import math
+import threading
+from typing import Tuple
+from unittest.mock import patch
 
-from .utils import create_table
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+
+from csvbase import models, svc, table_io
+from csvbase.config import get_config
+from csvbase.repcache import RepCache
+from csvbase.value_objs import (
+    Column,
+    ColumnType,
+    ContentType,
+    RowCount,
+    RowOperation,
+    RowOperationResult,
+    UpsertCounts,
+    ROW_ID_COLUMN,
+)
+from csvbase.userdata import PGUserdataAdapter, pguserdata
+
+from .utils import count_queries, create_table
 
 
 def test_row_id_bounds(sesh, ten_rows):
@@ -48,7 +74,8 @@ def test_upsert__by_csvbase_row_id(sesh, test_user):
         (None, 11),  # new row
     ]  # all other rows deleted implicitly
 
-    backend.upsert_table_data(test_table, (ROW_ID_COLUMN, n_col), upsert)
+    counts = backend.upsert_table_data(test_table, (ROW_ID_COLUMN, n_col), upsert)
+    assert counts == UpsertCounts(inserted=1, updated=1, deleted=8, unchanged=1)
 
     end_state = list(backend.table_as_rows(test_table.table_uuid))
     assert end_state == [
@@ -58,6 +85,28 @@ def test_upsert__by_csvbase_row_id(sesh, test_user):
     ]
 
 
+def test_upsert_record_batches(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+
+    n_col = Column("n", ColumnType.INTEGER)
+    test_table = create_table(sesh, test_user, [n_col])
+    backend.insert_table_data(test_table, [n_col], [[n] for n in range(1, 11)])
+
+    schema = table_io.arrow_schema([ROW_ID_COLUMN, n_col])
+    record_batches = [
+        pa.RecordBatch.from_pydict(
+            {"csvbase_row_id": [1, 3], "n": [1, 5]}, schema=schema
+        ),
+        pa.RecordBatch.from_pydict(
+            {"csvbase_row_id": [None], "n": [11]}, schema=schema
+        ),
+    ]
+    backend.upsert_record_batches(test_table, (ROW_ID_COLUMN, n_col), record_batches)
+
+    end_state = list(backend.table_as_rows(test_table.table_uuid))
+    assert end_state == [(1, 1), (3, 5), (11, 11)]
+
+
 def test_upsert__by_other_unique_key(sesh, test_user):
     backend = PGUserdataAdapter(sesh)
 
@@ -96,3 +145,606 @@ def test_upsert__by_other_unique_key(sesh, test_user):
     ]
 
     assert expected == actual
+
+
+def row_versions(sesh, table):
+    """Return the transaction id that last wrote each row, by csvbase_row_id"""
+    table_name = f"userdata.table_{table.table_uuid.hex}"
+    rs = sesh.execute(text(f"SELECT csvbase_row_id, xmin::text FROM {table_name}"))
+    return {row_id: xmin for row_id, xmin in rs}
+
+
+def test_upsert__only_changed_rows_are_updated(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    pop_col = Column("population", ColumnType.INTEGER)
+    test_table = create_table(sesh, test_user, [country_col, pop_col])
+    backend.insert_table_data(
+        test_table, [country_col, pop_col], [("UK", 10), ("FR", 9), ("US", 1)]
+    )
+    sesh.commit()
+    before = row_versions(sesh, test_table)
+
+    counts = backend.upsert_table_data(
+        test_table,
+        [country_col, pop_col],
+        [("UK", 10), ("FR", 8), ("DE", 3)],
+        key=(country_col,),
+        delete_missing=False,
+    )
+    assert counts == UpsertCounts(inserted=1, updated=1, deleted=0, unchanged=1)
+    sesh.commit()
+    after = row_versions(sesh, test_table)
+
+    assert list(backend.table_as_rows(test_table.table_uuid)) == [
+        (1, "UK", 10),
+        (2, "FR", 8),
+        (3, "US", 1),
+        (4, "DE", 3),
+    ]
+    assert after[1] == before[1]
+    assert after[2] != before[2]
+    assert after[3] == before[3]
+
+
+def test_upsert__creates_key_index(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.upsert_table_data(
+        test_table, [country_col], [("UK",), ("FR",)], key=(country_col,)
+    )
+    indexdef = sesh.execute(
+        text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+        {"name": f"table_{test_table.table_uuid.hex}_key"},
+    ).scalar()
+    assert "UNIQUE" in indexdef
+
+
+def test_upsert__duplicate_keys(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    pop_col = Column("population", ColumnType.INTEGER)
+    test_table = create_table(sesh, test_user, [country_col, pop_col])
+    backend.insert_table_data(
+        test_table, [country_col, pop_col], [("UK", 10), ("UK", 11)]
+    )
+    assert not backend.create_key_index(test_table.table_uuid, [country_col])
+
+    # still possible to update, just not to upsert
+    counts = backend.upsert_table_data(
+        test_table,
+        [country_col, pop_col],
+        [("UK", 12), ("FR", 9), ("FR", 9)],
+        key=(country_col,),
+    )
+    assert counts == UpsertCounts(inserted=2, updated=2, deleted=0, unchanged=0)
+    assert sorted(
+        (row[1:] for row in backend.table_as_rows(test_table.table_uuid)), key=str
+    ) == [
+        ("FR", 9),
+        ("FR", 9),
+        ("UK", 12),
+        ("UK", 12),
+    ]
+
+
+def test_upsert__duplicate_new_keys(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.upsert_table_data(test_table, [country_col], [("UK",)], key=(country_col,))
+    backend.upsert_table_data(
+        test_table, [country_col], [("UK",), ("FR",), ("FR",)], key=(country_col,)
+    )
+    assert sorted(
+        (row[1:] for row in backend.table_as_rows(test_table.table_uuid)), key=str
+    ) == [
+        ("FR",),
+        ("FR",),
+        ("UK",),
+    ]
+
+
+ALL_TYPES_COLUMNS = [
+    Column("t", ColumnType.TEXT),
+    Column("i", ColumnType.INTEGER),
+    Column("f", ColumnType.FLOAT),
+    Column("b", ColumnType.BOOLEAN),
+    Column("d", ColumnType.DATE),
+]
+
+ALL_TYPES_ROWS = [
+    ("a", 1, 1.5, True, date(2018, 1, 3)),
+    ("€ ünïcode ✓", -(2**62), -0.25, False, date(1970, 1, 1)),
+    ("", 2**62, 1e300, True, date(1066, 10, 14)),
+    (None, None, None, None, None),
+]
+
+
+def test_table_as_rows__all_types(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    backend.insert_table_data(table, ALL_TYPES_COLUMNS, ALL_TYPES_ROWS)
+
+    actual = list(backend.table_as_rows(table.table_uuid))
+    assert actual == [
+        (row_id, *row) for row_id, row in enumerate(ALL_TYPES_ROWS, start=1)
+    ]
+
+
+def test_table_as_rows__empty(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    assert list(backend.table_as_rows(table.table_uuid)) == []
+
+
+def test_table_as_record_batches__all_types(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    backend.insert_table_data(
+        table,
+        ALL_TYPES_COLUMNS,
+        ALL_TYPES_ROWS + [('quoted "\n\r, chars', 0, float("inf"), True, None)],
+    )
+
+    batches = list(backend.table_as_record_batches(table.table_uuid))
+    actual = [tuple(row.values()) for batch in batches for row in batch.to_pylist()]
+    assert actual == list(backend.table_as_rows(table.table_uuid))
+
+
+def test_table_as_record_batches__nan(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    f_col = Column("f", ColumnType.FLOAT)
+    table = create_table(sesh, test_user, [f_col])
+    backend.insert_table_data(table, [f_col], [(float("nan"),)])
+
+    (batch,) = backend.table_as_record_batches(table.table_uuid)
+    assert math.isnan(batch.column("f")[0].as_py())
+
+
+def test_table_as_record_batches__empty(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    assert list(backend.table_as_record_batches(table.table_uuid)) == []
+
+
+@pytest.fixture()
+def big_text_table(sesh, test_user):
+    text_col = Column("t", ColumnType.TEXT)
+    table = create_table(sesh, test_user, [text_col])
+    sesh.execute(
+        text(
+            f"INSERT INTO userdata.table_{table.table_uuid.hex} (t)"
+            " SELECT repeat('x', 100) FROM generate_series(1, 200000)"
+        )
+    )
+    return table
+
+
+def test_table_as_record_batches__streams(sesh, big_text_table):
+    backend = PGUserdataAdapter(sesh)
+    batches = backend.table_as_record_batches(big_text_table.table_uuid)
+    next(batches)
+    # the first batch comes before the COPY is done
+    assert any(thread.name == "copy-out" for thread in threading.enumerate())
+
+    # and once abandoned the rest is dropped, leaving the connection usable
+    batches.close()
+    assert not any(thread.name == "copy-out" for thread in threading.enumerate())
+    assert backend.count(big_text_table.table_uuid).exact == 200_000
+
+
+def test_copy_out__errors_are_raised(sesh):
+    copy_out = pguserdata._CopyOut(
+        sesh.connection().connection,
+        "COPY (SELECT 1 / (3 - n) FROM generate_series(1, 5) AS n) TO STDOUT",
+    )
+    with pytest.raises(Exception, match="division by zero"):
+        with closing(copy_out):
+            list(copy_out.chunks())
+    sesh.rollback()
+
+
+def test_populate_repcache__parquet(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    n_col = Column("n", ColumnType.INTEGER)
+    table = create_table(sesh, test_user, [n_col])
+    backend.insert_table_data(table, [n_col], [(n,) for n in range(12_000)])
+    svc.mark_table_changed(sesh, table.table_uuid)
+    sesh.commit()
+
+    svc.populate_repcache(sesh, table.table_uuid, ContentType.PARQUET)
+
+    table = svc.get_table(sesh, test_user.username, table.table_name)
+    repcache = RepCache(table.table_uuid, ContentType.PARQUET, table.version)
+    with repcache.open("rb") as rep_file:
+        pf = pq.ParquetFile(rep_file)
+        assert pf.metadata.num_rows == 12_000
+        assert (
+            max(pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups))
+            <= 5_000
+        )
+        assert pf.read().column("n").to_pylist() == list(range(12_000))
+
+
+def test_populate_repcache__parquet_empty(sesh, test_user):
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    sesh.commit()
+
+    svc.populate_repcache(sesh, table.table_uuid, ContentType.PARQUET)
+
+    repcache = RepCache(table.table_uuid, ContentType.PARQUET, table.version)
+    with repcache.open("rb") as rep_file:
+        pf = pq.ParquetFile(rep_file)
+        assert pf.metadata.num_rows == 0
+        assert pf.schema_arrow.names == [c.name for c in table.columns]
+
+
+def test_insert_record_batches__all_types(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    table = create_table(sesh, test_user, ALL_TYPES_COLUMNS)
+    schema = table_io.arrow_schema(ALL_TYPES_COLUMNS)
+    rows = ALL_TYPES_ROWS + [('quoted "\n\r, chars', 0, float("inf"), True, None)]
+    record_batch = pa.RecordBatch.from_arrays(
+        [
+            pa.array(values, type=field.type)
+            for values, field in zip(zip(*rows), schema)
+        ],
+        schema=schema,
+    )
+    backend.insert_record_batches(
+        table, ALL_TYPES_COLUMNS, [record_batch, record_batch]
+    )
+
+    actual = [row[1:] for row in backend.table_as_rows(table.table_uuid)]
+    assert actual == rows + rows
+
+
+def test_upsert__large_staging_table(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    pop_col = Column("population", ColumnType.INTEGER)
+    test_table = create_table(sesh, test_user, [country_col, pop_col])
+    backend.insert_table_data(
+        test_table, [country_col, pop_col], [("UK", 10), ("FR", 9)]
+    )
+
+    with patch.object(pguserdata, "STAGING_INDEX_THRESHOLD", 1):
+        with patch.object(get_config(), "upsert_work_mem", "64MB"):
+            counts = backend.upsert_table_data(
+                test_table,
+                [country_col, pop_col],
+                [("UK", 11), ("FR", 9), ("DE", 3)],
+                key=(country_col,),
+            )
+
+    assert counts == UpsertCounts(inserted=1, updated=1, deleted=0, unchanged=1)
+    staging_indexes = sesh.execute(
+        text(
+            "SELECT count(*) FROM pg_indexes"
+            " WHERE schemaname LIKE 'pg_temp%' AND tablename LIKE 'upsert%'"
+        )
+    ).scalar()
+    assert staging_indexes == 1
+    assert sesh.execute(text("SHOW work_mem")).scalar() == "64MB"
+
+
+def test_replace_record_batches(sesh, session_cls, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("FR",)])
+    sesh.commit()
+
+    def record_batches():
+        # while the new data is being loaded, the old is still readable
+        with session_cls() as other_sesh:
+            other_sesh.execute(text("SET lock_timeout = '1s'"))
+            other_backend = PGUserdataAdapter(other_sesh)
+            assert list(other_backend.table_as_rows(test_table.table_uuid)) == [
+                (1, "UK"),
+                (2, "FR"),
+            ]
+        yield pa.RecordBatch.from_pydict({"country": ["DE", "US"]})
+
+    backend.replace_record_batches(test_table, [country_col], record_batches())
+    sesh.commit()
+
+    # the csvbase_row_ids carry on from where they were
+    assert list(backend.table_as_rows(test_table.table_uuid)) == [
+        (3, "DE"),
+        (4, "US"),
+    ]
+    backend.insert_table_data(test_table, [country_col], [("IT",)])
+    assert list(backend.table_as_rows(test_table.table_uuid))[-1] == (5, "IT")
+
+    # and replacing can be done again
+    backend.replace_record_batches(
+        test_table,
+        [country_col],
+        [pa.RecordBatch.from_pydict({"country": ["ES"]})],
+    )
+    assert list(backend.table_as_rows(test_table.table_uuid)) == [(6, "ES")]
+
+
+def test_count__kept_up_to_date(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    assert backend.count(test_table.table_uuid) == RowCount(0, 0)
+
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("FR",)])
+    assert backend.count(test_table.table_uuid).best() == 2
+
+    # updated rows are not counted again, deleted ones are uncounted
+    backend.upsert_table_data(
+        test_table, [country_col], [("UK",), ("DE",), ("US",)], key=(country_col,)
+    )
+    assert backend.count(test_table.table_uuid).best() == 3
+
+    backend.delete_row(test_table.table_uuid, 1)
+    assert backend.count(test_table.table_uuid).best() == 2
+
+    backend.replace_record_batches(
+        test_table, [country_col], [pa.RecordBatch.from_pydict({"country": ["ES"]})]
+    )
+    assert backend.count(test_table.table_uuid).best() == 1
+
+    backend.delete_table_data(test_table)
+    assert backend.count_many([test_table.table_uuid]) == {
+        test_table.table_uuid: RowCount(0, 0)
+    }
+
+
+def test_version__bumped_by_changes(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+
+    def versions() -> Tuple[int, int]:
+        _, version, latest_version = backend.counts_and_versions(
+            [test_table.table_uuid]
+        )[test_table.table_uuid]
+        return version, latest_version
+
+    folded_version, _ = versions()
+    latest_versions = [versions()[1]]
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("FR",)])
+    latest_versions.append(versions()[1])
+    backend.update_row(test_table.table_uuid, 1, {country_col: "DE"})
+    latest_versions.append(versions()[1])
+    backend.delete_row(test_table.table_uuid, 2)
+    latest_versions.append(versions()[1])
+    assert latest_versions == sorted(set(latest_versions))
+
+    # changes to the rows are only logged, so the version the repcache goes by
+    # is left alone until they are folded in
+    assert versions()[0] == folded_version
+    assert backend.fold_changes(test_table.table_uuid) == [test_table.table_uuid]
+    assert versions() == (latest_versions[-1], latest_versions[-1])
+    assert backend.count(test_table.table_uuid) == RowCount(1, 1)
+    assert backend.fold_changes(test_table.table_uuid) == []
+
+    svc.mark_table_changed(sesh, test_table.table_uuid)
+    assert versions()[0] > latest_versions[-1]
+
+    # statements that change no rows leave the version alone
+    before = versions()
+    assert not backend.update_row(test_table.table_uuid, 100, {country_col: "US"})
+    backend.delete_row(test_table.table_uuid, 100)
+    assert versions() == before
+
+
+def test_concurrent_writers_dont_queue(sesh, session_cls, test_user):
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    sesh.commit()
+
+    with session_cls() as first, session_cls() as second:
+        PGUserdataAdapter(first).insert_table_data(test_table, [country_col], [("UK",)])
+        # the first writer hasn't committed, but the second doesn't wait
+        second.execute(text("SET LOCAL lock_timeout = '1s'"))
+        PGUserdataAdapter(second).insert_table_data(
+            test_table, [country_col], [("FR",)]
+        )
+        first.commit()
+        second.commit()
+
+    assert PGUserdataAdapter(sesh).count(test_table.table_uuid) == RowCount(2, 2)
+
+
+def test_note_column_use(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    big_table = replace(test_table, row_count=RowCount(1_000_000, 1_000_000))
+
+    # small tables are never indexed
+    assert not any(backend.note_column_use(test_table, country_col) for _ in range(5))
+
+    uses = [backend.note_column_use(big_table, country_col) for _ in range(5)]
+    assert uses == [False, False, True, False, False]
+
+    # the count is shared, outlives the session and stops at the threshold
+    sesh.rollback()
+    assert backend.note_column_use(big_table, country_col) is False
+    assert (
+        sesh.execute(
+            select(models.ColumnUse.uses).where(
+                models.ColumnUse.table_uuid == test_table.table_uuid
+            )
+        ).scalar_one()
+        == pguserdata.COLUMN_INDEX_THRESHOLD
+    )
+
+
+def test_note_column_use__indexed_columns_not_counted(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("FR",)])
+    sesh.commit()
+    backend.create_column_index(test_table.table_uuid, country_col.name)
+    sesh.commit()
+
+    table = svc.get_table(sesh, test_user.username, test_table.table_name)
+    assert table.indexed_columns == [country_col]
+    big_table = replace(table, row_count=RowCount(1_000_000, 1_000_000))
+    with count_queries(sesh) as statements:
+        assert not backend.note_column_use(big_table, country_col)
+    assert statements == []
+
+
+def test_create_column_index__survives_replace(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country name", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("FR",)])
+    # the index is built concurrently, which waits for open transactions
+    sesh.commit()
+
+    backend.create_column_index(test_table.table_uuid, country_col.name)
+    sesh.commit()
+    # it is fine to ask twice
+    backend.create_column_index(test_table.table_uuid, country_col.name)
+    sesh.commit()
+    assert backend.column_indexes(test_table.table_uuid) == ["country name"]
+
+    def index_names():
+        return set(
+            sesh.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = :tablename"),
+                {"tablename": f"table_{test_table.table_uuid.hex}"},
+            ).scalars()
+        )
+
+    expected = {
+        f"table_{test_table.table_uuid.hex}_pkey",
+        backend._column_index_name(test_table.table_uuid, country_col.name),
+    }
+    assert index_names() == expected
+
+    backend.replace_record_batches(
+        test_table,
+        [country_col],
+        [pa.RecordBatch.from_pydict({"country name": ["DE", "US"]})],
+    )
+    assert index_names() == expected
+
+
+def test_create_column_index__replaces_invalid_index(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [country_col])
+    backend.insert_table_data(test_table, [country_col], [("UK",), ("UK",)])
+    sesh.commit()
+
+    # a concurrent build that fails part way leaves an invalid index behind
+    index_name = backend._column_index_name(test_table.table_uuid, country_col.name)
+    table_name = backend._make_userdata_table_name(
+        test_table.table_uuid, with_schema=True
+    )
+    with pytest.raises(IntegrityError):
+        with backend._autocommit_connection() as conn:
+            conn.execute(
+                text(
+                    f"CREATE UNIQUE INDEX CONCURRENTLY {index_name}"
+                    f" ON {table_name} (country)"
+                )
+            )
+
+    backend.create_column_index(test_table.table_uuid, country_col.name)
+    sesh.commit()
+    is_valid = sesh.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": f"userdata.{index_name}"},
+    ).scalar_one()
+    assert is_valid
+
+
+def test_get_row__one_query(sesh, ten_rows):
+    # as for a row GET: the table's metadata is loaded (from cache), then the row
+    svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+    sesh.commit()
+    with count_queries(sesh) as statements:
+        table = svc.get_table(sesh, ten_rows.username, ten_rows.table_name)
+        row = PGUserdataAdapter(sesh).get_row(table.table_uuid, 1)
+    assert len(statements) == 1
+    assert row is not None and row[ROW_ID_COLUMN] == 1
+
+
+def test_get_columns__remembered_for_the_transaction(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    a_col = Column("a", ColumnType.TEXT)
+    test_table = create_table(sesh, test_user, [a_col])
+    sesh.commit()
+    expected = [ROW_ID_COLUMN, a_col]
+
+    assert backend.get_columns(test_table.table_uuid) == expected
+    with count_queries(sesh) as statements:
+        assert backend.get_columns(test_table.table_uuid) == expected
+        assert backend.get_columns_many([test_table.table_uuid]) == {
+            test_table.table_uuid: expected
+        }
+    assert statements == []
+
+    # but forgotten when the table is dropped
+    backend.drop_table(test_table.table_uuid)
+    b_col = Column("b", ColumnType.INTEGER)
+    backend.create_table(test_table.table_uuid, [b_col])
+    assert backend.get_columns(test_table.table_uuid) == [ROW_ID_COLUMN, b_col]
+
+    # and when the transaction ends
+    sesh.rollback()
+    with count_queries(sesh) as statements:
+        assert backend.get_columns(test_table.table_uuid) == expected
+    assert len(statements) == 1
+
+
+def test_apply_row_operations(sesh, test_user):
+    backend = PGUserdataAdapter(sesh)
+    country_col = Column("country", ColumnType.TEXT)
+    pop_col = Column("population", ColumnType.INTEGER)
+    founded_col = Column("founded", ColumnType.DATE)
+    columns = [country_col, pop_col, founded_col]
+    test_table = create_table(sesh, test_user, columns)
+    backend.insert_table_data(
+        test_table, columns, [("UK", 67, date(1707, 5, 1)), ("FR", 68, None)]
+    )
+
+    def row(country, population=None, founded=None):
+        return {country_col: country, pop_col: population, founded_col: founded}
+
+    operations = [
+        RowOperation("create", row=row("DE", 84)),
+        RowOperation("create", row=row("US", 335, date(1776, 7, 4))),
+        RowOperation("update", row_id=1, row=row("GB", 67)),
+        RowOperation("update", row_id=99, row=row("XX")),
+        # updating the same row twice is done in order
+        RowOperation("update", row_id=1, row=row("UK")),
+        RowOperation("delete", row_id=2),
+        RowOperation("delete", row_id=99),
+        RowOperation("update", row_id=3, row=row("DE", 83)),
+    ]
+    with count_queries(sesh) as statements:
+        results = backend.apply_row_operations(test_table.table_uuid, operations)
+    # one for the new ids, then one per run of operations
+    assert len(statements) == 6
+
+    assert results == [
+        RowOperationResult("create", 3, True),
+        RowOperationResult("create", 4, True),
+        RowOperationResult("update", 1, True),
+        RowOperationResult("update", 99, False),
+        RowOperationResult("update", 1, True),
+        RowOperationResult("delete", 2, True),
+        RowOperationResult("delete", 99, False),
+        RowOperationResult("update", 3, True),
+    ]
+    assert list(backend.table_as_rows(test_table.table_uuid)) == [
+        (1, "UK", None, None),
+        (3, "DE", 83, None),
+        (4, "US", 335, date(1776, 7, 4)),
+    ]
+    assert backend.count(test_table.table_uuid).best() == 3
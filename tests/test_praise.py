@@ -1,5 +1,11 @@
+from typing import List
+from uuid import UUID
+
+from sqlalchemy import text
+
+from csvbase import svc
 from csvbase.web.main.bp import get_praise_id_if_exists
-from .utils import current_user
+from .utils import current_user, create_table
 
 
 def test_praise__praise(sesh, client, test_user, ten_rows):
@@ -32,3 +38,67 @@ def test_praise__unpraise(sesh, client, test_user, ten_rows):
 def test_praise__not_signed_in(client, test_user, ten_rows):
     resp = client.post(f"/{test_user.username}/{ten_rows.table_name}/praise")
     assert resp.status_code == 401
+
+
+def test_top_n__ranked_by_praise(sesh, test_user):
+    unpraised = create_table(sesh, test_user)
+    praised = create_table(sesh, test_user)
+    svc.praise(sesh, test_user.username, praised.table_name, test_user.user_uuid)
+    sesh.commit()
+
+    # not shown until the ranking is refreshed
+    assert praised.table_uuid not in top_n_uuids(sesh)
+
+    svc.refresh_top_tables(sesh)
+    sesh.commit()
+    top_uuids = top_n_uuids(sesh)
+    assert top_uuids.index(praised.table_uuid) < top_uuids.index(unpraised.table_uuid)
+
+
+def test_top_n__excludes_tables_made_private(sesh, test_user):
+    table = create_table(sesh, test_user)
+    svc.praise(sesh, test_user.username, table.table_name, test_user.user_uuid)
+    sesh.commit()
+    svc.refresh_top_tables(sesh)
+    sesh.commit()
+    assert table.table_uuid in top_n_uuids(sesh)
+
+    svc.update_table_metadata(
+        sesh, table.table_uuid, is_public=False, caption="", licence=None
+    )
+    sesh.commit()
+    assert table.table_uuid not in top_n_uuids(sesh)
+
+
+def test_top_n__loads_tables(sesh, test_user):
+    table = create_table(sesh, test_user)
+    svc.praise(sesh, test_user.username, table.table_name, test_user.user_uuid)
+    sesh.commit()
+    svc.refresh_top_tables(sesh)
+    sesh.commit()
+
+    # just praised, so at (or very near) the top
+    top = list(svc.get_top_n(sesh, n=5))
+    assert [t.table_uuid for t in top] == svc.get_top_n_uuids(sesh, n=5)
+    (loaded,) = [t for t in top if t.table_uuid == table.table_uuid]
+    assert loaded == svc.get_table(sesh, test_user.username, table.table_name)
+
+
+def test_top_n__score_of_new_tables(sesh, test_user):
+    # refreshed in the same transaction, so now() is before the table was
+    # created
+    table = create_table(sesh, test_user)
+    svc.praise(sesh, test_user.username, table.table_name, test_user.user_uuid)
+    svc.refresh_top_tables(sesh)
+    score = sesh.execute(
+        text("SELECT score FROM metadata.top_tables WHERE table_uuid = :table_uuid"),
+        dict(table_uuid=table.table_uuid),
+    ).scalar_one()
+    assert score > 0
+
+
+def top_n_uuids(sesh) -> List[UUID]:
+    # loading thousands of tables in one transaction runs postgres out of
+    # locks, so check the ranking here and get_top_n in
+    # test_top_n__loads_tables
+    return svc.get_top_n_uuids(sesh, n=10_000)
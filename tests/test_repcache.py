@@ -1,13 +1,22 @@
-from datetime import datetime, timezone
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import patch
 
+import pytest
+import pyarrow as pa
+
+from csvbase import exc
 from csvbase.value_objs import ContentType
 from csvbase.repcache import RepCache
+from csvbase.storage import LocalObjectStore, local
 
 from .utils import random_uuid, random_df
 
 
 def test_repcache__miss():
-    repcache = RepCache(random_uuid(), ContentType.CSV, datetime.now(timezone.utc))
+    repcache = RepCache(random_uuid(), ContentType.CSV, 1)
 
     assert not repcache.exists()
 
@@ -15,9 +24,9 @@ def test_repcache__miss():
 def test_repcache__hit():
     table_uuid = random_uuid()
     content_type = ContentType.CSV
-    last_changed = datetime.now(timezone.utc)
+    version = 1
 
-    repcache = RepCache(table_uuid, content_type, last_changed)
+    repcache = RepCache(table_uuid, content_type, version)
 
     contents = b"a,b,c\n1,2,3"
 
@@ -36,8 +45,7 @@ def test_repcache__update_wipes_out_old_reps():
     table_uuid = random_uuid()
     content_type = ContentType.CSV
 
-    initial_dt = datetime(2018, 1, 3, tzinfo=timezone.utc)
-    initial_repcache = RepCache(table_uuid, content_type, initial_dt)
+    initial_repcache = RepCache(table_uuid, content_type, 1)
     initial_contents = b"a,b,c\n1,2,3"
 
     with initial_repcache.open("wb") as rep_file:
@@ -45,9 +53,8 @@ def test_repcache__update_wipes_out_old_reps():
 
     assert initial_repcache.exists()
 
-    update_dt = datetime(2018, 1, 4, tzinfo=timezone.utc)
     update_contents = b"a,b,c\n4,5,6"
-    update_repcache = RepCache(table_uuid, content_type, update_dt)
+    update_repcache = RepCache(table_uuid, content_type, 2)
 
     with update_repcache.open("wb") as rep_file:
         rep_file.write(update_contents)
@@ -58,32 +65,201 @@ def test_repcache__update_wipes_out_old_reps():
 
 def test_repcache__sizes():
     table_uuid = random_uuid()
-    last_changed = datetime.now(timezone.utc)
+    version = 1
     df = random_df()
 
-    csv_repcache = RepCache(table_uuid, ContentType.CSV, last_changed)
+    csv_repcache = RepCache(table_uuid, ContentType.CSV, version)
     with csv_repcache.open("wb") as rep_file:
         df.to_csv(rep_file)
 
-    parquet_repcache = RepCache(table_uuid, ContentType.PARQUET, last_changed)
+    parquet_repcache = RepCache(table_uuid, ContentType.PARQUET, version)
     with parquet_repcache.open("wb") as rep_file:
         df.to_parquet(rep_file)
 
-    sizes = RepCache.sizes(table_uuid, last_changed)
+    sizes = RepCache.sizes(table_uuid, version)
     assert {ContentType.CSV, ContentType.PARQUET} == set(sizes.keys())
     assert {int} == set(type(v) for v in sizes.values())
 
 
 def test_repcache__path():
     table_uuid = random_uuid()
-    last_changed = datetime(2018, 1, 3, tzinfo=timezone.utc)
-    repcache = RepCache(table_uuid, ContentType.CSV, last_changed)
+    repcache = RepCache(table_uuid, ContentType.CSV, 3)
 
     df = random_df()
 
     with repcache.open("wb") as rep_file:
         df.to_csv(rep_file)
 
-    expected = f"{table_uuid}/2018-01-03T00_00_00+00_00.csv"
+    expected = f"{table_uuid}/3.csv"
     actual = repcache.path()
     assert expected == actual
+
+
+def test_repcache__precompressed_variants():
+    table_uuid = random_uuid()
+    repcache = RepCache(table_uuid, ContentType.CSV, 1)
+    with repcache.open("wb") as rep_file:
+        random_df().to_csv(rep_file)
+    contents = read_rep(repcache)
+
+    variants = repcache.variants()
+    assert {"gzip", "zstd"} == {variant.encoding for variant in variants}
+    for variant in variants:
+        assert variant.exists()
+        compressed = read_rep(variant)
+        assert len(compressed) < len(contents)
+        assert (
+            pa.input_stream(
+                pa.py_buffer(compressed), compression=variant.encoding
+            ).read()
+            == contents
+        )
+
+    # the variants don't count as separate content types
+    assert {ContentType.CSV} == set(RepCache.sizes(table_uuid, 1).keys())
+
+    # and parquet is not compressed again
+    assert RepCache(table_uuid, ContentType.PARQUET, 1).variants() == []
+
+
+@pytest.fixture()
+def local_store(tmp_path):
+    store = LocalObjectStore(tmp_path)
+    with patch("csvbase.storage.__object_store__", store):
+        yield store
+
+
+def write_rep(
+    store: LocalObjectStore, version: int, contents: bytes, age: timedelta
+) -> RepCache:
+    # parquet, which has no precompressed variants to account for
+    repcache = RepCache(random_uuid(), ContentType.PARQUET, version)
+    with repcache.open("wb") as rep_file:
+        rep_file.write(contents)
+    used = time.time() - age.total_seconds()
+    os.utime(store.path(repcache._key()), (used, used))
+    return repcache
+
+
+def test_repcache__evict_least_recently_used(local_store):
+    oldest = write_rep(local_store, 1, b"a" * 100, timedelta(days=3))
+    middle = write_rep(local_store, 1, b"b" * 100, timedelta(days=2))
+    newest = write_rep(local_store, 1, b"c" * 100, timedelta(days=1))
+
+    # reading marks it as used
+    with oldest.open("rb") as rep_file:
+        assert rep_file.read() == b"a" * 100
+
+    assert RepCache.evict(200) == 100
+    assert not middle.exists()
+    assert oldest.exists()
+    assert newest.exists()
+
+
+def test_repcache__evict_spares_recently_used(local_store):
+    rep = write_rep(local_store, 1, b"a" * 100, timedelta(minutes=1))
+
+    assert RepCache.evict(0) == 0
+    assert rep.exists()
+
+
+def test_repcache__evict_while_open(local_store):
+    rep = write_rep(local_store, 1, b"a" * 100, timedelta(days=1))
+
+    with rep.open("rb") as rep_file:
+        os.utime(local_store.path(rep._key()), (0, 0))
+        assert RepCache.evict(0) == 100
+        assert rep_file.read() == b"a" * 100
+    assert not rep.exists()
+
+
+def test_repcache__single_writer(local_store):
+    repcache = RepCache(random_uuid(), ContentType.CSV, 1)
+    with repcache.open("wb") as rep_file:
+        rep_file.write(b"a,b,c\n")
+        with pytest.raises(exc.RepWriteInProgress):
+            with repcache.open("wb"):
+                pass
+        rep_file.write(b"1,2,3\n")
+
+    with repcache.open("rb") as rep_file:
+        assert rep_file.read() == b"a,b,c\n1,2,3\n"
+
+
+def test_repcache__follow_write_in_progress(local_store):
+    repcache = RepCache(random_uuid(), ContentType.CSV, 1)
+    with ThreadPoolExecutor(1) as executor:
+        with repcache.open("wb") as rep_file:
+            rep_file.write(b"a,b,c\n")
+            rep_file.flush()
+            assert repcache.write_in_progress()
+
+            follower = executor.submit(read_rep, repcache)
+            rep_file.write(b"1,2,3\n")
+        assert follower.result() == b"a,b,c\n1,2,3\n"
+    assert not repcache.write_in_progress()
+
+
+def test_repcache__wait_for_write_that_seeks(local_store):
+    # xlsx files are zip files, which are not written start to end
+    repcache = RepCache(random_uuid(), ContentType.XLSX, 1)
+    with ThreadPoolExecutor(1) as executor:
+        with repcache.open("wb") as rep_file:
+            rep_file.write(b"header, later\n")
+            rep_file.flush()
+
+            waiter = executor.submit(read_rep, repcache)
+            time.sleep(0.1)
+            assert not waiter.done()
+            rep_file.seek(0)
+            rep_file.write(b"header, final")
+        assert waiter.result() == b"header, final\n"
+
+
+@pytest.mark.parametrize("content_type", [ContentType.CSV, ContentType.XLSX])
+def test_repcache__stalled_write(local_store, content_type):
+    repcache = RepCache(random_uuid(), content_type, 1)
+    with patch.object(local, "FOLLOW_TIMEOUT", timedelta(milliseconds=200)):
+        with ThreadPoolExecutor(1) as executor:
+            with repcache.open("wb") as rep_file:
+                rep_file.write(b"a,b,c\n")
+                rep_file.flush()
+                reader = executor.submit(read_rep, repcache)
+                # the writer is stuck
+                with pytest.raises(exc.RepWriteInProgress):
+                    reader.result(timeout=5)
+
+
+def test_repcache__follow_failed_write(local_store):
+    repcache = RepCache(random_uuid(), ContentType.CSV, 1)
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(ValueError):
+            with repcache.open("wb") as rep_file:
+                rep_file.write(b"a,b,c\n")
+                rep_file.flush()
+                follower = executor.submit(read_rep, repcache)
+                # give the follower time to catch up
+                time.sleep(0.1)
+                raise ValueError()
+        with pytest.raises(RuntimeError):
+            follower.result()
+    assert not repcache.exists()
+
+
+def test_repcache__crashed_write(local_store):
+    repcache = RepCache(random_uuid(), ContentType.CSV, 1)
+    temp_path = local_store.path(repcache._key() + ".tmp")
+    temp_path.parent.mkdir(parents=True)
+    temp_path.write_bytes(b"a,b")
+    local_store.path(repcache._key() + ".lock").touch()
+
+    assert not repcache.write_in_progress()
+    with repcache.open("wb") as rep_file:
+        rep_file.write(b"a,b,c\n")
+    with repcache.open("rb") as rep_file:
+        assert rep_file.read() == b"a,b,c\n"
+
+
+def read_rep(repcache: RepCache) -> bytes:
+    with repcache.open("rb") as rep_file:
+        return rep_file.read()
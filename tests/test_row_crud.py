@@ -1,7 +1,11 @@
 from typing import Any, Dict
+import json
 from datetime import datetime
+from unittest.mock import patch
 import pytest
 
+from csvbase import svc
+from csvbase.config import get_config
 from csvbase.value_objs import ContentType
 from csvbase.userdata import PGUserdataAdapter
 from .utils import make_user, assert_is_valid_etag, create_table, current_user
@@ -66,6 +70,48 @@ def test_create__happy(client, ten_rows, test_user, accept_content_type):
         )
 
 
+def test_create__last_changed_coalesced(client, sesh, ten_rows, test_user):
+    table_url = f"/{test_user.username}/{ten_rows.table_name}"
+    csv_etag_before = client.get(table_url + ".csv").headers["ETag"]
+    json_etag_before = client.get(table_url + ".json").headers["ETag"]
+
+    with patch.object(get_config(), "table_changed_interval", 60):
+        post_resp = client.post(
+            f"{table_url}/rows/",
+            json={
+                "row": {
+                    "roman_numeral": "XI",
+                    "is_even": False,
+                    "as_date": "2018-01-11",
+                    "as_float": 11.5,
+                }
+            },
+            headers={
+                "Authorization": test_user.basic_auth(),
+                "Accept": ContentType.JSON.value,
+            },
+        )
+    assert post_resp.status_code == 201
+
+    # last_changed and the repcache are left for later, but the row count and
+    # the etags of pages change straight away
+    table = svc.get_table(sesh, test_user.username, ten_rows.table_name)
+    assert table.last_changed == ten_rows.last_changed
+    assert table.version == ten_rows.version
+    assert table.latest_version > ten_rows.latest_version
+    assert table.row_count.best() == 11
+    assert client.get(table_url + ".csv").headers["ETag"] == csv_etag_before
+    assert client.get(table_url + ".json").headers["ETag"] != json_etag_before
+
+    assert ten_rows.table_uuid in svc.flush_table_changes(sesh)
+    sesh.commit()
+    table = svc.get_table(sesh, test_user.username, ten_rows.table_name)
+    assert table.last_changed > ten_rows.last_changed
+    assert table.version == table.latest_version
+    assert client.get(table_url + ".csv").headers["ETag"] != csv_etag_before
+    assert ten_rows.table_uuid not in svc.flush_table_changes(sesh)
+
+
 def test_create__with_row_id(client, ten_rows, test_user, accept_content_type):
     """Creating a row with a specific row id is (currently) forbidden"""
     with current_user(test_user):
@@ -752,3 +798,92 @@ def test_delete__html_row_delete_check(client, ten_rows, test_user):
     with current_user(test_user):
         resp = client.get(url)
     assert resp.status_code == 200
+
+
+def test_batch__happy(client, ten_rows, test_user):
+    url = f"/{test_user.username}/{ten_rows.table_name}/rows/batch"
+    operations = [
+        {
+            "op": "create",
+            "row": {"roman_numeral": "XI", "is_even": False, "as_float": 11.5},
+        },
+        {"op": "update", "row_id": 1, "row": {"roman_numeral": "i"}},
+        {"op": "delete", "row_id": 2},
+        {"op": "delete", "row_id": 99},
+    ]
+    resp = client.post(
+        url, json=operations, headers={"Authorization": test_user.basic_auth()}
+    )
+    assert resp.status_code == 200, resp.data
+    row_url = f"http://localhost/{test_user.username}/{ten_rows.table_name}/rows/"
+    assert resp.json == {
+        "results": [
+            {"op": "create", "row_id": 11, "applied": True, "url": row_url + "11"},
+            {"op": "update", "row_id": 1, "applied": True, "url": row_url + "1"},
+            {"op": "delete", "row_id": 2, "applied": True, "url": row_url + "2"},
+            {"op": "delete", "row_id": 99, "applied": False, "url": row_url + "99"},
+        ]
+    }
+
+    assert client.get(row_url + "11").json["row"]["as_float"] == 11.5
+    assert client.get(row_url + "1").json["row"] == {
+        "roman_numeral": "i",
+        "is_even": None,
+        "as_date": None,
+        "as_float": None,
+    }
+    assert client.get(row_url + "2").status_code == 404
+
+    table_resp = client.get(f"/{test_user.username}/{ten_rows.table_name}.json")
+    assert (
+        datetime.fromisoformat(table_resp.json["last_changed"]) > ten_rows.last_changed
+    )
+
+
+def test_batch__json_lines(client, ten_rows, test_user):
+    url = f"/{test_user.username}/{ten_rows.table_name}/rows/batch"
+    body = "\n".join(
+        json.dumps({"op": "create", "row": {"roman_numeral": numeral}})
+        for numeral in ["XI", "XII", "XIII"]
+    )
+    resp = client.post(
+        url,
+        data=body + "\n",
+        headers={
+            "Authorization": test_user.basic_auth(),
+            "Content-Type": ContentType.JSON_LINES.value,
+        },
+    )
+    assert resp.status_code == 200, resp.data
+    assert [result["row_id"] for result in resp.json["results"]] == [11, 12, 13]
+
+
+@pytest.mark.parametrize(
+    "operation",
+    [
+        pytest.param({"op": "upsert", "row": {}}, id="unknown op"),
+        pytest.param({"op": "delete"}, id="no row id"),
+        pytest.param({"op": "delete", "row_id": "1"}, id="string row id"),
+        pytest.param({"op": "create", "row_id": 12, "row": {}}, id="create with id"),
+        pytest.param({"op": "create", "row": {"nonexistent": 1}}, id="bad column"),
+    ],
+)
+def test_batch__invalid(client, ten_rows, test_user, operation):
+    url = f"/{test_user.username}/{ten_rows.table_name}/rows/batch"
+    operations = [{"op": "delete", "row_id": 1}, operation]
+    resp = client.post(
+        url, json=operations, headers={"Authorization": test_user.basic_auth()}
+    )
+    assert resp.status_code == 400, resp.data
+
+    # nothing is done
+    row_resp = client.get(f"/{test_user.username}/{ten_rows.table_name}/rows/1")
+    assert row_resp.status_code == 200
+
+
+def test_batch__not_authed(client, ten_rows, test_user):
+    resp = client.post(
+        f"/{test_user.username}/{ten_rows.table_name}/rows/batch",
+        json=[{"op": "delete", "row_id": 1}],
+    )
+    assert resp.status_code == 401
@@ -3,10 +3,13 @@
 import string
 
 import pytest
+from sqlalchemy import event, text
 
 from csvbase import svc
 from csvbase.userdata import PGUserdataAdapter
 from csvbase.value_objs import (
+    BinaryFilter,
+    BinaryOp,
     Column,
     ColumnType,
     KeySet,
@@ -16,7 +19,7 @@ from csvbase.value_objs import (
     Licence,
 )
 
-from .utils import random_string
+from .utils import random_string, count_queries
 
 
 # FIXME: scope="module"?
@@ -183,3 +186,179 @@ def test_paging_on_empty_table(sesh, test_user):
     )
 
     assert page == Page(rows=[], has_less=False, has_more=False)
+
+
+def test_page_is_one_query(sesh, test_user, letters_table):
+    backend = PGUserdataAdapter(sesh)
+    with count_queries(sesh) as statements:
+        page = backend.table_page(
+            letters_table,
+            keyset=KeySet([csvbase_row_id_col], (3,), op="greater_than", size=3),
+        )
+    assert len(statements) == 1
+    assert page.has_less and page.has_more
+    assert rows_to_alist(page.rows) == [(4, "d"), (5, "e"), (6, "f")]
+
+
+@pytest.fixture()
+def numbers_table(test_user, module_sesh) -> Table:
+    """A table whose rows are not in the order of their numbers."""
+    table_name = random_string()
+
+    columns = [Column("number", type_=ColumnType.INTEGER)]
+    rows = [[n] for n in [5, 3, None, 1, 3, 4, 2]]
+    table_uuid = svc.create_table_metadata(
+        module_sesh,
+        test_user.user_uuid,
+        table_name,
+        True,
+        "",
+        backend=Backend.POSTGRES,
+        licence=None,
+    )
+    backend = PGUserdataAdapter(module_sesh)
+    backend.create_table(table_uuid, columns)
+    table = svc.get_table(module_sesh, test_user.username, table_name)
+    backend.insert_table_data(table, columns, rows)
+    module_sesh.commit()
+    return svc.get_table(module_sesh, test_user.username, table_name)
+
+
+number_col = Column("number", ColumnType.INTEGER)
+
+
+@pytest.mark.parametrize(
+    "values, op, expected_rows, has_less, has_more",
+    [
+        pytest.param(
+            (), "greater_than", [(4, 1), (7, 2), (2, 3)], False, True, id="first"
+        ),
+        pytest.param(
+            (3, 2), "greater_than", [(5, 3), (6, 4), (1, 5)], True, True, id="ties"
+        ),
+        pytest.param(
+            (), "less_than", [(6, 4), (1, 5), (3, None)], True, False, id="last"
+        ),
+        pytest.param(
+            (3, 5), "less_than", [(4, 1), (7, 2), (2, 3)], False, True, id="back"
+        ),
+        pytest.param(
+            (5, 1), "greater_than", [(3, None)], True, False, id="into the nulls"
+        ),
+        pytest.param(
+            (None, 3),
+            "less_than",
+            [(5, 3), (6, 4), (1, 5)],
+            True,
+            True,
+            id="back from the nulls",
+        ),
+        pytest.param((None, 3), "greater_than", [], True, False, id="over the top"),
+    ],
+)
+def test_sorted_page(
+    sesh, numbers_table, values, op, expected_rows, has_less, has_more
+):
+    backend = PGUserdataAdapter(sesh)
+    with count_queries(sesh) as statements:
+        page = backend.table_page(
+            numbers_table,
+            keyset=KeySet([number_col, csvbase_row_id_col], values, op=op, size=3),
+        )
+    assert len(statements) == 1
+    # nulls come last
+    assert rows_to_alist(page.rows) == expected_rows
+    assert (page.has_less, page.has_more) == (has_less, has_more)
+
+
+def rows_removed_by_filter(plan) -> int:
+    return plan.get("Rows Removed by Filter", 0) + sum(
+        rows_removed_by_filter(subplan) for subplan in plan.get("Plans", [])
+    )
+
+
+@pytest.mark.parametrize(
+    "values, op",
+    [
+        pytest.param((500, 1), "greater_than", id="forward"),
+        pytest.param((999, 1), "greater_than", id="into the nulls"),
+        pytest.param((None, 1), "less_than", id="back from the nulls"),
+    ],
+)
+def test_sorted_page__uses_index(sesh, test_user, values, op):
+    columns = [number_col]
+    table_name = random_string()
+    table_uuid = svc.create_table_metadata(
+        sesh,
+        test_user.user_uuid,
+        table_name,
+        True,
+        "",
+        backend=Backend.POSTGRES,
+        licence=None,
+    )
+    backend = PGUserdataAdapter(sesh)
+    backend.create_table(table_uuid, columns)
+    table = svc.get_table(sesh, test_user.username, table_name)
+    backend.insert_table_data(
+        table, columns, [[n % 1000 if n % 10 else None] for n in range(20_000)]
+    )
+    sesh.commit()
+    backend.create_column_index(table_uuid, number_col.name)
+    sesh.execute(text(f"ANALYZE userdata.table_{table_uuid.hex}"))
+    sesh.commit()
+
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        executed.append((statement, parameters))
+
+    engine = sesh.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        backend.table_page(
+            table, KeySet([number_col, csvbase_row_id_col], values, op=op, size=10)
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    statement, parameters = executed[0]
+    ((plan,),) = sesh.connection().exec_driver_sql(
+        f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}", parameters
+    )
+    # a condition that the index can't be used for is applied row by row
+    assert rows_removed_by_filter(plan[0]["Plan"]) < 100
+
+
+def test_filtered_page(sesh, numbers_table):
+    backend = PGUserdataAdapter(sesh)
+    keyset = KeySet(
+        [csvbase_row_id_col],
+        (),
+        op="greater_than",
+        size=2,
+        filters=[
+            BinaryFilter(number_col, 2, BinaryOp.GTE),
+            BinaryFilter(number_col, 5, BinaryOp.NQE),
+        ],
+    )
+    page = backend.table_page(numbers_table, keyset)
+    assert rows_to_alist(page.rows) == [(2, 3), (5, 3)]
+    assert (page.has_less, page.has_more) == (False, True)
+
+    keyset.values = (5,)
+    page = backend.table_page(numbers_table, keyset)
+    assert rows_to_alist(page.rows) == [(6, 4), (7, 2)]
+    assert (page.has_less, page.has_more) == (True, False)
+
+
+def test_filtered_page__nothing_matches(sesh, numbers_table):
+    backend = PGUserdataAdapter(sesh)
+    keyset = KeySet(
+        [number_col, csvbase_row_id_col],
+        (),
+        op="greater_than",
+        filters=[BinaryFilter(number_col, 10, BinaryOp.GT)],
+    )
+    page = backend.table_page(numbers_table, keyset)
+    assert page == Page(rows=[], has_less=False, has_more=False)
@@ -0,0 +1,116 @@
+from io import BytesIO
+from datetime import timedelta
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from csvbase import temp
+from csvbase.repcache import RepCache
+from csvbase.storage import s3
+from csvbase.value_objs import ContentType
+
+from .utils import random_uuid, random_string
+
+BUCKET = "csvbase-test"
+
+
+@pytest.fixture()
+def s3_store(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        store = s3.S3ObjectStore(client, BUCKET)
+        with patch("csvbase.storage.__object_store__", store):
+            yield store
+
+
+def test_s3__small_write_and_read(s3_store):
+    with s3_store.open_write("a/b.csv") as obj_file:
+        obj_file.write(b"a,b,c\n")
+
+    assert s3_store.exists("a/b.csv")
+    assert s3_store.sizes("a/") == {"a/b.csv": 6}
+    with s3_store.open_read("a/b.csv") as obj_file:
+        assert obj_file.read() == b"a,b,c\n"
+
+
+def test_s3__multipart_write_and_ranged_read(s3_store):
+    contents = bytes(range(256)) * (((s3.PART_SIZE * 2) // 256) + 1)
+    with s3_store.open_write("big") as obj_file:
+        for index in range(0, len(contents), 1_000_000):
+            obj_file.write(contents[index : index + 1_000_000])
+
+    with s3_store.open_read("big") as obj_file:
+        obj_file.seek(s3.PART_SIZE - 10)
+        assert obj_file.read(20) == contents[s3.PART_SIZE - 10 : s3.PART_SIZE + 10]
+        obj_file.seek(0)
+        assert obj_file.read() == contents
+
+
+def test_s3__failed_write(s3_store):
+    with pytest.raises(ValueError):
+        with s3_store.open_write("big") as obj_file:
+            obj_file.write(b"a" * (s3.PART_SIZE + 1))
+            raise ValueError()
+
+    assert not s3_store.exists("big")
+    uploads = s3_store.client.list_multipart_uploads(Bucket=BUCKET)
+    assert uploads.get("Uploads", []) == []
+
+
+def test_s3__missing(s3_store):
+    assert not s3_store.exists("nothing")
+    with pytest.raises(FileNotFoundError):
+        s3_store.open_read("nothing")
+
+
+def test_s3__evict(s3_store):
+    for key in ["x/1", "x/2", "x/3"]:
+        with s3_store.open_write(key) as obj_file:
+            obj_file.write(b"a" * 100)
+
+    # nothing is old enough yet
+    assert s3_store.evict("x/", 100) == 0
+
+    with patch.object(s3, "EVICTION_GRACE", timedelta(days=-1)):
+        assert s3_store.evict("x/", 100) == 200
+    assert len(s3_store.sizes("x/")) == 1
+
+
+def test_s3__repcache(s3_store):
+    table_uuid = random_uuid()
+    old_repcache = RepCache(table_uuid, ContentType.CSV, 1)
+    with old_repcache.open("wb") as rep_file:
+        rep_file.write(b"a,b,c\n")
+
+    repcache = RepCache(table_uuid, ContentType.CSV, 2)
+    with repcache.open("wb") as rep_file:
+        rep_file.write(b"a,b,c\n1,2,3\n")
+
+    assert not old_repcache.exists()
+    assert RepCache.sizes(table_uuid, 2) == {ContentType.CSV: 12}
+    with repcache.open("rb") as rep_file:
+        assert rep_file.read() == b"a,b,c\n1,2,3\n"
+
+    url = repcache.url("table.csv")
+    assert url is not None
+    assert f"repcache/{table_uuid}/2.csv" in url
+
+
+def test_s3__temp(s3_store):
+    contents = f"{random_string()}\n".encode("utf-8")
+
+    file_id = temp.store_temp_file(BytesIO(contents))
+    with temp.retrieve_temp_file(file_id) as f:
+        assert f.read() == contents
+
+
+def test_s3__table_download_redirects(s3_store, client, ten_rows, test_user):
+    resp = client.get(f"/{test_user.username}/{ten_rows.table_name}.csv")
+    assert resp.status_code == 302
+    assert f"repcache/{ten_rows.table_uuid}/" in resp.headers["Location"]
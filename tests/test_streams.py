@@ -1,12 +1,12 @@
 from pathlib import Path
 import os
-from io import StringIO
+from io import StringIO, BytesIO
 
 import pytest
 
 from csvbase import exc
 from csvbase.value_objs import Column, ColumnType
-from csvbase.streams import peek_csv, rewind
+from csvbase.streams import peek_csv, rewind, csv_chunk_offsets, IterableReader
 
 test_data = Path(__file__).resolve().parent / "test-data"
 
@@ -87,3 +87,21 @@ def test_rewind__partial():
     with rewind(buf, to=buf.tell(), allow_seekback=True):
         assert buf.read() == "lo"
     assert buf.read() == "lo"
+
+
+def test_csv_chunk_offsets():
+    csv_bytes = b'a,b\n1,"x\ny"\n2,"""z"""\n3,w\n'
+    offsets = csv_chunk_offsets(BytesIO(csv_bytes), 3, '"')
+    assert offsets == [(0, 4), (4, 12), (12, 22), (22, 26)]
+    assert b"".join(csv_bytes[start:end] for start, end in offsets) == csv_bytes
+
+
+def test_csv_chunk_offsets__unbalanced_quotes():
+    assert csv_chunk_offsets(BytesIO(b'a,b\n1,"x\n2,y\n'), 2, '"') is None
+
+
+def test_iterable_reader():
+    reader = IterableReader([b"hello", b"", b" world"])
+    assert reader.read(3) == b"hel"
+    assert reader.read() == b"lo world"
+    assert reader.read() == b""
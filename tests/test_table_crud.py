@@ -1,16 +1,20 @@
+import email
+from email.message import Message
 from io import BytesIO, SEEK_END, StringIO
 from datetime import date, datetime, timezone
 from unittest.mock import ANY
-from typing import Mapping, Optional
+from typing import List, Mapping, Optional
 from urllib.parse import quote_plus
 from unittest.mock import patch
 
 import pandas as pd
+import pyarrow as pa
 from pandas.testing import assert_frame_equal
 import pytest
 from werkzeug.wrappers.response import Response
 
-from csvbase import svc, streams, table_io, models
+from csvbase import exc, svc, streams, table_io, models
+from csvbase.storage import LocalObjectStore
 from csvbase.value_objs import (
     ContentType,
     Table,
@@ -216,6 +220,33 @@ hello,1,1.5,FALSE,2018-01-03
         assert_frame_equal(expected_df, actual_df)
 
 
+def test_create__parquet(client, test_user):
+    expected_df = pd.DataFrame(
+        {
+            "a": ["hello", None],
+            "b": pd.Series([1, 2], dtype="int32"),
+            "c": [1.5, 2.5],
+            "d": [False, True],
+            "e": [date(2018, 1, 3), date(2018, 1, 4)],
+        }
+    )
+    parquet_buf = BytesIO()
+    expected_df.to_parquet(parquet_buf, index=False)
+    table_name = random_string()
+    url = f"/{test_user.username}/{table_name}"
+    with current_user(test_user):
+        resp = client.put(
+            url,
+            data=parquet_buf.getvalue(),
+            headers={"Content-Type": ContentType.PARQUET.value},
+        )
+        assert resp.status_code == 201
+
+        resp = get_table(client, test_user.username, table_name, ContentType.PARQUET)
+    actual_df = pd.read_parquet(BytesIO(resp.data)).drop(columns="csvbase_row_id")
+    assert_frame_equal(expected_df.astype({"b": "int64"}), actual_df)
+
+
 def test_create__doesnt_exist(client, test_user):
     new_csv = """a,b,c,d,e
 hello,1,1.5,FALSE,2018-01-03
@@ -370,7 +401,7 @@ def test_read__happy(client, ten_rows, test_user, content_type):
     vary = resp.headers.get("Vary")
     assert cc_obj.no_cache
     assert cc_obj.must_revalidate
-    assert vary == "Accept, Cookie"
+    assert vary == "Accept, Accept-Encoding, Cookie"
 
     if content_type == ContentType.HTML:
         assert cc_obj.private
@@ -536,6 +567,211 @@ def test_read__x_accel_redirect(client, ten_rows, test_user, content_type, sesh)
     assert resp.headers.get("X-Accel-Redirect", "").startswith("/repcache/")
 
 
+@pytest.mark.parametrize("encoding", ["gzip", "zstd"])
+@pytest.mark.parametrize("content_type", [ContentType.CSV, ContentType.JSON_LINES])
+def test_read__precompressed(client, ten_rows, test_user, content_type, encoding):
+    plain_resp = get_table(
+        client, test_user.username, ten_rows.table_name, content_type
+    )
+    assert plain_resp.status_code == 200
+    assert "Content-Encoding" not in plain_resp.headers
+
+    resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        content_type,
+        extra_headers={"Accept-Encoding": f"{encoding}, br;q=0.5"},
+    )
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == encoding
+    assert resp.headers.get("Content-Length", type=int) == len(resp.data)
+    assert len(resp.data) < len(plain_resp.data)
+    decompressed = pa.input_stream(pa.py_buffer(resp.data), compression=encoding).read()
+    assert decompressed == plain_resp.data
+
+    # a different representation, so a different etag
+    assert_is_valid_etag(resp.headers["ETag"])
+    assert resp.headers["ETag"] != plain_resp.headers["ETag"]
+    not_modified_resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        content_type,
+        extra_headers={
+            "Accept-Encoding": encoding,
+            "If-None-Match": resp.headers["ETag"],
+        },
+    )
+    assert not_modified_resp.status_code == 304
+
+
+@pytest.mark.parametrize(
+    "served_by, expected_status", [("nginx", 200), ("object store", 302)]
+)
+def test_read__precompressed_served_elsewhere(
+    client, ten_rows, test_user, served_by, expected_status
+):
+    # the variant is encoded by whatever serves it, not this response
+    def get_gzipped():
+        return get_table(
+            client,
+            test_user.username,
+            ten_rows.table_name,
+            ContentType.CSV,
+            extra_headers={"Accept-Encoding": "gzip"},
+        )
+
+    assert get_gzipped().headers["Content-Encoding"] == "gzip"
+    if served_by == "nginx":
+        with patch.object(get_config(), "x_accel_redirect", True):
+            resp = get_gzipped()
+    else:
+        with patch(
+            "csvbase.web.main.bp.RepCache.url",
+            return_value="https://s3.example.com/table.csv.gz",
+        ):
+            resp = get_gzipped()
+    assert resp.status_code == expected_status
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_read__stalled_write(client, ten_rows, test_user):
+    # eg: the rep is being written by a writer that is stuck
+    with patch.object(
+        LocalObjectStore, "open_read", side_effect=exc.RepWriteInProgress()
+    ):
+        resp = get_table(
+            client, test_user.username, ten_rows.table_name, ContentType.CSV
+        )
+    assert resp.status_code == 503
+    assert "Retry-After" in resp.headers
+
+
+def test_read__precompressed_not_for_parquet(client, ten_rows, test_user):
+    resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        ContentType.PARQUET,
+        extra_headers={"Accept-Encoding": "gzip"},
+    )
+    assert resp.status_code == 200
+    assert "Content-Encoding" not in resp.headers
+
+
+@pytest.mark.parametrize(
+    "range_header, expected_slice",
+    [
+        ("bytes=0-9", slice(0, 10)),
+        ("bytes=10-", slice(10, None)),
+        ("bytes=-10", slice(-10, None)),
+        ("bytes=5-1000000", slice(5, None)),
+    ],
+)
+def test_read__range(client, ten_rows, test_user, range_header, expected_slice):
+    whole_resp = get_table(
+        client, test_user.username, ten_rows.table_name, ContentType.CSV
+    )
+    assert whole_resp.headers["Accept-Ranges"] == "bytes"
+    whole = whole_resp.data
+
+    resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        ContentType.CSV,
+        extra_headers={"Range": range_header},
+    )
+    assert resp.status_code == 206
+    expected = whole[expected_slice]
+    assert resp.data == expected
+    assert resp.headers.get("Content-Length", type=int) == len(expected)
+    start = expected_slice.indices(len(whole))[0]
+    assert (
+        resp.headers["Content-Range"]
+        == f"bytes {start}-{start + len(expected) - 1}/{len(whole)}"
+    )
+    assert resp.headers["ETag"] == whole_resp.headers["ETag"]
+
+
+def test_read__multiple_ranges(client, ten_rows, test_user):
+    whole = get_table(
+        client, test_user.username, ten_rows.table_name, ContentType.CSV
+    ).data
+
+    resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        ContentType.CSV,
+        extra_headers={"Range": "bytes=0-4,20-29,-5"},
+    )
+    assert resp.status_code == 206
+    assert resp.mimetype == "multipart/byteranges"
+    assert resp.headers.get("Content-Length", type=int) == len(resp.data)
+
+    message = email.message_from_bytes(
+        f"Content-Type: {resp.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        + resp.data
+    )
+    parts: List[Message] = message.get_payload()  # type: ignore[assignment]
+    assert [part["Content-Range"] for part in parts] == [
+        f"bytes 0-4/{len(whole)}",
+        f"bytes 20-29/{len(whole)}",
+        f"bytes {len(whole) - 5}-{len(whole) - 1}/{len(whole)}",
+    ]
+    assert [part.get_payload(decode=True) for part in parts] == [
+        whole[0:5],
+        whole[20:30],
+        whole[-5:],
+    ]
+
+
+def test_read__range_not_satisfiable(client, ten_rows, test_user):
+    whole = get_table(
+        client, test_user.username, ten_rows.table_name, ContentType.CSV
+    ).data
+
+    resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        ContentType.CSV,
+        extra_headers={"Range": f"bytes={len(whole)}-"},
+    )
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == f"bytes */{len(whole)}"
+
+
+def test_read__if_range(client, ten_rows, test_user):
+    whole_resp = get_table(
+        client, test_user.username, ten_rows.table_name, ContentType.CSV
+    )
+    etag = whole_resp.headers["ETag"]
+
+    matching_resp = get_table(
+        client,
+        test_user.username,
+        ten_rows.table_name,
+        ContentType.CSV,
+        extra_headers={"Range": "bytes=10-", "If-Range": etag},
+    )
+    assert matching_resp.status_code == 206
+    assert matching_resp.data == whole_resp.data[10:]
+
+    for if_range in ['"something-else"', whole_resp.headers["Last-Modified"]]:
+        stale_resp = get_table(
+            client,
+            test_user.username,
+            ten_rows.table_name,
+            ContentType.CSV,
+            extra_headers={"Range": "bytes=10-", "If-Range": if_range},
+        )
+        assert stale_resp.status_code == 200
+        assert stale_resp.data == whole_resp.data
+
+
 def test_read__metadata_headers(client, ten_rows, test_user, content_type, sesh):
     """Check that Last-Modified and Link headers are there - these are useful to consumers.
 
@@ -646,6 +882,104 @@ def test_read__paging_over_the_top(client, test_user, ten_rows, content_type):
         assert resp.json == {"error": "that page does not exist"}
 
 
+def test_read__sorted_and_filtered(client, test_user, ten_rows):
+    url = f"/{test_user.username}/{ten_rows.table_name}"
+    resp = client.get(
+        url,
+        query_string={"sort": "as_float", "op": "lt", "is_even.eq": "true"},
+        headers={"Accept": ContentType.JSON.value},
+    )
+    assert resp.status_code == 200, resp.data
+    page = resp.json["page"]
+    # the last page (of 5) is all of them
+    assert [row["row_id"] for row in page["rows"]] == [2, 4, 6, 8, 10]
+    assert page["previous_page_url"] is None
+    assert page["next_page_url"] is None
+
+    resp = client.get(
+        url,
+        query_string={
+            "sort": "as_date",
+            "v": "2018-01-03",
+            "n": "3",
+            "as_float.lt": "8",
+        },
+        headers={"Accept": ContentType.JSON.value},
+    )
+    assert resp.status_code == 200, resp.data
+    page = resp.json["page"]
+    assert [row["row_id"] for row in page["rows"]] == [4, 5, 6, 7]
+    # the sort and filters are kept
+    assert page["previous_page_url"] == (
+        f"http://localhost{url}?sort=as_date&as_float.lt=8.0&op=lt&n=4&v=2018-01-04"
+    )
+    assert page["next_page_url"] is None
+
+
+def test_read__sorted_with_nulls(client, sesh, test_user, ten_rows):
+    backend = PGUserdataAdapter(sesh)
+    as_float = ten_rows.columns[-1]
+    for row_id in [3, 7]:
+        backend.update_row(ten_rows.table_uuid, row_id, {as_float: None})
+    svc.mark_table_changed(sesh, ten_rows.table_uuid)
+    sesh.commit()
+
+    url = f"/{test_user.username}/{ten_rows.table_name}"
+    resp = client.get(
+        url, query_string={"sort": "as_float"}, headers={"Accept": "application/json"}
+    )
+    assert resp.status_code == 200, resp.data
+    # nulls come last rather than being left out
+    row_ids = [row["row_id"] for row in resp.json["page"]["rows"]]
+    assert row_ids == [1, 2, 4, 5, 6, 8, 9, 10, 3, 7]
+
+    # keys with a null sort value have no "v"
+    resp = client.get(
+        url,
+        query_string={"sort": "as_float", "n": "3"},
+        headers={"Accept": "application/json"},
+    )
+    assert resp.status_code == 200, resp.data
+    page = resp.json["page"]
+    assert [row["row_id"] for row in page["rows"]] == [7]
+    assert page["previous_page_url"] == (
+        f"http://localhost{url}?sort=as_float&op=lt&n=7"
+    )
+
+
+@pytest.mark.parametrize(
+    "query_string, expected_status",
+    [
+        pytest.param({"sort": "nonexistent"}, 400, id="unknown sort column"),
+        pytest.param({"nonexistent.eq": "1"}, 400, id="unknown filter column"),
+        pytest.param({"as_float.between": "1"}, 400, id="unknown filter op"),
+        pytest.param({"as_float.eq": "one"}, 422, id="unparseable filter value"),
+    ],
+)
+def test_read__bad_sort_or_filter(
+    client, test_user, ten_rows, query_string, expected_status
+):
+    resp = client.get(
+        f"/{test_user.username}/{ten_rows.table_name}",
+        query_string=query_string,
+        headers={"Accept": ContentType.JSON.value},
+    )
+    assert resp.status_code == expected_status, resp.data
+
+
+def test_read__sorting_requests_an_index(client, test_user, ten_rows):
+    with patch.object(PGUserdataAdapter, "note_column_use", return_value=True), patch(
+        "csvbase.web.main.bp.task_registry.create_column_index.delay"
+    ) as delay:
+        resp = client.get(
+            f"/{test_user.username}/{ten_rows.table_name}",
+            query_string={"sort": "as_date"},
+            headers={"Accept": ContentType.JSON.value},
+        )
+    assert resp.status_code == 200, resp.data
+    delay.assert_called_once_with(ten_rows.table_uuid, "as_date")
+
+
 def test_overwrite__no_ids(client, test_user, ten_rows):
     new_csv = """csvbase_row_id,roman_numeral,is_even,as_date,as_float
 ,X,yes,2018-01-10,10.0
@@ -665,6 +999,28 @@ def test_overwrite__no_ids(client, test_user, ten_rows):
     assert list(df.index) == [11, 12]
 
 
+def test_overwrite__keep_missing(client, test_user, ten_rows):
+    new_csv = """csvbase_row_id,roman_numeral,is_even,as_date,as_float
+1,I,no,2018-01-01,1.5
+,XI,no,2018-01-11,11.0
+"""
+    url = f"/{test_user.username}/{ten_rows.table_name}"
+    resp = client.put(
+        url,
+        data=new_csv,
+        query_string={"delete_missing": "false"},
+        headers={"Content-Type": "text/csv", "Authorization": test_user.basic_auth()},
+    )
+    assert resp.status_code == 200, resp.data
+    assert resp.json["deleted"] == 0
+    assert resp.json["inserted"] == 1
+
+    get_resp = client.get(url, headers={"Accept": "text/csv"})
+    df = pd.read_csv(BytesIO(get_resp.data), index_col="csvbase_row_id")
+    assert list(df.index) == list(range(1, 12))
+    assert df.loc[1, "as_float"] == 1.5
+
+
 def test_overwrite__some_ids(client, test_user, ten_rows):
     url = f"/{test_user.username}/{ten_rows.table_name}"
     get_resp = client.get(url)
@@ -684,6 +1040,13 @@ def test_overwrite__some_ids(client, test_user, ten_rows):
         headers={"Content-Type": "text/csv", "Authorization": test_user.basic_auth()},
     )
     assert post_resp.status_code == 200
+    assert post_resp.json == {
+        "message": f"upserted {test_user.username}/{ten_rows.table_name}",
+        "inserted": 2,
+        "updated": 0,
+        "deleted": 0,
+        "unchanged": 10,
+    }
 
     new_get_resp = client.get(url)
     df = pd.read_csv(BytesIO(new_get_resp.data))
@@ -718,6 +1081,42 @@ XI,no,2018-01-11,11.0
     assert resp.status_code == 200
 
 
+def test_overwrite__parquet(client, test_user, ten_rows):
+    url = f"/{test_user.username}/{ten_rows.table_name}"
+    get_resp = client.get(url, headers={"Accept": ContentType.PARQUET.value})
+    df = pd.read_parquet(BytesIO(get_resp.data)).iloc[:-1]
+    parquet_buf = BytesIO()
+    df.to_parquet(parquet_buf, index=False)
+
+    put_resp = client.put(
+        url,
+        data=parquet_buf.getvalue(),
+        headers={
+            "Content-Type": ContentType.PARQUET.value,
+            "Authorization": test_user.basic_auth(),
+        },
+    )
+    assert put_resp.status_code == 200
+
+    actual_df = pd.read_csv(BytesIO(client.get(url).data))
+    assert list(actual_df.csvbase_row_id) == list(range(1, 10))
+
+
+def test_overwrite__parquet_columns_dont_match(client, test_user, ten_rows):
+    parquet_buf = BytesIO()
+    pd.DataFrame({"a": [1]}).to_parquet(parquet_buf, index=False)
+    resp = client.put(
+        f"/{test_user.username}/{ten_rows.table_name}",
+        data=parquet_buf.getvalue(),
+        headers={
+            "Content-Type": ContentType.PARQUET.value,
+            "Authorization": test_user.basic_auth(),
+        },
+    )
+    assert resp.status_code == 400
+    assert resp.json == {"error": "columns or types don't match existing"}
+
+
 @pytest.mark.xfail(reason="not implemented")
 def test_overwrite__wrong_content_type(client, test_user, ten_rows):
     assert False
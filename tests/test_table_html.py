@@ -10,3 +10,17 @@ def test_table_rest_api_docs__private(private_table, test_user, client):
     with current_user(test_user):
         resp = client.get(f"/{test_user.username}/{private_table}/docs")
     assert resp.status_code == 200
+
+
+def test_table_view__sorted(ten_rows, test_user, client):
+    url = f"/{test_user.username}/{ten_rows.table_name}"
+    resp = client.get(
+        url,
+        query_string={"sort": "as_float", "is_even.eq": "true"},
+        headers={"Accept": "text/html"},
+    )
+    assert resp.status_code == 200
+    html = resp.text
+    assert "Sorted by as_float" in html
+    # the column headers link to sorting by that column, keeping the filters
+    assert f'href="{url}?sort=roman_numeral&amp;is_even.eq=true"' in html
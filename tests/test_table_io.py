@@ -1,13 +1,19 @@
 import io
 import csv
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import date
 import string
+import codecs
+from unittest.mock import patch
 
 import pytest
 
-from csvbase.exc import CSVParseError
+from csvbase.exc import CSVParseError, TableDefinitionMismatchException
 from csvbase.value_objs import Column, ColumnType
 from csvbase import table_io
+from csvbase.config import get_config
 from csvbase.streams import rewind
 
 
@@ -49,3 +55,174 @@ def test_csv_to_rows__many_errors():
         df.to_csv(buf, index=False)
     with pytest.raises(CSVParseError):
         list(table_io.csv_to_rows(buf, [Column("a", ColumnType.INTEGER)], csv.excel))
+
+
+def record_batches_as_rows(batches):
+    return [tuple(row.values()) for batch in batches for row in batch.to_pylist()]
+
+
+@pytest.mark.parametrize(
+    "column_type, values",
+    [
+        (
+            ColumnType.INTEGER,
+            ["1", " 2 ", "-3", "1,000", "1.0", "", "NA", "null", "#N/A"],
+        ),
+        (ColumnType.INTEGER, ["9223372036854775807", "-9223372036854775808"]),
+        (
+            ColumnType.FLOAT,
+            ["1.5", "-0.25", "1,000.5", "1.", ".5", "1e+10", "1e-3", "3", "nan", ""],
+        ),
+        (ColumnType.BOOLEAN, ["true", "FALSE", " t", "f ", "Yes", "no", "Y", "n", ""]),
+        (ColumnType.DATE, ["2018-01-03", " 2018-01-03 ", "1066-10-14", "", "N/A"]),
+        (
+            ColumnType.TEXT,
+            ["a", "", " b ", "NA", "null", "é", 'quote "d"', "new\nline"],
+        ),
+    ],
+)
+def test_csv_to_record_batches__same_as_csv_to_rows(column_type, values):
+    columns = [Column("a", column_type)]
+    csv_buf = io.StringIO()
+    csv.writer(csv_buf).writerows([["a"]] + [[value] for value in values])
+
+    csv_buf.seek(0)
+    expected = [tuple(row) for row in table_io.csv_to_rows(csv_buf, columns, csv.excel)]
+    csv_buf.seek(0)
+    actual = record_batches_as_rows(
+        table_io.csv_to_record_batches(csv_buf, columns, csv.excel)
+    )
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    "column_type, bad_value",
+    [
+        (ColumnType.INTEGER, "a"),
+        (ColumnType.INTEGER, "1 000"),
+        (ColumnType.INTEGER, "1.5"),
+        (ColumnType.INTEGER, "12345678901234567890"),
+        (ColumnType.INTEGER, "-9223372036854775809"),
+        (ColumnType.FLOAT, "1.2.3"),
+        (ColumnType.BOOLEAN, "maybe"),
+        (ColumnType.DATE, "2018-02-30"),
+        (ColumnType.DATE, "0000-01-01"),
+        (ColumnType.DATE, "03/01/2018"),
+    ],
+)
+def test_csv_to_record_batches__errors(column_type, bad_value):
+    column = Column("a", column_type)
+    csv_buf = io.StringIO(f"a\n\n{bad_value}\n")
+    with pytest.raises(CSVParseError) as e:
+        list(table_io.csv_to_record_batches(csv_buf, [column], csv.excel))
+    assert e.value.error_locations == [
+        table_io.CSVParseErrorLocation(1, column, bad_value)
+    ]
+
+
+def test_csv_to_record_batches__many_errors():
+    column = Column("a", ColumnType.INTEGER)
+    csv_buf = io.StringIO("a\n" + "\n".join(string.ascii_letters))
+    with pytest.raises(CSVParseError) as e:
+        list(table_io.csv_to_record_batches(csv_buf, [column], csv.excel))
+    assert [location.row for location in e.value.error_locations] == list(range(1, 12))
+
+
+def test_csv_to_record_batches__dialects():
+    columns = [Column("a", ColumnType.INTEGER), Column("b", ColumnType.TEXT)]
+    tab_buf = io.StringIO("a\tb\n1\tx\n2\ty\n")
+    assert record_batches_as_rows(
+        table_io.csv_to_record_batches(tab_buf, columns, csv.excel_tab)
+    ) == [(1, "x"), (2, "y")]
+
+    class SpacesAfterComma(csv.excel):
+        skipinitialspace = True
+
+    spaced_buf = io.StringIO("a, b\n1, x\n2, y\n")
+    assert record_batches_as_rows(
+        table_io.csv_to_record_batches(spaced_buf, columns, SpacesAfterComma)
+    ) == [(1, "x"), (2, "y")]
+
+
+def test_csv_to_record_batches__header_only():
+    csv_buf = io.StringIO("a,b\n")
+    columns = [Column("a", ColumnType.INTEGER), Column("b", ColumnType.TEXT)]
+    assert list(table_io.csv_to_record_batches(csv_buf, columns, csv.excel)) == []
+
+
+def test_csv_to_record_batches__ragged():
+    csv_buf = io.StringIO("a,b\n1,2\n3\n")
+    columns = [Column("a", ColumnType.INTEGER), Column("b", ColumnType.INTEGER)]
+    with pytest.raises(CSVParseError):
+        list(table_io.csv_to_record_batches(csv_buf, columns, csv.excel))
+
+
+@pytest.fixture()
+def parallel_csv_parsing():
+    with patch.object(get_config(), "csv_parse_workers", 2):
+        with patch.object(get_config(), "csv_parse_chunk_size", 64):
+            yield
+
+
+def test_csv_to_record_batches__parallel(parallel_csv_parsing):
+    columns = [Column("a", ColumnType.INTEGER), Column("b", ColumnType.TEXT)]
+    csv_str = "a,b\n" + "".join(f'{n},"line {n}\nis ""{n}"""\n' for n in range(100))
+    csv_buf = codecs.getreader("utf-8")(io.BytesIO(csv_str.encode("utf-8")))
+    assert record_batches_as_rows(
+        table_io.csv_to_record_batches(csv_buf, columns, csv.excel)
+    ) == [(n, f'line {n}\nis "{n}"') for n in range(100)]
+
+
+def test_csv_to_record_batches__parallel_errors(parallel_csv_parsing):
+    column = Column("a", ColumnType.INTEGER)
+    csv_str = "a\n" + "\n".join("x" if n in (10, 70) else str(n) for n in range(100))
+    csv_buf = codecs.getreader("utf-8")(io.BytesIO(csv_str.encode("utf-8")))
+    with pytest.raises(CSVParseError) as e:
+        list(table_io.csv_to_record_batches(csv_buf, [column], csv.excel))
+    assert e.value.error_locations == [
+        table_io.CSVParseErrorLocation(11, column, "x"),
+        table_io.CSVParseErrorLocation(71, column, "x"),
+    ]
+
+
+def test_parquet_file_to_record_batches():
+    parquet_buf = io.BytesIO()
+    pq.write_table(
+        pa.table(
+            {
+                "a": pa.array([1, 2, 3], type=pa.int32()),
+                "b": pa.array([1.5, None, 3.5], type=pa.float32()),
+                "c": pa.array([date(2018, 1, 3)] * 3, type=pa.date64()),
+                "d": ["x", "y", "z"],
+            }
+        ),
+        parquet_buf,
+    )
+    parquet_buf.seek(0)
+    assert table_io.is_parquet(parquet_buf)
+    pf = table_io.buf_to_pf(parquet_buf)
+
+    columns = table_io.parquet_file_to_columns(pf)
+    assert columns == [
+        Column("a", ColumnType.INTEGER),
+        Column("b", ColumnType.FLOAT),
+        Column("c", ColumnType.DATE),
+        Column("d", ColumnType.TEXT),
+    ]
+
+    batches = list(
+        table_io.parquet_file_to_record_batches(pf, columns[:2], batch_size=2)
+    )
+    assert [batch.num_rows for batch in batches] == [2, 1]
+    assert record_batches_as_rows(batches) == [(1, 1.5), (2, None), (3, 3.5)]
+    assert list(table_io.parquet_file_to_rows(pf))[0] == (1, 1.5, date(2018, 1, 3), "x")
+
+
+def test_parquet_file_to_columns__existing_columns():
+    parquet_buf = io.BytesIO()
+    pq.write_table(pa.table({"a": [1]}), parquet_buf)
+    pf = table_io.buf_to_pf(parquet_buf)
+    existing = [Column("b", ColumnType.TEXT), Column("a", ColumnType.FLOAT)]
+    assert table_io.parquet_file_to_columns(pf, existing) == [existing[1]]
+    with pytest.raises(TableDefinitionMismatchException):
+        table_io.parquet_file_to_columns(pf, existing[:1])
@@ -1,9 +1,9 @@
-from csvbase.value_objs import Column, ColumnType, BinaryOp
+from csvbase.value_objs import Column, ColumnType, BinaryOp, Licence
 from csvbase import svc
 
 import pytest
 
-from .utils import create_table
+from .utils import create_table, count_queries
 
 
 @pytest.fixture()
@@ -92,3 +92,28 @@ def test_paging_on_empty_table(sesh, test_user):
     assert page.tables == []
     assert not page.has_next
     assert not page.has_prev
+
+
+def test_page_matches_get_table(sesh, test_user):
+    a_col = Column("a", ColumnType.TEXT)
+    keyed = create_table(
+        sesh, test_user, [a_col], licence=Licence.from_spdx_id("CC0-1.0")
+    )
+    svc.set_key(sesh, keyed.table_uuid, [a_col])
+    create_table(sesh, test_user)
+    sesh.commit()
+
+    page = svc.table_page(sesh, test_user.user_uuid, test_user, count=2)
+    for table in page.tables:
+        assert table == svc.get_table(sesh, test_user.username, table.table_name)
+
+
+@pytest.mark.parametrize("count", [2, 10])
+def test_page_query_count_is_constant(sesh, user_with_tables, count):
+    with count_queries(sesh) as statements:
+        page = svc.table_page(
+            sesh, user_with_tables.user_uuid, user_with_tables, count=count
+        )
+    assert len(page.tables) == count
+    # page, columns, counts, keys, licences, has_next, has_prev
+    assert len(statements) == 7
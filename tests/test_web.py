@@ -62,6 +62,8 @@ def test_table_view_etag():
             created=datetime(2018, 1, 3, 9),
             row_count=RowCount(0, 0),
             last_changed=t[1],
+            version=1,
+            latest_version=1,
             key=None,
             licence=None,
         )
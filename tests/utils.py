@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Optional, Iterable, Mapping, Generator
+from typing import Optional, Iterable, Mapping, Generator, List
 from datetime import datetime, timezone
 import random
 import string
@@ -15,6 +15,7 @@ from uuid import UUID, uuid4
 
 from lxml import etree
 from lxml.cssselect import CSSSelector
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 import pandas as pd
 from werkzeug.datastructures import MultiDict
@@ -269,3 +270,18 @@ def mock_turnstile(requests_mocker, response_dict=HAPPY_TURNSTILE_RESPONSE):
     resp_json.update(response_dict)
 
     requests_mocker.post(TURNSTILE_URL, json=response_dict)
+
+
+@contextlib.contextmanager
+def count_queries(sesh) -> Generator[List[str], None, None]:
+    statements: List[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = sesh.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)